@@ -4,22 +4,41 @@ Sistema de análise avançada de clientes
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-from db_manager_v2 import DatabaseManager
+from db_manager_v2 import CATEGORIAS, EPOCA, DatabaseManager, classificar_frequencia, datas_dos_dias
 
 class AnalisadorClientes:
     def __init__(self, db_manager):
         self.db = db_manager
     
+    def _filtro_cliente(self, cliente_id, use_v2=False):
+        """Condição em vendas.cliente_id (e parâmetros) para o cliente dado por código (v2) ou nome
+        
+        As chaves são buscadas antes na dimensão: com `IN (subconsulta)` o SQLite
+        não estima quantas vendas o filtro pega e prefere varrer um índice inteiro.
+        """
+        coluna = 'cod_parceiro' if use_v2 else 'parceiro'
+        chaves = [linha[0] for linha in self.db.connect().execute(
+            f'SELECT id FROM dim_cliente WHERE {coluna} = ?', [cliente_id]
+        )]
+        return f"cliente_id IN ({','.join(['?'] * len(chaves)) or 'NULL'})", chaves
+    
+    def _produtos_do_cliente(self, cliente_id, use_v2=False):
+        """Chave e nome dos produtos que o cliente já comprou"""
+        filtro, chaves = self._filtro_cliente(cliente_id, use_v2)
+        return pd.read_sql(f'''
+            SELECT id, produto
+            FROM dim_produto
+            WHERE id IN (SELECT produto_id FROM vendas WHERE {filtro})
+        ''', self.db.connect(), params=chaves)
+    
     def get_analise_completa_cliente(self, cliente_id):
         """Retorna análise completa de um cliente específico (por código ou nome)"""
         
         # Verificar se é código ou nome
         conn = self.db.connect()
-        cursor = conn.cursor()
         
         # Tentar primeiro como código
-        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='clientes_metricas_v2'")
-        use_v2 = cursor.fetchone()[0] > 0
+        use_v2 = self.db.tem_recurso('metricas_v2')
         
         if use_v2:
             # Usar tabela v2 com códigos
@@ -34,12 +53,14 @@ class AnalisadorClientes:
             produtos = self.db.get_produtos_cliente_v2(cod_parceiro)
             
             # Histórico de compras
-            historico = pd.read_sql('''
-                SELECT data, n_venda, cod_produto, produto, quantidade, total
-                FROM vendas
-                WHERE cod_parceiro = ?
-                ORDER BY data DESC
-            ''', conn, params=[cod_parceiro])
+            filtro, chaves = self._filtro_cliente(cod_parceiro, True)
+            historico = pd.read_sql(f'''
+                SELECT v.data_dia AS data, v.n_venda, v.cod_produto, p.produto, v.quantidade, v.total
+                FROM vendas v
+                LEFT JOIN dim_produto p ON p.id = v.produto_id
+                WHERE v.{filtro}
+                ORDER BY v.data_dia DESC
+            ''', conn, params=chaves)
         else:
             # Usar tabela antiga
             cliente_info = self.db.get_cliente_data(cliente_id)
@@ -52,12 +73,29 @@ class AnalisadorClientes:
             produtos = self.db.get_produtos_cliente(parceiro)
             
             # Histórico de compras
-            historico = pd.read_sql('''
-                SELECT data, n_venda, produto, quantidade, total
-                FROM vendas
-                WHERE parceiro = ?
-                ORDER BY data DESC
-            ''', conn, params=[parceiro])
+            filtro, chaves = self._filtro_cliente(parceiro)
+            historico = pd.read_sql(f'''
+                SELECT v.data_dia AS data, v.n_venda, p.produto, v.quantidade, v.total
+                FROM vendas v
+                LEFT JOIN dim_produto p ON p.id = v.produto_id
+                WHERE v.{filtro}
+                ORDER BY v.data_dia DESC
+            ''', conn, params=chaves)
+        
+        historico['data'] = datas_dos_dias(historico['data'])
+        
+        # Evolução mensal (do resumo por cliente e mês)
+        evolucao = pd.read_sql(f'''
+            SELECT 
+                printf('%04d-%02d', ano_mes / 100, ano_mes % 100) as mes,
+                SUM(qtd_vendida) as qtd_vendida,
+                SUM(valor_total) as valor_total,
+                SUM(qtd_pedidos) as qtd_pedidos
+            FROM cliente_mes
+            WHERE {filtro}
+            GROUP BY ano_mes
+            ORDER BY ano_mes
+        ''', conn, params=chaves)
         
         # Determinar identificador para outras funções
         if use_v2:
@@ -81,6 +119,7 @@ class AnalisadorClientes:
             'info_basica': cliente_info.to_dict('records')[0],
             'produtos_comprados': produtos.to_dict('records'),
             'historico': historico.to_dict('records'),
+            'evolucao': evolucao.to_dict('records'),
             'categorias': categorias,
             'produtos_nao_comprados': produtos_nao_comprados,
             'frequencia': frequencia,
@@ -91,36 +130,23 @@ class AnalisadorClientes:
         """Analisa as categorias de produtos que o cliente compra"""
         conn = self.db.connect()
         
-        # Definir categorias
-        categorias_map = {
-            'Especiarias': ['CANELA', 'CRAVO', 'PIMENTA', 'GENGIBRE', 'CURCUMA', 'PAPRICA', 'ALHO', 'CEBOLA', 'OREGANO'],
-            'Frutas Secas': ['UVA PASSA', 'DAMASCO', 'GOJI', 'CRANBERRY', 'AMEIXA', 'TAMARA'],
-            'Oleaginosas': ['AMENDOA', 'CASTANHA', 'NOZES', 'AMENDOIM', 'PISTACHE', 'MACADAMIA'],
-            'Farinhas': ['FARINHA'],
-            'Chás e Ervas': ['CHA', 'HIBISCO', 'CAMOMILA', 'ERVA DOCE', 'HORTELA', 'BOLDO'],
-            'Óleos e Manteigas': ['OLEO', 'MANTEIGA', 'GHEE'],
-            'Suplementos': ['WHEY', 'PROTEIN', 'COLAGENO', 'VITAMINA', 'OMEGA'],
-            'Grãos e Sementes': ['CHIA', 'LINHACA', 'QUINOA', 'AVEIA', 'GIRASSOL', 'ABOBORA'],
-            'Açúcares e Adoçantes': ['ACUCAR', 'MEL', 'XILITOL', 'ERITRITOL', 'STEVIA'],
-            'Cacau e Chocolate': ['CACAU', 'CHOCOLATE', 'NIBS']
-        }
+        # Categorias pelas palavras do nome (as mesmas da categoria_principal das métricas)
+        categorias_map = CATEGORIAS
         
         # Buscar produtos do cliente
-        if use_v2:
-            query = '''
-                SELECT produto, SUM(total) as valor_total, SUM(quantidade) as qtd_total
+        filtro, chaves = self._filtro_cliente(cliente_id, use_v2)
+        query = f'''
+            SELECT p.produto, v.valor_total, v.qtd_total
+            FROM (
+                SELECT produto_id, SUM(total) as valor_total, SUM(quantidade) as qtd_total
                 FROM vendas
-                WHERE cod_parceiro = ?
-                GROUP BY produto
-            '''
-        else:
-            query = '''
-                SELECT produto, SUM(total) as valor_total, SUM(quantidade) as qtd_total
-                FROM vendas
-                WHERE parceiro = ?
-                GROUP BY produto
-            '''
-        df_produtos = pd.read_sql(query, conn, params=[cliente_id])
+                WHERE {filtro}
+                GROUP BY produto_id
+            ) v
+            LEFT JOIN dim_produto p ON p.id = v.produto_id
+            ORDER BY p.produto
+        '''
+        df_produtos = pd.read_sql(query, conn, params=chaves)
         
         # Classificar produtos em categorias
         resultado = {}
@@ -153,26 +179,17 @@ class AnalisadorClientes:
         conn = self.db.connect()
         
         # Produtos que o cliente já comprou
-        if use_v2:
-            produtos_comprados = pd.read_sql('''
-                SELECT DISTINCT produto 
-                FROM vendas 
-                WHERE cod_parceiro = ?
-            ''', conn, params=[cliente_id])['produto'].tolist()
-        else:
-            produtos_comprados = pd.read_sql('''
-                SELECT DISTINCT produto 
-                FROM vendas 
-                WHERE parceiro = ?
-            ''', conn, params=[cliente_id])['produto'].tolist()
+        produtos_comprados = self._produtos_do_cliente(cliente_id, use_v2)['produto'].tolist()
         
         # Todos os produtos disponíveis com suas métricas
         if use_v2:
             tabela_produtos = 'produtos_metricas_v2'
             col_produto = 'cod_produto, produto'
+            col_recencia = 'ultima_venda'
         else:
             tabela_produtos = 'produtos_metricas'
             col_produto = 'produto'
+            col_recencia = 'dias_desde_ultima'
         
         if produtos_comprados:
             todos_produtos = pd.read_sql(f'''
@@ -181,7 +198,7 @@ class AnalisadorClientes:
                     valor_total,
                     clientes_unicos,
                     taxa_recompra,
-                    dias_desde_ultima
+                    {col_recencia}
                 FROM {tabela_produtos}
                 WHERE produto NOT IN ({','.join(['?'] * len(produtos_comprados))})
                 ORDER BY valor_total DESC
@@ -193,11 +210,14 @@ class AnalisadorClientes:
                     valor_total,
                     clientes_unicos,
                     taxa_recompra,
-                    dias_desde_ultima
+                    {col_recencia}
                 FROM {tabela_produtos}
                 ORDER BY valor_total DESC
             ''', conn)
         
+        if use_v2:
+            todos_produtos = self.db.aplicar_referencia(todos_produtos, tabela_produtos)
+        
         # Adicionar score de recomendação
         todos_produtos['score_recomendacao'] = (
             todos_produtos['clientes_unicos'] * 0.3 +
@@ -208,24 +228,25 @@ class AnalisadorClientes:
         return todos_produtos.sort_values('score_recomendacao', ascending=False).to_dict('records')
     
     def analisar_frequencia_compra(self, cliente_id, use_v2=False):
-        """Analisa padrão de frequência de compra do cliente"""
-        conn = self.db.connect()
+        """Analisa padrão de frequência de compra do cliente
         
-        # Buscar datas de compra
+        Com use_v2, frequência, desvio e status vêm prontos de
+        clientes_metricas_v2 (montados na importação, com o status pela data
+        de referência); sem as métricas v2, os intervalos são calculados aqui.
+        """
         if use_v2:
-            datas = pd.read_sql('''
-                SELECT DISTINCT data
-                FROM vendas
-                WHERE cod_parceiro = ?
-                ORDER BY data
-            ''', conn, params=[cliente_id])
-        else:
-            datas = pd.read_sql('''
-                SELECT DISTINCT data
-                FROM vendas
-                WHERE parceiro = ?
-                ORDER BY data
-            ''', conn, params=[cliente_id])
+            return self._frequencia_v2(cliente_id)
+        
+        conn = self.db.connect()
+        
+        # Buscar datas de compra (dos pedidos: uma linha por n_venda)
+        filtro, chaves = self._filtro_cliente(cliente_id, use_v2)
+        datas = pd.read_sql(f'''
+            SELECT DISTINCT data_dia
+            FROM pedidos
+            WHERE {filtro} AND data_dia IS NOT NULL
+            ORDER BY data_dia
+        ''', conn, params=chaves)
         
         if len(datas) < 2:
             return {
@@ -235,17 +256,16 @@ class AnalisadorClientes:
                 'status_frequencia': 'Cliente Novo'
             }
         
-        # Calcular intervalos entre compras
-        datas['data'] = pd.to_datetime(datas['data'])
-        intervalos = datas['data'].diff().dt.days.dropna()
+        # Calcular intervalos entre compras (direto nos números de dia)
+        intervalos = datas['data_dia'].diff().dropna()
         
         freq_media = intervalos.mean()
         desvio = intervalos.std()
-        ultima_compra = datas['data'].max()
-        dias_desde_ultima = (datetime.now() - ultima_compra).days
+        ultima_compra = int(datas['data_dia'].max())
+        dias_desde_ultima = self.db.dia_referencia() - ultima_compra
         
         # Prever próxima compra
-        previsao = ultima_compra + timedelta(days=freq_media)
+        previsao = datas_dos_dias(ultima_compra) + timedelta(days=freq_media)
         
         # Determinar status
         if dias_desde_ultima > freq_media + desvio:
@@ -263,6 +283,35 @@ class AnalisadorClientes:
             'status_frequencia': status
         }
     
+    def _frequencia_v2(self, cod_parceiro):
+        """analisar_frequencia_compra lida da linha do cliente em clientes_metricas_v2"""
+        cliente = self.db.connect().execute('''
+            SELECT frequencia_media_dias, desvio_frequencia_dias, ultima_compra, tendencia
+            FROM clientes_metricas_v2
+            WHERE cod_parceiro = ?
+        ''', (cod_parceiro,)).fetchone()
+        if cliente is None or cliente[0] is None:
+            return {
+                'frequencia_media_dias': None,
+                'desvio_padrao_dias': None,
+                'previsao_proxima_compra': None,
+                'status_frequencia': 'Cliente Novo'
+            }
+        
+        freq_media, desvio, ultima_compra, tendencia = cliente
+        ultima_compra = pd.Timestamp(ultima_compra)
+        dias_desde_ultima = self.db.dia_referencia() - (ultima_compra - EPOCA).days
+        previsao = ultima_compra + timedelta(days=freq_media)
+        
+        return {
+            'frequencia_media_dias': round(freq_media, 1),
+            'desvio_padrao_dias': round(desvio, 1) if desvio is not None else 0,
+            'previsao_proxima_compra': previsao.strftime('%Y-%m-%d'),
+            'dias_desde_ultima': dias_desde_ultima,
+            'status_frequencia': classificar_frequencia(freq_media, desvio, dias_desde_ultima).item(),
+            'tendencia': tendencia
+        }
+    
     def gerar_recomendacoes(self, cliente_id, use_v2=False):
         """Gera recomendações de ação para o cliente"""
         conn = self.db.connect()
@@ -312,53 +361,44 @@ class AnalisadorClientes:
         
         # 3. Cross-sell baseado em produtos similares
         # Buscar produtos frequentemente comprados juntos
-        if use_v2:
-            produtos_cliente = pd.read_sql('''
-                SELECT DISTINCT produto FROM vendas WHERE cod_parceiro = ?
-            ''', conn, params=[cliente_id])['produto'].tolist()
-        else:
-            produtos_cliente = pd.read_sql('''
-                SELECT DISTINCT produto FROM vendas WHERE parceiro = ?
-            ''', conn, params=[cliente_id])['produto'].tolist()
+        produtos_cliente = self._produtos_do_cliente(cliente_id, use_v2)['id'].tolist()
         
         if produtos_cliente:
             # Encontrar clientes similares
-            if use_v2:
-                clientes_similares = pd.read_sql('''
-                    SELECT cod_parceiro, parceiro, COUNT(DISTINCT produto) as produtos_comum
+            filtro, chaves = self._filtro_cliente(cliente_id, use_v2)
+            clientes_similares = pd.read_sql('''
+                SELECT s.cliente_id, c.cod_parceiro, c.parceiro, s.produtos_comum
+                FROM (
+                    SELECT cliente_id, COUNT(DISTINCT produto_id) as produtos_comum
                     FROM vendas
-                    WHERE produto IN ({})
-                    AND cod_parceiro != ?
-                    GROUP BY cod_parceiro, parceiro
+                    WHERE produto_id IN ({})
+                    AND NOT ({})
+                    GROUP BY cliente_id
                     HAVING produtos_comum >= 3
                     ORDER BY produtos_comum DESC
                     LIMIT 10
-                '''.format(','.join(['?'] * len(produtos_cliente))), 
-                conn, params=produtos_cliente + [cliente_id])
-            else:
-                clientes_similares = pd.read_sql('''
-                    SELECT parceiro, COUNT(DISTINCT produto) as produtos_comum
-                    FROM vendas
-                    WHERE produto IN ({})
-                    AND parceiro != ?
-                    GROUP BY parceiro
-                    HAVING produtos_comum >= 3
-                    ORDER BY produtos_comum DESC
-                    LIMIT 10
-                '''.format(','.join(['?'] * len(produtos_cliente))), 
-                conn, params=produtos_cliente + [cliente_id])
+                ) s
+                JOIN dim_cliente c ON c.id = s.cliente_id
+                ORDER BY s.produtos_comum DESC
+            '''.format(','.join(['?'] * len(produtos_cliente)), filtro),
+            conn, params=produtos_cliente + chaves)
             
             if not clientes_similares.empty:
                 # Ver o que eles compram que nosso cliente não compra
-                similares_list = clientes_similares['parceiro'].tolist()
+                similares_list = clientes_similares['cliente_id'].tolist()
                 produtos_sugestao = pd.read_sql('''
-                    SELECT produto, COUNT(DISTINCT parceiro) as freq
-                    FROM vendas
-                    WHERE parceiro IN ({})
-                    AND produto NOT IN ({})
-                    GROUP BY produto
-                    ORDER BY freq DESC
-                    LIMIT 5
+                    SELECT p.produto, s.freq
+                    FROM (
+                        SELECT produto_id, COUNT(DISTINCT cliente_id) as freq
+                        FROM vendas
+                        WHERE cliente_id IN ({})
+                        AND produto_id NOT IN ({})
+                        GROUP BY produto_id
+                        ORDER BY freq DESC
+                        LIMIT 5
+                    ) s
+                    JOIN dim_produto p ON p.id = s.produto_id
+                    ORDER BY s.freq DESC
                 '''.format(
                     ','.join(['?'] * len(similares_list)),
                     ','.join(['?'] * len(produtos_cliente))
@@ -374,21 +414,30 @@ class AnalisadorClientes:
                     })
         
         # 4. Recompra de produtos
-        produtos_recompra = pd.read_sql('''
+        filtro, chaves = self._filtro_cliente(parceiro)
+        produtos_recompra = pd.read_sql(f'''
             SELECT 
-                produto,
-                MAX(data) as ultima_compra,
-                AVG(quantidade) as qtd_media,
-                COUNT(*) as vezes_comprado
-            FROM vendas
-            WHERE parceiro = ?
-            GROUP BY produto
-            HAVING vezes_comprado > 1
-        ''', conn, params=[parceiro])
+                p.produto,
+                r.ultima_compra,
+                r.qtd_media,
+                r.vezes_comprado
+            FROM (
+                SELECT
+                    produto_id,
+                    MAX(data_dia) as ultima_compra,
+                    AVG(quantidade) as qtd_media,
+                    COUNT(*) as vezes_comprado
+                FROM vendas
+                WHERE {filtro}
+                GROUP BY produto_id
+                HAVING vezes_comprado > 1
+            ) r
+            LEFT JOIN dim_produto p ON p.id = r.produto_id
+            ORDER BY p.produto
+        ''', conn, params=chaves)
         
         if not produtos_recompra.empty:
-            produtos_recompra['ultima_compra'] = pd.to_datetime(produtos_recompra['ultima_compra'])
-            produtos_recompra['dias_desde'] = (datetime.now() - produtos_recompra['ultima_compra']).dt.days
+            produtos_recompra['dias_desde'] = self.db.dia_referencia() - produtos_recompra['ultima_compra']
             
             # Produtos que já passou da hora de recomprar
             produtos_atrasados = produtos_recompra[produtos_recompra['dias_desde'] > 60]['produto'].head(3).tolist()
@@ -404,47 +453,33 @@ class AnalisadorClientes:
         return recomendacoes
     
     def get_clientes_para_acao(self, tipo_acao=None):
-        """Retorna lista de clientes que precisam de ação"""
-        conn = self.db.connect()
+        """Retorna lista de clientes que precisam de ação
+        
+        Segmento e dias sem comprar vêm das métricas com a data de referência
+        do banco, então as listas não dependem de quando as métricas foram
+        recalculadas.
+        """
+        clientes = self.db.get_cliente_data_v2()
         
         # Clientes em risco
-        em_risco = pd.read_sql('''
-            SELECT 
-                parceiro,
-                total_compras,
-                qtd_compras,
-                dias_desde_ultima,
-                segmento
-            FROM clientes_metricas
-            WHERE segmento IN ('Em Risco', 'Inativo')
-            ORDER BY total_compras DESC
-        ''', conn)
+        em_risco = clientes.loc[
+            clientes['segmento'].isin(['Em Risco', 'Inativo']),
+            ['parceiro', 'total_compras', 'qtd_compras', 'dias_desde_ultima', 'segmento']
+        ]
         
         # Clientes para reativação
-        para_reativar = pd.read_sql('''
-            SELECT 
-                parceiro,
-                total_compras,
-                dias_desde_ultima
-            FROM clientes_metricas
-            WHERE dias_desde_ultima > 60
-            AND qtd_compras > 1
-            ORDER BY total_compras DESC
-        ''', conn)
+        para_reativar = clientes.loc[
+            (clientes['dias_desde_ultima'] > 60) & (clientes['qtd_compras'] > 1),
+            ['parceiro', 'total_compras', 'dias_desde_ultima']
+        ]
         
         # Oportunidades de cross-sell (clientes que compram poucas categorias)
-        cross_sell = pd.read_sql('''
-            SELECT 
-                c.parceiro,
-                c.total_compras,
-                c.total_produtos_unicos,
-                c.qtd_compras
-            FROM clientes_metricas c
-            WHERE c.total_produtos_unicos < 5
-            AND c.qtd_compras > 2
-            AND c.dias_desde_ultima < 60
-            ORDER BY c.total_compras DESC
-        ''', conn)
+        cross_sell = clientes.loc[
+            (clientes['total_produtos_unicos'] < 5)
+            & (clientes['qtd_compras'] > 2)
+            & (clientes['dias_desde_ultima'] < 60),
+            ['parceiro', 'total_compras', 'total_produtos_unicos', 'qtd_compras']
+        ]
         
         return {
             'em_risco': em_risco.to_dict('records'),
@@ -457,34 +492,30 @@ class AnalisadorClientes:
         conn = self.db.connect()
 
         # Buscar clientes com apenas uma compra
-        uma_compra = pd.read_sql('''
-            SELECT
-                c.parceiro,
-                c.total_compras,
-                c.qtd_compras,
-                c.ticket_medio,
-                c.dias_desde_ultima,
-                c.ultima_compra,
-                c.segmento
-            FROM clientes_metricas c
-            WHERE c.qtd_compras = 1
-            ORDER BY c.total_compras DESC
-        ''', conn)
+        clientes = self.db.get_cliente_data_v2()
+        uma_compra = clientes.loc[
+            clientes['qtd_compras'] == 1,
+            ['cod_parceiro', 'parceiro', 'total_compras', 'qtd_compras', 'ticket_medio',
+             'dias_desde_ultima', 'ultima_compra', 'segmento']
+        ]
 
         # Para cada cliente, buscar os produtos comprados
         clientes_com_produtos = []
         for _, cliente in uma_compra.iterrows():
             # Buscar produtos comprados por este cliente
-            produtos = pd.read_sql('''
+            filtro, chaves = self._filtro_cliente(cliente['cod_parceiro'], use_v2=True)
+            produtos = pd.read_sql(f'''
                 SELECT
-                    v.produto,
+                    p.produto,
                     v.quantidade,
                     v.total,
-                    v.data
+                    v.data_dia AS data
                 FROM vendas v
-                WHERE v.parceiro = ?
-                ORDER BY v.data DESC
-            ''', conn, params=[cliente['parceiro']])
+                LEFT JOIN dim_produto p ON p.id = v.produto_id
+                WHERE v.{filtro}
+                ORDER BY v.data_dia DESC
+            ''', conn, params=chaves)
+            produtos['data'] = datas_dos_dias(produtos['data'])
 
             cliente_dict = cliente.to_dict()
             cliente_dict['produtos'] = produtos.to_dict('records')
@@ -495,10 +526,7 @@ class AnalisadorClientes:
     def gerar_script_abordagem(self, cliente_id):
         """Gera script personalizado de abordagem para o cliente"""
         # Verificar se usar v2
-        conn = self.db.connect()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='clientes_metricas_v2'")
-        use_v2 = cursor.fetchone()[0] > 0
+        use_v2 = self.db.tem_recurso('metricas_v2')
         
         if use_v2:
             cliente = self.db.get_cliente_data_v2(cliente_id)
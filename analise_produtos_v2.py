@@ -3,13 +3,26 @@ Sistema de análise detalhada de produtos - Versão corrigida
 """
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
 
-from db_manager_v2 import DatabaseManager
+from db_manager_v2 import CATEGORIA_PADRAO, CATEGORIAS, DatabaseManager, datas_dos_dias
+from motor_analitico import obter_motor
 
 class AnalisadorProdutos:
     def __init__(self, db_manager):
         self.db = db_manager
+        # Agregações sobre vendas inteira (SQLite ou DuckDB, ver motor_analitico)
+        self.motor = obter_motor(db_manager)
+    
+    def _filtro_produto(self, produto):
+        """Condição em vendas.produto_id (e parâmetros) para o produto dado pelo nome
+        
+        As chaves são buscadas antes na dimensão: com `IN (subconsulta)` o SQLite
+        não estima quantas vendas o filtro pega e prefere varrer um índice inteiro.
+        """
+        chaves = [linha[0] for linha in self.db.connect().execute(
+            'SELECT id FROM dim_produto WHERE produto = ?', [produto]
+        )]
+        return f"produto_id IN ({','.join(['?'] * len(chaves)) or 'NULL'})", chaves
     
     def get_todos_produtos_analise(self):
         """Retorna análise de todos os produtos com tratamento de erros"""
@@ -17,9 +30,7 @@ class AnalisadorProdutos:
             conn = self.db.connect()
             
             # Verificar qual tabela usar
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='produtos_metricas_v2'")
-            use_v2 = cursor.fetchone()[0] > 0
+            use_v2 = self.db.tem_recurso('metricas_v2')
             
             if use_v2:
                 # Usar tabela v2 com códigos
@@ -36,7 +47,8 @@ class AnalisadorProdutos:
                     margem_media,
                     primeira_venda,
                     ultima_venda,
-                    dias_desde_ultima
+                    dias_desde_ultima,
+                    categoria
                 FROM produtos_metricas_v2
                 ORDER BY valor_total DESC
                 """
@@ -44,18 +56,32 @@ class AnalisadorProdutos:
                 # Query original
                 query = """
                 SELECT 
-                    produto,
-                    SUM(quantidade) as quantidade_vendida,
-                    SUM(total) as valor_total,
-                    COUNT(*) as total_vendas,
-                    COUNT(DISTINCT parceiro) as clientes_unicos,
-                    AVG(total) as ticket_medio,
-                    MIN(data) as primeira_venda,
-                    MAX(data) as ultima_venda
-                FROM vendas
-                WHERE produto IS NOT NULL AND produto != ''
-                GROUP BY produto
-                ORDER BY valor_total DESC
+                    v.produto_id,
+                    p.produto,
+                    v.quantidade_vendida,
+                    v.valor_total,
+                    v.total_vendas,
+                    v.clientes_unicos,
+                    v.ticket_medio,
+                    v.primeira_venda,
+                    v.ultima_venda
+                FROM (
+                    SELECT
+                        produto_id,
+                        SUM(quantidade) as quantidade_vendida,
+                        SUM(total) as valor_total,
+                        COUNT(*) as total_vendas,
+                        COUNT(DISTINCT cliente_id) as clientes_unicos,
+                        AVG(total) as ticket_medio,
+                        MIN(data_dia) as primeira_venda,
+                        MAX(data_dia) as ultima_venda
+                    FROM vendas
+                    WHERE produto_id IS NOT NULL
+                    GROUP BY produto_id
+                ) v
+                JOIN dim_produto p ON p.id = v.produto_id
+                WHERE p.produto IS NOT NULL
+                ORDER BY v.valor_total DESC
                 """
             
             produtos_df = pd.read_sql(query, conn)
@@ -63,12 +89,17 @@ class AnalisadorProdutos:
             if produtos_df.empty:
                 return pd.DataFrame()
             
-            # Adicionar dias desde última venda
+            if not use_v2:
+                for coluna in ('primeira_venda', 'ultima_venda'):
+                    produtos_df[coluna] = datas_dos_dias(produtos_df[coluna])
+            
+            # Adicionar dias desde última venda (até a data de referência)
             produtos_df['ultima_venda'] = pd.to_datetime(produtos_df['ultima_venda'])
-            produtos_df['dias_desde_ultima'] = (datetime.now() - produtos_df['ultima_venda']).dt.days
+            produtos_df['dias_desde_ultima'] = (datas_dos_dias(self.db.dia_referencia()) - produtos_df['ultima_venda']).dt.days
             
-            # Categorizar produtos
-            produtos_df['categoria'] = produtos_df['produto'].apply(self.categorizar_produto)
+            # Categoria já gravada nas métricas v2; sem elas, pelo nome
+            if 'categoria' not in produtos_df.columns:
+                produtos_df['categoria'] = produtos_df['produto'].apply(self.categorizar_produto)
             
             # Classificação ABC
             produtos_df = produtos_df.sort_values('valor_total', ascending=False)
@@ -83,18 +114,18 @@ class AnalisadorProdutos:
             if not use_v2:
                 # Calcular taxa de recompra
                 taxa_recompra = []
-                for produto in produtos_df['produto']:
+                for produto_id in produtos_df['produto_id']:
                     query_recompra = """
-                    SELECT COUNT(DISTINCT parceiro) as total_clientes,
+                    SELECT COUNT(DISTINCT cliente_id) as total_clientes,
                            SUM(CASE WHEN compras > 1 THEN 1 ELSE 0 END) as clientes_recorrentes
                     FROM (
-                        SELECT parceiro, COUNT(*) as compras
+                        SELECT cliente_id, COUNT(*) as compras
                         FROM vendas
-                        WHERE produto = ?
-                        GROUP BY parceiro
+                        WHERE produto_id = ?
+                        GROUP BY cliente_id
                     ) t
                     """
-                    result = pd.read_sql(query_recompra, conn, params=[produto])
+                    result = pd.read_sql(query_recompra, conn, params=[int(produto_id)])
                     if result['total_clientes'][0] > 0:
                         taxa = (result['clientes_recorrentes'][0] / result['total_clientes'][0]) * 100
                     else:
@@ -106,20 +137,20 @@ class AnalisadorProdutos:
                 # Calcular margem média
                 margem_query = """
                 SELECT 
-                    produto,
+                    produto_id,
                     AVG(CASE 
                         WHEN preco_base > 0 AND preco_final > 0 
                         THEN ((preco_final - preco_base) / preco_base * 100)
                         ELSE 0 
                     END) as margem_media
                 FROM vendas
-                WHERE produto IS NOT NULL
-                GROUP BY produto
+                WHERE produto_id IS NOT NULL
+                GROUP BY produto_id
                 """
                 margem_df = pd.read_sql(margem_query, conn)
                 
                 # Merge com margem
-                produtos_df = produtos_df.merge(margem_df, on='produto', how='left')
+                produtos_df = produtos_df.merge(margem_df, on='produto_id', how='left')
                 produtos_df['margem_media'] = produtos_df['margem_media'].fillna(0)
             else:
                 # V2 já tem essas colunas
@@ -151,40 +182,27 @@ class AnalisadorProdutos:
             ])
     
     def categorizar_produto(self, nome_produto):
-        """Categoriza produto baseado no nome"""
+        """Categoria do produto pelas palavras do nome (CATEGORIAS, as mesmas
+        gravadas em produtos_metricas_v2.categoria)"""
         if pd.isna(nome_produto):
-            return 'Outros'
+            return CATEGORIA_PADRAO
         
         nome_upper = str(nome_produto).upper()
         
-        categorias = {
-            'Especiarias': ['CANELA', 'CRAVO', 'PIMENTA', 'GENGIBRE', 'CURCUMA', 'PAPRICA', 'ALHO', 'CEBOLA'],
-            'Frutas Secas': ['UVA PASSA', 'DAMASCO', 'GOJI', 'CRANBERRY', 'AMEIXA'],
-            'Oleaginosas': ['AMENDOA', 'CASTANHA', 'NOZES', 'AMENDOIM', 'PISTACHE'],
-            'Farinhas': ['FARINHA'],
-            'Chás': ['CHA', 'HIBISCO', 'CAMOMILA', 'ERVA DOCE'],
-            'Óleos': ['OLEO', 'AZEITE'],
-            'Suplementos': ['WHEY', 'PROTEIN', 'COLAGENO', 'VITAMINA'],
-            'Grãos/Sementes': ['CHIA', 'LINHACA', 'QUINOA', 'AVEIA', 'GIRASSOL'],
-            'Cacau': ['CACAU', 'CHOCOLATE']
-        }
-        
-        for categoria, palavras in categorias.items():
+        for categoria, palavras in CATEGORIAS.items():
             for palavra in palavras:
                 if palavra in nome_upper:
                     return categoria
         
-        return 'Outros'
+        return CATEGORIA_PADRAO
     
     def get_analise_completa_produto(self, produto_id):
         """Retorna análise completa de um produto específico (código ou nome)"""
         try:
             conn = self.db.connect()
-            cursor = conn.cursor()
             
             # Verificar qual tabela usar
-            cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='produtos_metricas_v2'")
-            use_v2 = cursor.fetchone()[0] > 0
+            use_v2 = self.db.tem_recurso('metricas_v2')
             
             if use_v2:
                 # Usar tabela v2
@@ -197,21 +215,26 @@ class AnalisadorProdutos:
                 cod_produto = produto_id
             else:
                 # Métricas básicas
-                metricas_query = """
-                SELECT
-                    produto,
-                    SUM(quantidade) as quantidade_vendida,
-                    SUM(total) as valor_total,
-                    COUNT(*) as qtd_vendas,
-                    COUNT(DISTINCT parceiro) as clientes_unicos,
-                    AVG(total) as ticket_medio,
-                    MIN(data) as primeira_venda,
-                    MAX(data) as ultima_venda
-                FROM vendas
-                WHERE produto = ?
-                GROUP BY produto
+                filtro, chaves = self._filtro_produto(produto_id)
+                metricas_query = f"""
+                SELECT * FROM (
+                    SELECT
+                        ? as produto,
+                        SUM(quantidade) as quantidade_vendida,
+                        SUM(total) as valor_total,
+                        COUNT(*) as qtd_vendas,
+                        COUNT(DISTINCT cliente_id) as clientes_unicos,
+                        AVG(total) as ticket_medio,
+                        MIN(data_dia) as primeira_venda,
+                        MAX(data_dia) as ultima_venda
+                    FROM vendas
+                    WHERE {filtro}
+                )
+                WHERE qtd_vendas > 0
                 """
-                metricas = pd.read_sql(metricas_query, conn, params=[produto_id])
+                metricas = pd.read_sql(metricas_query, conn, params=[produto_id] + chaves)
+                for coluna in ('primeira_venda', 'ultima_venda'):
+                    metricas[coluna] = datas_dos_dias(metricas[coluna])
                 produto_nome = produto_id
                 produto = produto_id
                 cod_produto = None
@@ -219,23 +242,24 @@ class AnalisadorProdutos:
             if metricas.empty:
                 return None
             
-            # Adicionar dias desde última venda
+            # Adicionar dias desde última venda (até a data de referência)
             metricas['ultima_venda'] = pd.to_datetime(metricas['ultima_venda'])
-            metricas['dias_desde_ultima'] = (datetime.now() - metricas['ultima_venda']).dt.days
+            metricas['dias_desde_ultima'] = (datas_dos_dias(self.db.dia_referencia()) - metricas['ultima_venda']).dt.days
             
             # Taxa de recompra
-            recompra_query = """
+            filtro, chaves = self._filtro_produto(produto)
+            recompra_query = f"""
             SELECT 
-                COUNT(DISTINCT parceiro) as total_clientes,
+                COUNT(DISTINCT cliente_id) as total_clientes,
                 SUM(CASE WHEN compras > 1 THEN 1 ELSE 0 END) as clientes_recorrentes
             FROM (
-                SELECT parceiro, COUNT(*) as compras
+                SELECT cliente_id, COUNT(*) as compras
                 FROM vendas
-                WHERE produto = ?
-                GROUP BY parceiro
+                WHERE {filtro}
+                GROUP BY cliente_id
             ) t
             """
-            recompra = pd.read_sql(recompra_query, conn, params=[produto])
+            recompra = pd.read_sql(recompra_query, conn, params=chaves)
             
             if recompra['total_clientes'][0] > 0:
                 taxa_recompra = (recompra['clientes_recorrentes'][0] / recompra['total_clientes'][0]) * 100
@@ -245,42 +269,54 @@ class AnalisadorProdutos:
             metricas['taxa_recompra'] = taxa_recompra
             
             # Clientes que compraram
-            clientes_query = """
+            clientes_query = f"""
             SELECT 
-                parceiro,
-                SUM(quantidade) as qtd_total,
-                SUM(total) as valor_total,
-                COUNT(*) as frequencia,
-                MIN(data) as primeira_compra,
-                MAX(data) as ultima_compra
-            FROM vendas
-            WHERE produto = ?
-            GROUP BY parceiro
-            ORDER BY valor_total DESC
+                c.parceiro,
+                v.qtd_total,
+                v.valor_total,
+                v.frequencia,
+                v.primeira_compra,
+                v.ultima_compra
+            FROM (
+                SELECT
+                    cliente_id,
+                    SUM(quantidade) as qtd_total,
+                    SUM(total) as valor_total,
+                    COUNT(*) as frequencia,
+                    MIN(data_dia) as primeira_compra,
+                    MAX(data_dia) as ultima_compra
+                FROM vendas
+                WHERE {filtro}
+                GROUP BY cliente_id
+            ) v
+            LEFT JOIN dim_cliente c ON c.id = v.cliente_id
+            ORDER BY v.valor_total DESC
             """
-            clientes = pd.read_sql(clientes_query, conn, params=[produto])
+            clientes = pd.read_sql(clientes_query, conn, params=chaves)
+            for coluna in ('primeira_compra', 'ultima_compra'):
+                clientes[coluna] = datas_dos_dias(clientes[coluna])
             
-            # Evolução temporal
-            evolucao_query = """
+            # Evolução temporal (do resumo por produto e mês; com mais de um código
+            # para o mesmo nome, o cliente conta uma vez em cada código)
+            evolucao_query = f"""
             SELECT 
-                strftime('%Y-%m', data) as mes,
-                SUM(quantidade) as qtd_vendida,
-                SUM(total) as valor_total,
-                COUNT(DISTINCT parceiro) as clientes_unicos,
-                AVG(preco_final) as preco_medio
-            FROM vendas
-            WHERE produto = ?
-            AND data IS NOT NULL
-            GROUP BY mes
-            ORDER BY mes
+                printf('%04d-%02d', ano_mes / 100, ano_mes % 100) as mes,
+                SUM(qtd_vendida) as qtd_vendida,
+                SUM(valor_total) as valor_total,
+                SUM(clientes_unicos) as clientes_unicos,
+                SUM(soma_preco_final) / SUM(qtd_preco_final) as preco_medio
+            FROM produto_mes
+            WHERE {filtro}
+            GROUP BY ano_mes
+            ORDER BY ano_mes
             """
-            evolucao = pd.read_sql(evolucao_query, conn, params=[produto])
+            evolucao = pd.read_sql(evolucao_query, conn, params=chaves)
             
             # Produtos complementares
             complementares = self.get_produtos_complementares(produto)
             
             # Análise de margem
-            margem_query = """
+            margem_query = f"""
             SELECT 
                 AVG(CASE 
                     WHEN preco_base > 0 THEN ((preco_final - preco_base) / preco_base * 100)
@@ -290,9 +326,9 @@ class AnalisadorProdutos:
                 MAX(preco_final) as preco_maximo,
                 AVG(preco_final) as preco_medio
             FROM vendas
-            WHERE produto = ?
+            WHERE {filtro}
             """
-            margem = pd.read_sql(margem_query, conn, params=[produto])
+            margem = pd.read_sql(margem_query, conn, params=chaves)
             
             # Sazonalidade
             sazonalidade = self.analisar_sazonalidade(produto)
@@ -315,44 +351,44 @@ class AnalisadorProdutos:
         try:
             conn = self.db.connect()
             
-            # Encontrar vendas que incluem o produto
-            vendas_query = """
-            SELECT DISTINCT n_venda
+            # Quantas vendas incluem o produto
+            filtro, chaves = self._filtro_produto(produto)
+            qtd_vendas = conn.execute(f"""
+            SELECT COUNT(DISTINCT n_venda)
             FROM vendas
-            WHERE produto = ?
-            """
-            vendas_df = pd.read_sql(vendas_query, conn, params=[produto])
-            
-            if vendas_df.empty:
-                return []
-            
-            vendas_list = vendas_df['n_venda'].tolist()
+            WHERE {filtro}
+            """, chaves).fetchone()[0]
             
-            if not vendas_list:
+            if not qtd_vendas:
                 return []
             
-            # Criar placeholder para query
-            placeholders = ','.join(['?' for _ in vendas_list])
-            
-            # Produtos comprados nas mesmas vendas
+            # Produtos comprados nas mesmas vendas (subconsulta em vez da lista de
+            # números: produtos muito vendidos passariam do limite de parâmetros)
             complementares_query = f"""
             SELECT 
-                produto,
-                COUNT(DISTINCT n_venda) as freq_conjunta,
-                SUM(total) as valor_conjunto
-            FROM vendas
-            WHERE n_venda IN ({placeholders})
-            AND produto != ?
-            GROUP BY produto
-            ORDER BY freq_conjunta DESC
+                p.produto,
+                c.freq_conjunta,
+                c.valor_conjunto
+            FROM (
+                SELECT
+                    produto_id,
+                    COUNT(DISTINCT n_venda) as freq_conjunta,
+                    SUM(total) as valor_conjunto
+                FROM vendas
+                WHERE n_venda IN (SELECT n_venda FROM vendas WHERE {filtro})
+                AND NOT ({filtro})
+                GROUP BY produto_id
+            ) c
+            JOIN dim_produto p ON p.id = c.produto_id
+            WHERE p.produto IS NOT NULL
+            ORDER BY c.freq_conjunta DESC, p.produto
             LIMIT 10
             """
             
-            params = vendas_list + [produto]
-            complementares = pd.read_sql(complementares_query, conn, params=params)
+            complementares = pd.read_sql(complementares_query, conn, params=chaves + chaves)
             
             if not complementares.empty:
-                complementares['confianca'] = (complementares['freq_conjunta'] / len(vendas_list) * 100).round(1)
+                complementares['confianca'] = (complementares['freq_conjunta'] / qtd_vendas * 100).round(1)
                 return complementares[['produto', 'freq_conjunta', 'confianca', 'valor_conjunto']].to_dict('records')
             
             return []
@@ -365,20 +401,20 @@ class AnalisadorProdutos:
         """Analisa padrões sazonais do produto"""
         try:
             conn = self.db.connect()
+            filtro, chaves = self._filtro_produto(produto)
             
-            query = """
+            query = f"""
             SELECT 
-                strftime('%m', data) as mes_num,
-                SUM(quantidade) as qtd,
-                SUM(total) as valor
-            FROM vendas
-            WHERE produto = ?
-            AND data IS NOT NULL
-            GROUP BY mes_num
-            ORDER BY mes_num
+                printf('%02d', ano_mes % 100) as mes_num,
+                SUM(qtd_vendida) as qtd,
+                SUM(valor_total) as valor
+            FROM produto_mes
+            WHERE {filtro}
+            GROUP BY ano_mes % 100
+            ORDER BY ano_mes % 100
             """
             
-            vendas_mensais = pd.read_sql(query, conn, params=[produto])
+            vendas_mensais = pd.read_sql(query, conn, params=chaves)
             
             if vendas_mensais.empty:
                 return []
@@ -443,23 +479,30 @@ class AnalisadorProdutos:
     def get_produtos_para_acao(self):
         """Identifica produtos que precisam de ação"""
         try:
-            conn = self.db.connect()
-            
             # Produtos sem venda recente
-            sem_venda_query = """
+            sem_venda_query = f"""
             SELECT 
-                produto,
-                SUM(total) as valor_total,
-                COUNT(DISTINCT parceiro) as clientes_unicos,
-                julianday('now') - julianday(MAX(data)) as dias_desde_ultima
-            FROM vendas
-            WHERE produto IS NOT NULL
-            GROUP BY produto
-            HAVING dias_desde_ultima > 30
-            ORDER BY valor_total DESC
+                p.produto,
+                v.valor_total,
+                v.clientes_unicos,
+                v.dias_desde_ultima
+            FROM (
+                SELECT
+                    produto_id,
+                    SUM(total) as valor_total,
+                    COUNT(DISTINCT cliente_id) as clientes_unicos,
+                    {self.db.dia_referencia()} - MAX(data_dia) as dias_desde_ultima
+                FROM vendas
+                WHERE produto_id IS NOT NULL
+                GROUP BY produto_id
+                HAVING dias_desde_ultima > 30
+            ) v
+            JOIN dim_produto p ON p.id = v.produto_id
+            WHERE p.produto IS NOT NULL
+            ORDER BY v.valor_total DESC
             LIMIT 20
             """
-            sem_venda_recente = pd.read_sql(sem_venda_query, conn)
+            sem_venda_recente = self.motor.consultar(sem_venda_query)
             
             # Produtos com baixa taxa de recompra (calcular inline)
             baixa_recompra = []
@@ -474,20 +517,28 @@ class AnalisadorProdutos:
             # Produtos com margem baixa
             margem_query = """
             SELECT 
-                produto,
-                SUM(total) as valor_total,
-                AVG(CASE 
-                    WHEN preco_base > 0 THEN ((preco_final - preco_base) / preco_base * 100)
-                    ELSE 0 
-                END) as margem_media
-            FROM vendas
-            WHERE produto IS NOT NULL
-            GROUP BY produto
-            HAVING margem_media < 10 AND margem_media > 0
-            ORDER BY valor_total DESC
+                p.produto,
+                v.valor_total,
+                v.margem_media
+            FROM (
+                SELECT
+                    produto_id,
+                    SUM(total) as valor_total,
+                    AVG(CASE 
+                        WHEN preco_base > 0 THEN ((preco_final - preco_base) / preco_base * 100)
+                        ELSE 0 
+                    END) as margem_media
+                FROM vendas
+                WHERE produto_id IS NOT NULL
+                GROUP BY produto_id
+                HAVING margem_media < 10 AND margem_media > 0
+            ) v
+            JOIN dim_produto p ON p.id = v.produto_id
+            WHERE p.produto IS NOT NULL
+            ORDER BY v.valor_total DESC
             LIMIT 20
             """
-            margem_baixa = pd.read_sql(margem_query, conn)
+            margem_baixa = self.motor.consultar(margem_query)
             
             return {
                 'sem_venda_recente': sem_venda_recente.to_dict('records') if not sem_venda_recente.empty else [],
@@ -506,17 +557,15 @@ class AnalisadorProdutos:
     def get_relatorio_executivo_produtos(self):
         """Gera relatório executivo sobre produtos"""
         try:
-            conn = self.db.connect()
-            
             # KPIs principais
             kpis_query = """
             SELECT 
-                COUNT(DISTINCT produto) as total_produtos,
+                COUNT(DISTINCT produto_id) as total_produtos,
                 SUM(total) as faturamento_total
             FROM vendas
-            WHERE produto IS NOT NULL
+            WHERE produto_id IN (SELECT id FROM dim_produto WHERE produto IS NOT NULL)
             """
-            kpis = pd.read_sql(kpis_query, conn)
+            kpis = self.motor.consultar(kpis_query)
             
             # Adicionar taxa de recompra e margem média
             produtos_df = self.get_todos_produtos_analise()
@@ -529,29 +578,42 @@ class AnalisadorProdutos:
             
             # Top produtos
             top_query = """
-            SELECT produto, SUM(total) as valor_total
-            FROM vendas
-            WHERE produto IS NOT NULL
-            GROUP BY produto
-            ORDER BY valor_total DESC
+            SELECT p.produto, v.valor_total
+            FROM (
+                SELECT produto_id, SUM(total) as valor_total
+                FROM vendas
+                WHERE produto_id IS NOT NULL
+                GROUP BY produto_id
+            ) v
+            JOIN dim_produto p ON p.id = v.produto_id
+            WHERE p.produto IS NOT NULL
+            ORDER BY v.valor_total DESC
             LIMIT 5
             """
-            top_produtos = pd.read_sql(top_query, conn)
+            top_produtos = self.motor.consultar(top_query)
             
             # Produtos problemáticos
-            problematicos_query = """
+            problematicos_query = f"""
             SELECT 
-                produto,
-                julianday('now') - julianday(MAX(data)) as dias_desde_ultima,
-                SUM(total) as valor_total
-            FROM vendas
-            WHERE produto IS NOT NULL
-            GROUP BY produto
-            HAVING dias_desde_ultima > 60 AND valor_total > 1000
-            ORDER BY valor_total DESC
+                p.produto,
+                v.dias_desde_ultima,
+                v.valor_total
+            FROM (
+                SELECT
+                    produto_id,
+                    {self.db.dia_referencia()} - MAX(data_dia) as dias_desde_ultima,
+                    SUM(total) as valor_total
+                FROM vendas
+                WHERE produto_id IS NOT NULL
+                GROUP BY produto_id
+                HAVING dias_desde_ultima > 60 AND valor_total > 1000
+            ) v
+            JOIN dim_produto p ON p.id = v.produto_id
+            WHERE p.produto IS NOT NULL
+            ORDER BY v.valor_total DESC
             LIMIT 5
             """
-            problematicos = pd.read_sql(problematicos_query, conn)
+            problematicos = self.motor.consultar(problematicos_query)
             
             # Mix de categorias
             mix_categorias = self.analisar_mix_produtos()
@@ -3,16 +3,22 @@ CRM de Vendas - Dashboard Streamlit
 """
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
-import plotly.graph_objects as go
-from datetime import datetime, timedelta
+from datetime import datetime
 import os
+import time
 from pathlib import Path
 
-from db_manager_v2 import DatabaseManager
+from db_manager_v2 import DatabaseManager, banco_padrao, datas_dos_dias
+from importacao import calcular_hash_arquivo, combinar_hashes
+from tarefas import obter_fila
 from analise_clientes import AnalisadorClientes
 from analise_produtos_v2 import AnalisadorProdutos
 
+# Opções mostradas nos seletores de cliente e produto (o resto fica na busca)
+LIMITE_BUSCA = 50
+
 # Configuração da página
 st.set_page_config(
     page_title="CRM Vendas Atacado",
@@ -36,37 +42,29 @@ def init_database():
             print(f"Erro no setup inicial: {e}")
 
     # Usar banco de produção
-    if os.path.exists('database_production.db'):
-        db_path = 'database_production.db'
-    else:
-        db_path = 'database.db'
+    db_path = banco_padrao()
 
     db = DatabaseManager(db_path)
 
+    # Trabalhador das importações em segundo plano (retoma tarefas pendentes)
+    fila = obter_fila(db_path)
+
     # Verificar se precisa importar dados iniciais
-    conn = db.connect()
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM vendas")
-    count = cursor.fetchone()[0]
+    situacao = db.situacao_metricas()
 
-    print(f"Inicializando banco: {db_path} com {count} registros")
+    print(f"Inicializando banco: {db_path} com {situacao['linhas']} registros "
+          f"(esquema versão {db.versao_esquema})")
 
-    # Sempre atualizar métricas se o banco existir e tiver dados
-    if count > 0:
-        # Verificar se as tabelas v2 existem e têm dados
-        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='clientes_metricas_v2'")
-        if cursor.fetchone()[0] == 0:
-            print("Criando tabelas de métricas v2...")
-            db.update_metrics()  # Cria as tabelas v2 e popula
-        else:
-            cursor.execute("SELECT COUNT(*) FROM clientes_metricas_v2")
-            if cursor.fetchone()[0] == 0:
-                db.update_metrics()  # Popula as tabelas v2
-    elif count == 0:
+    if situacao['linhas'] == 0:
         # Importar CSV inicial se existir
         csv_path = Path("ATACADO VENDAS PRODUTOS.csv")
         if csv_path.exists():
             db.import_csv(str(csv_path))
+    elif not situacao['atualizadas']:
+        # vendas mudou depois da última montagem (ex.: importação interrompida):
+        # as páginas seguem com as métricas atuais enquanto o recálculo roda
+        print(f"Métricas desatualizadas ({', '.join(situacao['desatualizadas'])}); recálculo enfileirado")
+        fila.enfileirar('metricas')
     
     return db
 
@@ -75,6 +73,23 @@ def init_database():
 def init_analyzers(_db):
     return AnalisadorClientes(_db), AnalisadorProdutos(_db)
 
+# Situação das métricas na barra lateral
+def mostrar_situacao_metricas(db):
+    situacao = db.situacao_metricas()
+    if situacao['atualizadas']:
+        if situacao['atualizado_em']:
+            st.sidebar.caption(f"✅ Métricas atualizadas em {situacao['atualizado_em']} (UTC)")
+        return
+
+    ativas = obter_fila(db.db_path).tarefas_ativas()
+    if any(tarefa['tipo'] == 'importacao' for tarefa in ativas):
+        st.sidebar.info("🔄 Importação em andamento: as métricas mostram os dados anteriores")
+    elif ativas:
+        st.sidebar.info("🔄 Recalculando métricas: os números mostram os dados anteriores")
+    else:
+        st.sidebar.warning("⚠️ Métricas desatualizadas em relação às vendas. "
+                           "Use \"Recalcular métricas\" em ⚙️ Atualizar Dados")
+
 # Função para aplicar estilos
 def apply_custom_css():
     st.markdown("""
@@ -112,6 +127,7 @@ def main():
     
     # Sidebar
     st.sidebar.title("🎯 CRM Vendas Atacado")
+    mostrar_situacao_metricas(db)
     
     # Menu de navegação
     menu = st.sidebar.selectbox(
@@ -155,6 +171,16 @@ def safe_int_format(value, default=0):
         return default
     return int(value)
 
+def seletor_busca(rotulo, encontrados, coluna_codigo, coluna_nome):
+    """Selectbox 'código - nome' com as linhas encontradas; retorna o código escolhido"""
+    if encontrados.empty:
+        st.info("Nenhum resultado para a busca.")
+        return None
+    codigos = encontrados[coluna_codigo].astype(str)
+    opcoes = dict(zip(codigos + ' - ' + encontrados[coluna_nome].astype(str), codigos))
+    escolhido = st.selectbox(rotulo, options=list(opcoes))
+    return opcoes.get(escolhido)
+
 def show_dashboard(db):
     """Mostra dashboard principal com KPIs"""
     st.title("📊 Dashboard Principal")
@@ -165,20 +191,24 @@ def show_dashboard(db):
     # Buscar métricas
     conn = db.connect()
 
-    # Total de vendas
-    total_vendas_result = pd.read_sql("SELECT SUM(total) as total FROM vendas", conn)
+    # Total de vendas: resumo mensal mais as linhas sem data, que ficam fora
+    # dele (pedidos não serve: deixa de fora as linhas sem n_venda)
+    total_vendas_result = pd.read_sql("""
+        SELECT (SELECT SUM(valor_total) FROM vendas_mes)
+             + (SELECT IFNULL(SUM(total), 0) FROM vendas WHERE ano_mes IS NULL) as total
+    """, conn)
     total_vendas = safe_float_format(total_vendas_result['total'][0] if not total_vendas_result.empty else None)
 
-    # Total de clientes
-    total_clientes_result = pd.read_sql("SELECT COUNT(DISTINCT parceiro) as total FROM vendas", conn)
+    # Total de clientes (todas as linhas, com ou sem n_venda)
+    total_clientes_result = pd.read_sql("SELECT COUNT(DISTINCT cliente_id) as total FROM vendas", conn)
     total_clientes = safe_int_format(total_clientes_result['total'][0] if not total_clientes_result.empty else None)
 
     # Total de produtos
-    total_produtos_result = pd.read_sql("SELECT COUNT(DISTINCT produto) as total FROM vendas", conn)
+    total_produtos_result = pd.read_sql("SELECT COUNT(DISTINCT produto_id) as total FROM vendas", conn)
     total_produtos = safe_int_format(total_produtos_result['total'][0] if not total_produtos_result.empty else None)
 
-    # Ticket médio
-    ticket_medio_result = pd.read_sql("SELECT AVG(total) as media FROM vendas", conn)
+    # Ticket médio (valor médio do pedido)
+    ticket_medio_result = pd.read_sql("SELECT AVG(total) as media FROM pedidos", conn)
     ticket_medio = safe_float_format(ticket_medio_result['media'][0] if not ticket_medio_result.empty else None)
     
     with col1:
@@ -202,11 +232,10 @@ def show_dashboard(db):
         # Evolução mensal
         vendas_mensais = pd.read_sql("""
             SELECT 
-                strftime('%Y-%m', data) as mes,
-                SUM(total) as valor
-            FROM vendas
-            GROUP BY mes
-            ORDER BY mes
+                printf('%04d-%02d', ano_mes / 100, ano_mes % 100) as mes,
+                valor_total as valor
+            FROM vendas_mes
+            ORDER BY ano_mes
         """, conn)
         
         fig = px.line(vendas_mensais, x='mes', y='valor', 
@@ -218,11 +247,16 @@ def show_dashboard(db):
     with col2:
         # Top clientes
         top_clientes = pd.read_sql("""
-            SELECT parceiro, SUM(total) as valor
-            FROM vendas
-            GROUP BY parceiro
-            ORDER BY valor DESC
-            LIMIT 10
+            SELECT c.parceiro, v.valor
+            FROM (
+                SELECT cliente_id, SUM(total) as valor
+                FROM pedidos
+                GROUP BY cliente_id
+                ORDER BY valor DESC
+                LIMIT 10
+            ) v
+            LEFT JOIN dim_cliente c ON c.id = v.cliente_id
+            ORDER BY v.valor DESC
         """, conn)
         
         fig = px.bar(top_clientes, x='valor', y='parceiro',
@@ -233,14 +267,11 @@ def show_dashboard(db):
     # Segmentação de clientes
     st.subheader("📊 Segmentação de Clientes")
     
-    segmentos = pd.read_sql("""
-        SELECT 
-            segmento,
-            COUNT(*) as quantidade,
-            SUM(total_compras) as valor_total
-        FROM clientes_metricas
-        GROUP BY segmento
-    """, conn)
+    # Segmentos pela data de referência (calculados na leitura das métricas)
+    segmentos = db.get_cliente_data_v2().groupby('segmento', as_index=False).agg(
+        quantidade=('cod_parceiro', 'count'),
+        valor_total=('total_compras', 'sum')
+    )
     
     col1, col2 = st.columns(2)
     
@@ -346,25 +377,20 @@ def show_analise_clientes(db, analisador):
     with tab2:
         st.subheader("🔍 Análise Individual do Cliente")
         
-        # Seletor de cliente com código
-        if 'cod_parceiro' in clientes_df.columns:
-            # Criar opções com código e nome
-            clientes_df['display_option'] = clientes_df['cod_parceiro'].astype(str) + ' - ' + clientes_df['parceiro'].astype(str)
-            cliente_opcoes = clientes_df['display_option'].tolist()
-            cliente_selecionado_display = st.selectbox(
-                "Selecione o Cliente (Código - Nome)",
-                options=cliente_opcoes
-            )
-            # Extrair o código do cliente selecionado
-            if cliente_selecionado_display:
-                cod_cliente = cliente_selecionado_display.split(' - ')[0]
-                # Usar código para buscar análise
-                cliente_selecionado = cod_cliente
+        # Seletor de cliente com código: só as melhores correspondências da
+        # busca vão para a página (sem busca, os maiores clientes)
+        busca_cliente = st.text_input(
+            "Buscar cliente (código ou nome)",
+            placeholder="Digite parte do código ou do nome e tecle Enter"
+        )
+        if busca_cliente.strip():
+            encontrados = db.buscar_clientes(busca_cliente, limite=LIMITE_BUSCA)
         else:
-            cliente_selecionado = st.selectbox(
-                "Selecione o Cliente",
-                options=clientes_df['parceiro'].tolist()
-            )
+            encontrados = clientes_df.head(LIMITE_BUSCA)
+        cliente_selecionado = seletor_busca(
+            "Selecione o Cliente (Código - Nome)",
+            encontrados, 'cod_parceiro', 'parceiro'
+        )
         
         if cliente_selecionado:
             # Análise completa
@@ -388,7 +414,20 @@ def show_analise_clientes(db, analisador):
                 # Frequência de compra
                 freq = analise['frequencia']
                 if freq['frequencia_media_dias']:
-                    st.info(f"📅 Frequência: compra a cada {freq['frequencia_media_dias']:.0f} dias | Status: {freq['status_frequencia']}")
+                    texto = f"📅 Frequência: compra a cada {freq['frequencia_media_dias']:.0f} dias | Status: {freq['status_frequencia']}"
+                    if freq.get('tendencia'):
+                        texto += f" | Tendência: {freq['tendencia']}"
+                    if info.get('categoria_principal'):
+                        texto += f" | Categoria principal: {info['categoria_principal']}"
+                    st.info(texto)
+                
+                # Evolução mensal
+                evolucao_df = pd.DataFrame(analise['evolucao'])
+                if not evolucao_df.empty:
+                    fig = px.bar(evolucao_df, x='mes', y='valor_total',
+                                title='Compras Mensais',
+                                labels={'valor_total': 'Valor (R$)', 'mes': 'Mês'})
+                    st.plotly_chart(fig, use_container_width=True)
                 
                 # Produtos comprados
                 st.subheader("📦 Produtos Comprados")
@@ -593,24 +632,19 @@ def show_analise_produtos(db, analisador):
     with tab2:
         st.subheader("🔍 Análise Individual do Produto")
         
-        # Seletor com código
-        if 'cod_produto' in produtos_df.columns:
-            # Criar opções com código e nome
-            produtos_df['display_option'] = produtos_df['cod_produto'].astype(str) + ' - ' + produtos_df['produto'].astype(str)
-            produto_opcoes = produtos_df['display_option'].tolist()
-            produto_selecionado_display = st.selectbox(
-                "Selecione o Produto (Código - Nome)",
-                options=produto_opcoes
-            )
-            # Extrair o código do produto selecionado
-            if produto_selecionado_display:
-                cod_produto = produto_selecionado_display.split(' - ')[0]
-                produto_selecionado = cod_produto
+        # Seletor com código, a partir da busca (sem busca, os mais vendidos)
+        busca_produto = st.text_input(
+            "Buscar produto (código ou nome)",
+            placeholder="Digite parte do código ou do nome e tecle Enter"
+        )
+        if busca_produto.strip():
+            encontrados = db.buscar_produtos(busca_produto, limite=LIMITE_BUSCA)
         else:
-            produto_selecionado = st.selectbox(
-                "Selecione o Produto",
-                options=produtos_df['produto'].tolist()
-            )
+            encontrados = produtos_df.head(LIMITE_BUSCA)
+        produto_selecionado = seletor_busca(
+            "Selecione o Produto (Código - Nome)",
+            encontrados, 'cod_produto', 'produto'
+        )
         
         if produto_selecionado:
             analise = analisador.get_analise_completa_produto(produto_selecionado)
@@ -969,23 +1003,19 @@ def show_relatorios(db, analisador_clientes, analisador_produtos):
     with tab1:
         st.subheader("📊 Relatório Executivo - Clientes")
         
-        # KPIs
-        conn = db.connect()
-        
-        kpis_result = pd.read_sql("""
-            SELECT
-                COUNT(*) as total_clientes,
-                SUM(total_compras) as faturamento_total,
-                AVG(ticket_medio) as ticket_medio_geral,
-                AVG(dias_desde_ultima) as media_dias_inativos
-            FROM clientes_metricas
-        """, conn)
+        # KPIs (recência e segmentos pela data de referência)
+        clientes_df = db.get_cliente_data_v2()
 
-        if kpis_result.empty:
+        if clientes_df.empty:
             st.error("Não há dados suficientes para gerar o relatório.")
             return
 
-        kpis = kpis_result.iloc[0]
+        kpis = {
+            'total_clientes': len(clientes_df),
+            'faturamento_total': clientes_df['total_compras'].sum(),
+            'ticket_medio_geral': clientes_df['ticket_medio'].mean(),
+            'media_dias_inativos': clientes_df['dias_desde_ultima'].astype(float).mean(),
+        }
 
         col1, col2, col3, col4 = st.columns(4)
 
@@ -1003,15 +1033,11 @@ def show_relatorios(db, analisador_clientes, analisador_produtos):
             st.metric("Média Dias Inativos", f"{media_dias:.0f}")
         
         # Distribuição de segmentos
-        segmentos_df = pd.read_sql("""
-            SELECT 
-                segmento,
-                COUNT(*) as quantidade,
-                SUM(total_compras) as valor,
-                AVG(ticket_medio) as ticket_medio
-            FROM clientes_metricas
-            GROUP BY segmento
-        """, conn)
+        segmentos_df = clientes_df.groupby('segmento', as_index=False).agg(
+            quantidade=('cod_parceiro', 'count'),
+            valor=('total_compras', 'sum'),
+            ticket_medio=('ticket_medio', 'mean')
+        )
         
         fig = px.sunburst(
             segmentos_df,
@@ -1024,19 +1050,16 @@ def show_relatorios(db, analisador_clientes, analisador_produtos):
         # Análise de retenção
         st.subheader("📈 Análise de Retenção")
         
-        retencao = pd.read_sql("""
-            SELECT 
-                CASE 
-                    WHEN dias_desde_ultima <= 30 THEN 'Ativo (0-30 dias)'
-                    WHEN dias_desde_ultima <= 60 THEN 'Em Alerta (31-60 dias)'
-                    WHEN dias_desde_ultima <= 90 THEN 'Em Risco (61-90 dias)'
-                    ELSE 'Inativo (>90 dias)'
-                END as status,
-                COUNT(*) as quantidade,
-                SUM(total_compras) as valor_total
-            FROM clientes_metricas
-            GROUP BY status
-        """, conn)
+        dias = clientes_df['dias_desde_ultima'].astype(float)
+        status = np.select(
+            [dias <= 30, dias <= 60, dias <= 90],
+            ['Ativo (0-30 dias)', 'Em Alerta (31-60 dias)', 'Em Risco (61-90 dias)'],
+            default='Inativo (>90 dias)'
+        )
+        retencao = clientes_df.groupby(status).agg(
+            quantidade=('cod_parceiro', 'count'),
+            valor_total=('total_compras', 'sum')
+        ).rename_axis('status').reset_index()
         
         fig = px.bar(retencao, x='status', y='quantidade',
                     title='Status de Atividade dos Clientes',
@@ -1088,55 +1111,144 @@ def show_atualizar_dados(db):
     """Página para atualizar dados do banco"""
     st.title("⚙️ Atualizar Dados")
     
-    st.info("📤 Faça upload de um novo arquivo CSV para atualizar os dados")
+    fila = obter_fila(db.db_path)
+    
+    # Tarefas em andamento: a página consulta o status a cada segundo
+    ativas = fila.tarefas_ativas()
+    if ativas:
+        for tarefa in ativas:
+            if tarefa['status'] == 'executando':
+                texto = "🔄 Importando" if tarefa['tipo'] == 'importacao' else "🔄 Recalculando métricas"
+                if tarefa['progresso_linhas']:
+                    texto += (f": {tarefa['progresso_linhas']:,} linhas "
+                              f"({tarefa['linhas_por_segundo']:,.0f} linhas/s)")
+                st.info(texto)
+            else:
+                st.info(f"⏳ Tarefa {tarefa['id']} ({tarefa['tipo']}) aguardando na fila")
+        time.sleep(1)
+        st.rerun()
+    
+    # Tarefa concluída desde a última visita: recarregar os dados em cache
+    recentes = fila.listar(limite=1)
+    ultima_tarefa = recentes[0] if recentes else None
+    if ultima_tarefa and st.session_state.get('tarefa_vista') != ultima_tarefa['id']:
+        st.session_state['tarefa_vista'] = ultima_tarefa['id']
+        if ultima_tarefa['status'] == 'concluida':
+            if ultima_tarefa['tipo'] == 'importacao':
+                st.session_state['ultima_importacao'] = ultima_tarefa['resultado']
+            st.cache_resource.clear()
+            st.cache_data.clear()
+            st.rerun()
+    
+    if ultima_tarefa and ultima_tarefa['status'] in ('erro', 'interrompida'):
+        st.error(f"❌ Tarefa {ultima_tarefa['id']} ({ultima_tarefa['tipo']}) não concluída: "
+                 f"{ultima_tarefa['erro']}")
+    
+    # Resumo da última importação (sobrevive ao st.rerun)
+    ultima = st.session_state.get('ultima_importacao')
+    if ultima and ultima.get('ignorado'):
+        anterior = ultima['importacao_anterior']
+        st.info(f"ℹ️ Arquivo idêntico ao importado em {anterior['importado_em']} "
+                f"({anterior['arquivo']}); nenhum dado foi alterado")
+    elif ultima:
+        st.success(f"✅ Última importação ({ultima.get('modo', 'completo')}): {ultima['linhas']:,} linhas em "
+                   f"{ultima['segundos']:.1f}s - {ultima.get('inseridas', 0):,} inseridas, "
+                   f"{ultima.get('atualizadas', 0):,} atualizadas")
+        invalidos = {col: c['invalidos'] for col, c in ultima.get('colunas', {}).items() if c['invalidos']}
+        if invalidos:
+            st.warning("⚠️ Células inválidas convertidas para vazio/zero: " +
+                       ", ".join(f"{col} ({qtd:,})" for col, qtd in invalidos.items()))
+        if ultima.get('colunas_ausentes'):
+            st.warning(f"⚠️ Colunas não encontradas no arquivo: {', '.join(ultima['colunas_ausentes'])}")
     
-    # Upload de arquivo
-    uploaded_file = st.file_uploader(
-        "Escolha o arquivo CSV",
-        type=['csv'],
-        help="O arquivo deve estar no mesmo formato do original"
+    st.info("📤 Faça upload de um ou mais arquivos CSV/XLSX para atualizar os dados")
+    
+    # Upload de arquivos (ex.: um arquivo por mês exportado do ERP)
+    uploaded_files = st.file_uploader(
+        "Escolha os arquivos CSV ou XLSX",
+        type=['csv', 'xlsx'],
+        accept_multiple_files=True,
+        help="Os arquivos devem estar no mesmo formato do original"
     )
     
-    if uploaded_file is not None:
-        # Salvar arquivo temporário
-        temp_path = Path("data/uploads") / uploaded_file.name
-        temp_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        with open(temp_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+    if uploaded_files:
+        # Salvar arquivos temporários com nome único (a tarefa apaga os arquivos
+        # ao terminar); reruns da página reaproveitam os arquivos já salvos
+        salvos = st.session_state.setdefault('uploads_salvos', {})
+        temp_paths = []
+        hashes = []
+        for i, uploaded_file in enumerate(uploaded_files):
+            chave_upload = (uploaded_file.name, uploaded_file.size)
+            salvo = salvos.get(chave_upload)
+            if salvo is None or not salvo['caminho'].exists():
+                # Subpasta própria: o nível de cima de data/uploads é do monitor_uploads
+                temp_path = Path("data/uploads/pagina") / f"{datetime.now():%Y%m%d_%H%M%S}_{i}_{uploaded_file.name}"
+                temp_path.parent.mkdir(parents=True, exist_ok=True)
+                
+                with open(temp_path, "wb") as f:
+                    f.write(uploaded_file.getbuffer())
+                
+                salvo = {'caminho': temp_path, 'hash': calcular_hash_arquivo(temp_path)}
+                salvos[chave_upload] = salvo
+            
+            temp_paths.append(salvo['caminho'])
+            hashes.append(salvo['hash'])
         
-        # Preview dos dados
+        # Preview dos dados (primeiro arquivo)
         st.subheader("📋 Preview dos Dados")
-        df_preview = pd.read_csv(temp_path, encoding='latin-1', sep=';', nrows=10)
+        if len(uploaded_files) > 1:
+            st.caption(f"{len(uploaded_files)} arquivos selecionados; mostrando {uploaded_files[0].name}")
+        if temp_paths[0].suffix.lower() == '.xlsx':
+            df_preview = pd.read_excel(temp_paths[0], nrows=10)
+        else:
+            df_preview = pd.read_csv(temp_paths[0], encoding='latin-1', sep=';', nrows=10)
         st.dataframe(df_preview, use_container_width=True)
         
+        modo_importacao = st.radio(
+            "Modo de importação",
+            ["incremental", "completo"],
+            format_func=lambda x: {
+                "incremental": "Incremental - adiciona pedidos novos e atualiza os alterados",
+                "completo": "Completa - substitui todos os dados pelos arquivos"
+            }[x]
+        )
+        
+        # Arquivos já aplicados: a importação deles seria ignorada
+        if modo_importacao == 'incremental':
+            repetidos = [arquivo.name for arquivo, hash_arquivo in zip(uploaded_files, hashes)
+                         if db.importacao_existente(hash_arquivo, modo_importacao)]
+        elif db.importacao_existente(combinar_hashes(hashes), modo_importacao):
+            repetidos = [arquivo.name for arquivo in uploaded_files]
+        else:
+            repetidos = []
+        
+        forcar = False
+        if repetidos:
+            st.warning(f"⚠️ Idêntico(s) ao que já foi importado: {', '.join(repetidos)}. "
+                       "Esses arquivos não alterariam nada e serão ignorados.")
+            forcar = st.checkbox("Importar mesmo assim")
+        
         # Botão para confirmar importação
         col1, col2 = st.columns(2)
         
         with col1:
             if st.button("✅ Confirmar e Importar", type="primary"):
-                with st.spinner("Importando dados..."):
-                    try:
-                        # Importar para o banco
-                        db.import_csv(str(temp_path))
-                        st.success("✅ Dados importados com sucesso!")
-                        
-                        # Limpar cache
-                        st.cache_resource.clear()
-                        st.cache_data.clear()
-                        
-                        # Recarregar página
-                        st.rerun()
-                        
-                    except Exception as e:
-                        st.error(f"❌ Erro ao importar: {str(e)}")
+                # A importação roda no trabalhador em segundo plano
+                fila.enfileirar('importacao', caminhos=[str(p) for p in temp_paths],
+                                modo=modo_importacao, remover_arquivo=True, forcar=forcar)
+                st.rerun()
         
         with col2:
             if st.button("❌ Cancelar"):
-                # Remover arquivo temporário
-                temp_path.unlink()
+                # Remover arquivos temporários
+                for temp_path in temp_paths:
+                    temp_path.unlink(missing_ok=True)
                 st.info("Importação cancelada")
-    
+
+    if st.button("🔄 Recalcular métricas"):
+        fila.enfileirar('metricas')
+        st.rerun()
+
     # Informações do banco atual
     st.divider()
     st.subheader("📊 Informações do Banco Atual")
@@ -1146,11 +1258,13 @@ def show_atualizar_dados(db):
     info_result = pd.read_sql("""
         SELECT
             (SELECT COUNT(*) FROM vendas) as total_vendas,
-            (SELECT COUNT(DISTINCT parceiro) FROM vendas) as total_clientes,
-            (SELECT COUNT(DISTINCT produto) FROM vendas) as total_produtos,
-            (SELECT MIN(data) FROM vendas) as primeira_venda,
-            (SELECT MAX(data) FROM vendas) as ultima_venda
+            (SELECT COUNT(DISTINCT cliente_id) FROM vendas) as total_clientes,
+            (SELECT COUNT(DISTINCT produto_id) FROM vendas) as total_produtos,
+            (SELECT MIN(data_dia) FROM vendas) as primeira_venda,
+            (SELECT MAX(data_dia) FROM vendas) as ultima_venda
     """, conn)
+    for coluna in ('primeira_venda', 'ultima_venda'):
+        info_result[coluna] = datas_dos_dias(info_result[coluna])
 
     if info_result.empty:
         st.error("Não há dados no banco de dados.")
@@ -1171,8 +1285,8 @@ def show_atualizar_dados(db):
         st.metric("Total de Produtos", f"{total_produtos:,}")
 
     # Verificar se há datas válidas
-    primeira_venda = info['primeira_venda'] if info['primeira_venda'] is not None else "N/A"
-    ultima_venda = info['ultima_venda'] if info['ultima_venda'] is not None else "N/A"
+    primeira_venda = info['primeira_venda'].date() if pd.notna(info['primeira_venda']) else "N/A"
+    ultima_venda = info['ultima_venda'].date() if pd.notna(info['ultima_venda']) else "N/A"
     st.info(f"📅 Período: {primeira_venda} até {ultima_venda}")
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+"""
+Tempo da importação completa com e sem a carga em lote (carga_em_lote)
+
+Gera um arquivo sintético no formato do ERP (dados_sinteticos) com
+`--linhas` linhas e importa o mesmo arquivo no modo completo em dois bancos
+novos: um com carga_em_lote=False (vendas_nova com os índices desde o início,
+pragmas normais) e outro com carga_em_lote=True (índices montados uma vez no
+final, PRAGMAS_CARGA e ANALYZE). Mostra o total e cada etapa da importação;
+a reconstrução das métricas é a mesma nos dois e aparece separada.
+
+    python benchmark_importacao.py [--linhas 2000000] [--clientes 100000] [--produtos 50000] [--csv arquivo.csv]
+
+Com --csv, o arquivo é reaproveitado se já existir (ou criado ali, se não);
+sem ele, o arquivo e os bancos ficam numa pasta temporária apagada no final.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmark_metricas import medir_etapas
+from dados_sinteticos import escrever_csv_erp, linhas_sinteticas
+from db_manager_v2 import DatabaseManager
+
+# Etapas de import_arquivos medidas separadamente
+ETAPAS = ['_carregar_arquivo_temporario', '_preparar_vendas_nova', '_reconstruir_metricas']
+
+
+def medir_importacao(caminho_db, caminho_csv, carga_em_lote):
+    """Importa o CSV num banco novo; devolve (total, {etapa: segundos}, linhas)"""
+    db = DatabaseManager(caminho_db)
+    try:
+        resumo = {}
+        total, tempos = medir_etapas(db, ETAPAS, lambda: resumo.update(
+            db.import_csv(caminho_csv, modo='completo', carga_em_lote=carga_em_lote)
+        ))
+        return total, tempos, resumo['linhas']
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mede a importação completa com e sem carga em lote')
+    parser.add_argument('--linhas', type=int, default=2000000)
+    parser.add_argument('--clientes', type=int, default=100000)
+    parser.add_argument('--produtos', type=int, default=50000)
+    parser.add_argument('--csv', default=None, help='Arquivo sintético (reaproveitado se existir)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho_csv = args.csv or os.path.join(pasta, 'vendas.csv')
+        if not os.path.exists(caminho_csv):
+            inicio = time.perf_counter()
+            escrever_csv_erp(caminho_csv, linhas_sinteticas(args.linhas, args.clientes, args.produtos))
+            print(f"Arquivo sintético: {args.linhas:,} linhas, {args.clientes:,} clientes, "
+                  f"{args.produtos:,} produtos ({time.perf_counter() - inicio:.1f}s)")
+
+        resultados = {}
+        for carga_em_lote in (False, True):
+            resultados[carga_em_lote] = medir_importacao(
+                os.path.join(pasta, f'importacao_{int(carga_em_lote)}.db'), caminho_csv, carga_em_lote
+            )
+
+        for carga_em_lote, (total, tempos, linhas) in resultados.items():
+            print(f"carga_em_lote={carga_em_lote}: {linhas:,} linhas")
+            for etapa in ETAPAS:
+                print(f"  {etapa:<30} {tempos.get(etapa, 0):7.2f}s")
+            print(f"  {'total':<30} {total:7.2f}s")
+
+        sem_metricas = {carga_em_lote: total - tempos.get('_reconstruir_metricas', 0)
+                        for carga_em_lote, (total, tempos, _) in resultados.items()}
+        print(f"Importação sem as métricas: {sem_metricas[False]:.2f}s -> {sem_metricas[True]:.2f}s "
+              f"({sem_metricas[False] / sem_metricas[True]:.2f}x)")
@@ -0,0 +1,118 @@
+"""
+Tempo da reconstrução das métricas (update_metrics) num banco sintético
+
+Monta um banco novo com `--clientes` clientes, `--produtos` produtos e
+`--linhas` linhas de venda (pedidos de LINHAS_POR_PEDIDO linhas, nos últimos
+DIAS_HISTORICO dias) e mede o update_metrics completo e cada etapa dele.
+Serve para conferir que o custo cresce com o volume de vendas e não com
+laços em Python por cliente ou produto.
+
+    python benchmark_metricas.py [--clientes 100000] [--produtos 50000] [--linhas 2000000] [--db arquivo.db]
+
+Sem --db, o banco é criado numa pasta temporária e apagado no final.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from db_manager_v2 import DIA_HOJE_SQL, DatabaseManager
+
+LINHAS_POR_PEDIDO = 4
+DIAS_HISTORICO = 730
+
+# Etapas de _reconstruir_metricas medidas separadamente (com TAREFAS_METRICAS
+# > 1 as tabelas de uma etapa são montadas ao mesmo tempo e cada tempo soma o
+# de todas as threads, então a soma das etapas passa do total)
+ETAPAS = ['_montar_pedidos', '_montar_resumos_mensais', '_update_cliente_produtos_v2',
+          '_update_cliente_metrics_v2', '_update_produto_metrics_v2', '_trocar_tabelas']
+
+
+def gerar_banco(db, clientes, produtos, linhas):
+    """Preenche as dimensões e vendas com dados aleatórios"""
+    with db.pool.lock_escrita:
+        conn = db.pool.escritor
+        conn.execute('''
+            WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+            INSERT INTO dim_cliente (id, cod_parceiro, parceiro) SELECT i, 'C' || i, 'CLIENTE ' || i FROM n
+        ''', (clientes,))
+        conn.execute('''
+            WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+            INSERT INTO dim_produto (id, cod_produto, produto) SELECT i, 'P' || i, 'PRODUTO ' || i FROM n
+        ''', (produtos,))
+        conn.execute(f'''
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ? - 1)
+            INSERT INTO vendas (
+                n_venda, data_dia, ano_mes, cod_produto, produto_id, cod_parceiro, cliente_id,
+                quantidade, valor_bruto, desconto, total, preco_final, preco_base, seq_linha
+            )
+            SELECT
+                pedido, dia, CAST(strftime('%Y%m', dia * 86400, 'unixepoch') AS INTEGER),
+                'P' || produto, produto, 'C' || cliente, cliente,
+                quantidade, quantidade * 10, 0, quantidade * 10, 10 + abs(random()) % 5, 10, 0
+            FROM (
+                SELECT
+                    i / {LINHAS_POR_PEDIDO} AS pedido,
+                    {DIA_HOJE_SQL} - (i / {LINHAS_POR_PEDIDO}) * 7919 % {DIAS_HISTORICO} AS dia,
+                    1 + (i / {LINHAS_POR_PEDIDO}) * 104729 % ? AS cliente,
+                    1 + abs(random()) % ? AS produto,
+                    1 + abs(random()) % 10 AS quantidade
+                FROM n
+            )
+        ''', (linhas, clientes, produtos))
+        conn.commit()
+
+
+def medir_etapas(db, etapas, funcao):
+    """Roda `funcao()` medindo os métodos `etapas` de db; devolve (total, {etapa: segundos})"""
+    tempos = {}
+    originais = {}
+    for etapa in etapas:
+        originais[etapa] = getattr(db, etapa)
+
+        def medida(*args, _etapa=etapa, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return originais[_etapa](*args, **kwargs)
+            finally:
+                tempos[_etapa] = tempos.get(_etapa, 0) + time.perf_counter() - inicio
+        setattr(db, etapa, medida)
+
+    inicio = time.perf_counter()
+    try:
+        funcao()
+    finally:
+        for etapa in etapas:
+            delattr(db, etapa)
+    return time.perf_counter() - inicio, tempos
+
+
+def medir_update_metrics(db):
+    """Roda o update_metrics medindo as ETAPAS; devolve (total, {etapa: segundos})"""
+    return medir_etapas(db, ETAPAS, db.update_metrics)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mede o update_metrics num banco sintético')
+    parser.add_argument('--clientes', type=int, default=100000)
+    parser.add_argument('--produtos', type=int, default=50000)
+    parser.add_argument('--linhas', type=int, default=2000000)
+    parser.add_argument('--db', default=None, help='Banco a criar (padrão: arquivo temporário)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho = args.db or os.path.join(pasta, 'benchmark.db')
+        if os.path.exists(caminho):
+            parser.error(f'{caminho} já existe')
+        db = DatabaseManager(caminho)
+
+        inicio = time.perf_counter()
+        gerar_banco(db, args.clientes, args.produtos, args.linhas)
+        print(f"Banco sintético: {args.linhas:,} linhas, {args.clientes:,} clientes, "
+              f"{args.produtos:,} produtos ({time.perf_counter() - inicio:.1f}s)")
+
+        total, tempos = medir_update_metrics(db)
+        for etapa in ETAPAS:
+            print(f"  {etapa:<30} {tempos.get(etapa, 0):7.2f}s")
+        print(f"update_metrics: {total:.2f}s")
+        db.close()
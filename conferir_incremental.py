@@ -0,0 +1,147 @@
+"""
+Conferência da importação incremental contra a reconstrução completa das métricas
+
+A importação incremental atualiza só as métricas dos clientes e produtos
+afetados (update_metrics_parcial). Este script gera arquivos sintéticos
+(dados_sinteticos), importa o base no modo completo e depois a atualização e
+a renomeação no incremental, guarda todas as TABELAS_METRICAS e as compara,
+linha a linha, com o resultado de um update_metrics completo sobre as mesmas
+vendas.
+
+A atualização traz linhas iguais às do base, linhas alteradas e pedidos
+novos (com clientes e produtos novos). A renomeação é um arquivo à parte com
+uma linha do base em que o produto mudou de nome e outra em que o cliente
+mudou: sozinha, ela afeta diretamente só esses dois clientes, e os demais
+clientes do produto renomeado também precisam ser atualizados.
+
+    python conferir_incremental.py [--linhas 20000] [--clientes 800] [--produtos 300] [--pasta dir]
+
+Sem --pasta, os arquivos e o banco ficam numa pasta temporária apagada no
+final. Sai com código 1 se alguma tabela divergir.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from collections import Counter
+
+from dados_sinteticos import (COLUNA_PARCEIRO, COLUNA_PRODUTO, COLUNA_QUANTIDADE, escrever_csv_erp,
+                              linhas_sinteticas, numero_br)
+from db_manager_v2 import TABELAS_METRICAS, DatabaseManager
+
+# Colunas que mudam a cada montagem sem mudar o conteúdo
+COLUNAS_IGNORADAS = {'id', 'updated_at'}
+
+# Casas decimais na comparação: as somas parciais e a completa podem diferir
+# no último bit conforme a ordem em que as linhas são somadas
+CASAS_DECIMAIS = 6
+
+# A cada quantas linhas do base uma entra na atualização (alterada ou não)
+PASSO_ATUALIZACAO = 25
+
+
+def gerar_arquivos(pasta, linhas, clientes, produtos):
+    """Grava base.csv, atualizacao.csv e renomeacao.csv em `pasta`; devolve os caminhos"""
+    base = list(linhas_sinteticas(linhas, clientes, produtos, semente=1))
+    atualizacao = []
+
+    # Linhas do base repetidas na atualização; metade delas com outra quantidade
+    for i, linha in enumerate(base[::PASSO_ATUALIZACAO]):
+        linha = list(linha)
+        if i % 2:
+            linha[COLUNA_QUANTIDADE] = numero_br(999 + i)
+        atualizacao.append(linha)
+
+    # Pedidos novos, numerados depois dos do base, que também alcançam clientes
+    # e produtos que o base não tem
+    ultimo_pedido = max(int(linha[0]) for linha in base)
+    atualizacao.extend(linhas_sinteticas(linhas // 10, clientes + 50, produtos + 10, semente=2,
+                                         primeiro_pedido=ultimo_pedido + 1))
+
+    # Um produto e um cliente do base com outro nome, numa linha cada
+    produto = list(base[0])
+    produto[COLUNA_PRODUTO] = 'PRODUTO RENOMEADO - '
+    cliente = list(base[-1])
+    cliente[COLUNA_PARCEIRO] = 'CLIENTE RENOMEADO LTDA'
+
+    caminhos = [os.path.join(pasta, nome) for nome in ('base.csv', 'atualizacao.csv', 'renomeacao.csv')]
+    for caminho, conteudo in zip(caminhos, (base, atualizacao, [produto, cliente])):
+        escrever_csv_erp(caminho, conteudo)
+    return caminhos
+
+
+def ler_tabela(conn, tabela):
+    """Linhas da tabela (sem COLUNAS_IGNORADAS e com os REAL arredondados) como Counter"""
+    colunas = [linha[1] for linha in conn.execute(f'PRAGMA table_info({tabela})')
+               if linha[1] not in COLUNAS_IGNORADAS]
+    linhas = conn.execute(f'SELECT {", ".join(colunas)} FROM {tabela}')
+    return colunas, Counter(
+        tuple(round(valor, CASAS_DECIMAIS) if isinstance(valor, float) else valor for valor in linha)
+        for linha in linhas
+    )
+
+
+def comparar_tabelas(db):
+    """Compara as métricas atuais com as de um update_metrics completo
+
+    Retorna {tabela: (colunas, só no incremental, só na reconstrução)} com as
+    tabelas que divergiram; cada lado é um Counter de linhas.
+    """
+    conn = db.connect()
+    incrementais = {tabela: ler_tabela(conn, tabela) for tabela in TABELAS_METRICAS}
+    db.update_metrics()
+    conn = db.connect()
+
+    divergencias = {}
+    for tabela in TABELAS_METRICAS:
+        colunas, incremental = incrementais[tabela]
+        _, completa = ler_tabela(conn, tabela)
+        if incremental != completa:
+            divergencias[tabela] = (colunas, incremental - completa, completa - incremental)
+    return divergencias
+
+
+def conferir(pasta, linhas, clientes, produtos):
+    """Importa os arquivos sintéticos num banco novo em `pasta` e compara as métricas"""
+    base, *incrementais = gerar_arquivos(pasta, linhas, clientes, produtos)
+    db = DatabaseManager(os.path.join(pasta, 'conferencia.db'))
+    try:
+        db.import_csv(base, modo='completo')
+        for caminho in incrementais:
+            resumo = db.import_csv(caminho, modo='incremental')
+            print(f"{os.path.basename(caminho)}: {resumo['inseridas']} linha(s) inserida(s), "
+                  f"{resumo['atualizadas']} atualizada(s)")
+        return comparar_tabelas(db)
+    finally:
+        db.close()
+
+
+def _linha_texto(colunas, linha):
+    return ', '.join(f"{coluna}={valor!r}" for coluna, valor in zip(colunas, linha))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Confere a importação incremental contra a completa')
+    parser.add_argument('--linhas', type=int, default=20000, help='Linhas do arquivo base')
+    parser.add_argument('--clientes', type=int, default=800)
+    parser.add_argument('--produtos', type=int, default=300)
+    parser.add_argument('--pasta', default=None, help='Pasta para os arquivos e o banco (padrão: temporária)')
+    parser.add_argument('--exemplos', type=int, default=5, help='Linhas divergentes mostradas por tabela')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporaria:
+        pasta = args.pasta or temporaria
+        if os.path.exists(os.path.join(pasta, 'conferencia.db')):
+            parser.error(f"{os.path.join(pasta, 'conferencia.db')} já existe")
+        os.makedirs(pasta, exist_ok=True)
+        divergencias = conferir(pasta, args.linhas, args.clientes, args.produtos)
+
+    for tabela, (colunas, so_incremental, so_completa) in divergencias.items():
+        print(f"[DIVERGE] {tabela}: {sum(so_incremental.values())} linha(s) só no incremental, "
+              f"{sum(so_completa.values())} só na reconstrução")
+        for lado, linhas in (('incremental', so_incremental), ('reconstrução', so_completa)):
+            for linha in list(linhas)[:args.exemplos]:
+                print(f"    {lado}: {_linha_texto(colunas, linha)}")
+
+    print(f"{len(TABELAS_METRICAS)} tabela(s) conferida(s), {len(divergencias)} com diferença")
+    sys.exit(1 if divergencias else 0)
@@ -0,0 +1,101 @@
+"""
+Arquivos sintéticos no formato do export de vendas do ERP
+
+Gera linhas com o mesmo cabeçalho, separador, codificação (latin-1) e formato
+de números e datas dos arquivos reais, para os scripts de conferência e de
+benchmark da importação. A geração é determinística pela `semente`.
+"""
+import csv
+import random
+from datetime import date, timedelta
+
+from db_manager_v2 import CATEGORIAS
+
+# Cabeçalho do arquivo do ERP, na ordem das colunas
+CABECALHO_ERP = [
+    'N° Venda', 'Data', 'Classificação', 'Produto (Classificação)', 'Quantidade',
+    'Preço Unitario', 'Valor Bruto', 'Unidade Medida', 'Qtd. Un. Medida', 'Valor',
+    'Desconto', 'Acréscimo', 'Total', 'Vendedor', 'Nome Vendedor', 'Ref. Fábrica',
+    'Cód', 'Parceiro', 'Preço Final', 'Preço Base', 'OBS', 'Marca',
+]
+
+# Posição de algumas colunas na linha, para quem altera linhas já geradas
+COLUNA_PRODUTO = 3
+COLUNA_QUANTIDADE = 4
+COLUNA_PARCEIRO = 17
+
+LINHAS_POR_PEDIDO = 4
+VENDEDORES = 20
+MARCAS = ['VP', 'GRANEL', 'PREMIUM']
+
+# Nomes de produto: uma palavra de cada categoria e algumas sem categoria
+PALAVRAS_PRODUTO = [palavra for palavras in CATEGORIAS.values() for palavra in palavras] + [
+    'GRANOLA', 'PAPEL TOALHA', 'SACO KRAFT']
+
+
+def numero_br(valor, moeda=False):
+    """1234.5 -> '1.234,50' (com 'R$ ' na frente se moeda=True)"""
+    texto = f"{valor:,.2f}".replace(',', '_').replace('.', ',').replace('_', '.')
+    return f"R$ {texto}" if moeda else texto
+
+
+def codigo_produto(i):
+    return f"{i}/{1 + i % 3}"
+
+
+def nome_produto(i):
+    return f"{PALAVRAS_PRODUTO[i % len(PALAVRAS_PRODUTO)]} {i} - "
+
+
+def codigo_cliente(i):
+    return str(1000 + i)
+
+
+def nome_cliente(i):
+    return f"CLIENTE {i} LTDA"
+
+
+def linhas_sinteticas(linhas, clientes, produtos, dias=730, semente=0, primeiro_pedido=100000,
+                      ultimo_dia=None):
+    """Gera `linhas` linhas do ERP (listas de textos, na ordem de CABECALHO_ERP)
+
+    Pedidos de até LINHAS_POR_PEDIDO produtos diferentes, numerados a partir de
+    `primeiro_pedido`, para um cliente e um dia sorteados entre `clientes` e
+    os `dias` até `ultimo_dia` (padrão: hoje).
+    """
+    rnd = random.Random(semente)
+    ultimo_dia = ultimo_dia or date.today()
+    datas = [(ultimo_dia - timedelta(days=d)).strftime('%d/%m/%Y') for d in range(dias)]
+    por_pedido = min(LINHAS_POR_PEDIDO, produtos)
+
+    geradas = 0
+    pedido = primeiro_pedido
+    while geradas < linhas:
+        data = datas[rnd.randrange(dias)]
+        cliente = rnd.randrange(clientes)
+        vendedor = rnd.randrange(VENDEDORES)
+        primeiro_produto = rnd.randrange(produtos)
+        for k in range(min(1 + rnd.randrange(por_pedido), linhas - geradas)):
+            produto = (primeiro_produto + k) % produtos
+            quantidade = 1 + rnd.randrange(50)
+            preco = 5 + produto % 40 + rnd.randrange(4) / 2
+            desconto = quantidade * preco * 0.05 if rnd.random() < 0.1 else 0
+            total = quantidade * preco - desconto
+            yield [
+                str(pedido), data, codigo_produto(produto), nome_produto(produto),
+                numero_br(quantidade), numero_br(preco), numero_br(quantidade * preco, total > 1000),
+                'KG', numero_br(quantidade), numero_br(total, True), numero_br(desconto), '0,00',
+                numero_br(total, True), str(300 + vendedor), f"VENDEDOR {vendedor}", 'CFOP5102',
+                codigo_cliente(cliente), nome_cliente(cliente), numero_br(preco),
+                numero_br(5 + produto % 40), '', MARCAS[produto % len(MARCAS)],
+            ]
+            geradas += 1
+        pedido += 1
+
+
+def escrever_csv_erp(caminho, linhas):
+    """Grava as linhas com o cabeçalho do ERP (latin-1, ';', fim de linha CRLF)"""
+    with open(caminho, 'w', encoding='latin-1', newline='') as f:
+        escritor = csv.writer(f, delimiter=';', lineterminator='\r\n')
+        escritor.writerow(CABECALHO_ERP)
+        escritor.writerows(linhas)
@@ -1,34 +1,121 @@
 """
 Gerenciador do banco de dados SQLite - Versão com códigos
 """
+import atexit
+import math
+import multiprocessing
+import os
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import pandas as pd
-from datetime import datetime, timedelta
 import numpy as np
 from pathlib import Path
 
-class DatabaseManager:
-    def __init__(self, db_path='database.db'):
-        self.db_path = db_path
-        self.conn = None
-        self.init_database()
-    
-    def connect(self):
-        """Conecta ao banco de dados"""
-        if self.conn is None:
-            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        return self.conn
-    
-    def init_database(self):
-        """Inicializa o banco com as tabelas necessárias"""
-        conn = self.connect()
-        cursor = conn.cursor()
-        
-        # Tabela principal de vendas (já existe, não vamos alterar)
-        
-        # Tabela de métricas agregadas de clientes - AGORA COM CÓDIGO
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS clientes_metricas_v2 (
+from importacao import (COLUNAS_VENDAS, EPOCA, blocos_arquivo, calcular_hash_arquivo, combinar_hashes,
+                        converter_arquivo, ler_blocos_convertidos)
+
+# Estrutura das tabelas ({tabela} permite criar a versão _nova usada na troca)
+TABELAS = {
+    # Tabela principal de vendas: nomes de cliente, produto, vendedor e marca
+    # ficam nas tabelas dim_* e cada linha guarda só a chave inteira; a data é
+    # o número do dia desde 1970-01-01, com o mês (AAAAMM) em ano_mes
+    'vendas': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            n_venda TEXT,
+            data_dia INTEGER,
+            ano_mes INTEGER,
+            cod_produto TEXT,
+            produto_id INTEGER REFERENCES dim_produto(id),
+            quantidade REAL,
+            preco_unitario REAL,
+            valor_bruto REAL,
+            unidade_medida TEXT,
+            qtd_un_medida REAL,
+            valor REAL,
+            desconto REAL,
+            acrescimo REAL,
+            total REAL,
+            cod_vendedor TEXT,
+            vendedor_id INTEGER REFERENCES dim_vendedor(id),
+            ref_fabrica TEXT,
+            cod_parceiro TEXT,
+            cliente_id INTEGER REFERENCES dim_cliente(id),
+            preco_final REAL,
+            preco_base REAL,
+            obs TEXT,
+            marca_id INTEGER REFERENCES dim_marca(id),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            seq_linha INTEGER
+        )
+    ''',
+    # Um registro por pedido (n_venda) com os totais das suas linhas, montado a
+    # partir de vendas junto com as métricas (na importação incremental, só os
+    # pedidos alterados). Linhas sem n_venda não formam pedido, e um número
+    # que aparece com dois clientes vira um pedido por cliente
+    'pedidos': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            n_venda TEXT NOT NULL,
+            cliente_id INTEGER REFERENCES dim_cliente(id),
+            data_dia INTEGER,
+            ano_mes INTEGER,
+            vendedor_id INTEGER REFERENCES dim_vendedor(id),
+            qtd_linhas INTEGER,
+            valor_bruto REAL,
+            desconto REAL,
+            total REAL
+        )
+    ''',
+    # Resumos mensais de vendas (total, por cliente e por produto), mantidos
+    # junto com pedidos: os gráficos por mês leem um registro por mês em vez
+    # de todas as linhas do período. Linhas sem data ficam de fora
+    'vendas_mes': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            ano_mes INTEGER PRIMARY KEY,
+            qtd_linhas INTEGER,
+            qtd_vendida REAL,
+            valor_total REAL,
+            qtd_pedidos INTEGER,
+            clientes_unicos INTEGER
+        )
+    ''',
+    'cliente_mes': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            cliente_id INTEGER REFERENCES dim_cliente(id),
+            ano_mes INTEGER,
+            qtd_linhas INTEGER,
+            qtd_vendida REAL,
+            valor_total REAL,
+            qtd_pedidos INTEGER,
+            produtos_unicos INTEGER
+        )
+    ''',
+    # soma_preco_final/qtd_preco_final dão o preço médio (AVG ignora nulos)
+    'produto_mes': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            produto_id INTEGER REFERENCES dim_produto(id),
+            ano_mes INTEGER,
+            qtd_linhas INTEGER,
+            qtd_vendida REAL,
+            valor_total REAL,
+            qtd_pedidos INTEGER,
+            clientes_unicos INTEGER,
+            soma_preco_final REAL,
+            qtd_preco_final INTEGER
+        )
+    ''',
+    # Tabela de métricas agregadas de clientes - AGORA COM CÓDIGO. Nesta e nas
+    # duas seguintes, dias_desde_ultima, segmento e status não são gravados:
+    # dependem da data de referência e são calculados na leitura (ver
+    # ULTIMA_DATA). score_cliente segue sem cálculo
+    'clientes_metricas_v2': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
             cod_parceiro TEXT PRIMARY KEY,
             parceiro TEXT,
             total_compras REAL,
@@ -38,6 +125,7 @@ class DatabaseManager:
             ultima_compra DATE,
             dias_desde_ultima INTEGER,
             frequencia_media_dias REAL,
+            desvio_frequencia_dias REAL,
             total_produtos_unicos INTEGER,
             categoria_principal TEXT,
             segmento TEXT,
@@ -46,11 +134,10 @@ class DatabaseManager:
             tendencia TEXT,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-        ''')
-        
-        # Tabela de produtos por cliente - COM CÓDIGOS
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS cliente_produtos_v2 (
+    ''',
+    # Tabela de produtos por cliente - COM CÓDIGOS
+    'cliente_produtos_v2': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             cod_parceiro TEXT,
             parceiro TEXT,
@@ -65,11 +152,10 @@ class DatabaseManager:
             frequencia_compra_dias REAL,
             FOREIGN KEY (cod_parceiro) REFERENCES clientes_metricas_v2(cod_parceiro)
         )
-        ''')
-        
-        # Tabela de métricas de produtos - COM CÓDIGOS
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS produtos_metricas_v2 (
+    ''',
+    # Tabela de métricas de produtos - COM CÓDIGOS
+    'produtos_metricas_v2': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
             cod_produto TEXT PRIMARY KEY,
             produto TEXT,
             quantidade_vendida REAL,
@@ -85,209 +171,1975 @@ class DatabaseManager:
             categoria TEXT,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
+    ''',
+    # Dimensões: uma linha por código do ERP (ou por nome, quando a linha veio
+    # sem código), com o nome mais recente importado
+    'dim_cliente': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            id INTEGER PRIMARY KEY,
+            cod_parceiro TEXT,
+            parceiro TEXT
+        )
+    ''',
+    'dim_produto': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            id INTEGER PRIMARY KEY,
+            cod_produto TEXT,
+            produto TEXT
+        )
+    ''',
+    'dim_vendedor': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            id INTEGER PRIMARY KEY,
+            cod_vendedor TEXT,
+            nome_vendedor TEXT
+        )
+    ''',
+    'dim_marca': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            id INTEGER PRIMARY KEY,
+            marca TEXT UNIQUE
+        )
+    ''',
+    # Registro das importações aplicadas (arquivos identificados pelo SHA-256)
+    'importacoes': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hash_arquivo TEXT NOT NULL,
+            arquivo TEXT,
+            modo TEXT,
+            linhas INTEGER,
+            inseridas INTEGER,
+            atualizadas INTEGER,
+            segundos REAL,
+            importado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    # Marca de vendas (linhas, último id e contador de alterações) com que
+    # cada tabela de métricas foi montada; a linha 'vendas' guarda o contador,
+    # que sobe a cada importação (ver DatabaseManager.situacao_metricas)
+    'frescor_metricas': '''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            tabela TEXT PRIMARY KEY,
+            linhas INTEGER,
+            ultimo_id INTEGER,
+            alteracao INTEGER,
+            atualizado_em TIMESTAMP
+        )
+    ''',
+}
+
+# Índices secundários por tabela: nome -> colunas
+#
+# Em vendas, os compostos cobrem as análises de um cliente ou produto
+# (planos conferidos por planos_consultas.py): filtram pela chave da dimensão
+# e agrupam pela outra sem ler a tabela.
+INDICES = {
+    'vendas': {
+        # Categorias, recompra e cross-sell do cliente; métricas cliente x produto
+        'idx_vendas_cliente_produto': 'cliente_id, produto_id, data_dia, quantidade, total',
+        # Clientes e recompra do produto, clientes similares, vendas com o produto
+        'idx_vendas_produto_cliente': 'produto_id, cliente_id, data_dia, quantidade, total, n_venda',
+        # Produtos das mesmas vendas (complementares)
+        'idx_vendas_venda_produto': 'n_venda, produto_id, total',
+        'idx_vendas_data': 'data_dia',
+        'idx_vendas_ano_mes': 'ano_mes',
+        'idx_vendas_chave_linha': 'n_venda, cod_produto, seq_linha',
+    },
+    'pedidos': {
+        'idx_pedidos_venda': 'n_venda',
+        'idx_pedidos_cliente': 'cliente_id, data_dia, total',
+        'idx_pedidos_data': 'data_dia',
+    },
+    'cliente_mes': {
+        'idx_cliente_mes': 'cliente_id, ano_mes',
+    },
+    'produto_mes': {
+        'idx_produto_mes': 'produto_id, ano_mes',
+    },
+    'cliente_produtos_v2': {
+        'idx_cliente_produtos_v2': 'cod_parceiro, cod_produto',
+    },
+    'importacoes': {
+        'idx_importacoes_hash': 'hash_arquivo',
+    },
+}
+
+# Chaves naturais das dimensões: o código é único entre as linhas com código
+# e o nome entre as linhas sem código
+INDICES_DIMENSOES = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_dim_cliente_codigo ON dim_cliente(cod_parceiro) WHERE cod_parceiro IS NOT NULL',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_dim_cliente_nome ON dim_cliente(parceiro) WHERE cod_parceiro IS NULL',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_dim_produto_codigo ON dim_produto(cod_produto) WHERE cod_produto IS NOT NULL',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_dim_produto_nome ON dim_produto(produto) WHERE cod_produto IS NULL',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_dim_vendedor_codigo ON dim_vendedor(cod_vendedor) WHERE cod_vendedor IS NOT NULL',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_dim_vendedor_nome ON dim_vendedor(nome_vendedor) WHERE cod_vendedor IS NULL',
+    # Análises por nome: chaves de todos os códigos com aquele nome
+    'CREATE INDEX IF NOT EXISTS idx_dim_cliente_parceiro ON dim_cliente(parceiro)',
+    'CREATE INDEX IF NOT EXISTS idx_dim_produto_produto ON dim_produto(produto)',
+]
+
+# Coluna de vendas -> dimensão que ela referencia (código e nome vindos do arquivo)
+DIMENSOES = {
+    'cliente_id': {'tabela': 'dim_cliente', 'codigo': 'cod_parceiro', 'nome': 'parceiro'},
+    'produto_id': {'tabela': 'dim_produto', 'codigo': 'cod_produto', 'nome': 'produto'},
+    'vendedor_id': {'tabela': 'dim_vendedor', 'codigo': 'cod_vendedor', 'nome': 'nome_vendedor'},
+    'marca_id': {'tabela': 'dim_marca', 'codigo': None, 'nome': 'marca'},
+}
+
+# Colunas do arquivo que não são gravadas em vendas (vão para as dimensões)
+COLUNAS_NOMES = {dim['nome'] for dim in DIMENSOES.values()}
+
+# Vendas com os nomes das dimensões, para listagens linha a linha
+VISOES = {
+    'vendas_detalhe': '''
+        CREATE VIEW IF NOT EXISTS vendas_detalhe AS
+        SELECT
+            v.*,
+            c.parceiro,
+            p.produto,
+            vd.nome_vendedor,
+            m.marca
+        FROM vendas v
+        LEFT JOIN dim_cliente c ON c.id = v.cliente_id
+        LEFT JOIN dim_produto p ON p.id = v.produto_id
+        LEFT JOIN dim_vendedor vd ON vd.id = v.vendedor_id
+        LEFT JOIN dim_marca m ON m.id = v.marca_id
+    ''',
+}
+
+# Índices de busca dos seletores: tabela FTS5 -> coluna de vendas da dimensão
+# indexada. O índice guarda trigramas de código e nome (acha qualquer trecho
+# com 3 ou mais letras, sem diferenciar maiúsculas) e lê as linhas da própria
+# dimensão (content=), mantido em dia pelos GATILHOS_BUSCA
+BUSCAS = {
+    'busca_cliente': 'cliente_id',
+    'busca_produto': 'produto_id',
+}
+
+INDICE_BUSCA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS {indice} USING fts5(
+        {codigo}, {nome}, content='{tabela}', content_rowid='id', tokenize='trigram'
+    )
+'''
+
+GATILHOS_BUSCA = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS {indice}_ai AFTER INSERT ON {tabela} BEGIN
+        INSERT INTO {indice} (rowid, {codigo}, {nome}) VALUES (new.id, new.{codigo}, new.{nome});
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS {indice}_ad AFTER DELETE ON {tabela} BEGIN
+        INSERT INTO {indice} ({indice}, rowid, {codigo}, {nome}) VALUES ('delete', old.id, old.{codigo}, old.{nome});
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS {indice}_au AFTER UPDATE ON {tabela} BEGIN
+        INSERT INTO {indice} ({indice}, rowid, {codigo}, {nome}) VALUES ('delete', old.id, old.{codigo}, old.{nome});
+        INSERT INTO {indice} (rowid, {codigo}, {nome}) VALUES (new.id, new.{codigo}, new.{nome});
+    END
+    ''',
+]
+
+# Tamanho mínimo de uma palavra buscada pelo índice de trigramas; as menores
+# são filtradas com LIKE
+LETRAS_TRIGRAMA = 3
+
+# Tabelas derivadas de vendas, recalculadas juntas em etapas: cada tabela lê
+# vendas, as dimensões e só tabelas de etapas anteriores (vendas_mes lê
+# cliente_mes e as métricas de clientes leem pedidos, cliente_produtos_v2 e
+# produtos_metricas_v2), então as tabelas de uma mesma etapa podem ser
+# montadas ao mesmo tempo
+ETAPAS_METRICAS = [
+    ['pedidos', 'cliente_mes', 'produto_mes', 'cliente_produtos_v2', 'produtos_metricas_v2'],
+    ['vendas_mes', 'clientes_metricas_v2'],
+]
+TABELAS_METRICAS = [tabela for etapa in ETAPAS_METRICAS for tabela in etapa]
+
+# Tabelas derivadas montadas ao mesmo tempo na reconstrução (uma thread e uma
+# conexão por tabela, num arquivo temporário). O padrão, 1, monta uma a uma
+# direto no banco: a montagem em paralelo grava cada tabela duas vezes e só
+# compensa com núcleos livres, então é ligada pela variável de ambiente
+TAREFAS_METRICAS = max(1, int(os.environ.get('TAREFAS_METRICAS', 1)))
+
+# Colunas dos resumos mensais que vêm direto das linhas de vendas
+COLUNAS_DAS_LINHAS = {
+    'qtd_linhas': 'COUNT(*)',
+    'qtd_vendida': 'SUM(quantidade)',
+    'valor_total': 'SUM(total)',
+}
+
+# Resumos mensais, montados nesta ordem: tabela -> origem (vendas ou um resumo
+# anterior), chave além do mês e colunas. Como em pedidos, um pedido é um
+# n_venda de um cliente, então o total do mês soma os pedidos dos clientes
+RESUMOS_MENSAIS = {
+    'cliente_mes': {
+        'origem': 'vendas',
+        'chave': 'cliente_id',
+        'colunas': dict(COLUNAS_DAS_LINHAS,
+                        qtd_pedidos='COUNT(DISTINCT n_venda)',
+                        produtos_unicos='COUNT(DISTINCT produto_id)'),
+    },
+    'produto_mes': {
+        'origem': 'vendas',
+        'chave': 'produto_id',
+        'colunas': dict(COLUNAS_DAS_LINHAS,
+                        qtd_pedidos='COUNT(DISTINCT n_venda)',
+                        clientes_unicos='COUNT(DISTINCT cliente_id)',
+                        soma_preco_final='SUM(preco_final)',
+                        qtd_preco_final='COUNT(preco_final)'),
+    },
+    'vendas_mes': {
+        'origem': 'cliente_mes',
+        'chave': None,
+        'colunas': {
+            'qtd_linhas': 'SUM(qtd_linhas)',
+            'qtd_vendida': 'SUM(qtd_vendida)',
+            'valor_total': 'SUM(valor_total)',
+            'qtd_pedidos': 'SUM(qtd_pedidos)',
+            'clientes_unicos': 'COUNT(cliente_id)',
+        },
+    },
+}
+
+# Migrações do esquema: versão -> método que leva o banco até ela. A versão
+# aplicada fica em PRAGMA user_version e só as migrações acima dela rodam na
+# abertura; bancos anteriores ao controle (versão 0) passam por todas, que só
+# mexem no que ainda falta
+MIGRACOES = {
+    1: '_garantir_seq_linha',
+    2: '_garantir_dimensoes',
+    3: '_garantir_dias',
+    4: '_garantir_derivadas',
+    5: '_garantir_busca',
+    6: '_garantir_frescor',
+    7: '_garantir_frequencia',
+}
+VERSAO_ESQUEMA = max(MIGRACOES)
+
+# Recursos do esquema -> tabelas que precisam existir para ele valer. Apurados
+# uma vez na abertura (DatabaseManager.tem_recurso), no lugar de consultar o
+# sqlite_master a cada análise
+RECURSOS = {
+    'metricas_v2': ('clientes_metricas_v2', 'cliente_produtos_v2', 'produtos_metricas_v2'),
+    'dimensoes': tuple(dim['tabela'] for dim in DIMENSOES.values()),
+    'pedidos': ('pedidos',),
+    'resumos_mensais': tuple(RESUMOS_MENSAIS),
+    'busca': tuple(BUSCAS),
+}
+
+# Número do dia de hoje, comparável com vendas.data_dia
+DIA_HOJE_SQL = "CAST(julianday('now') - 2440587.5 AS INTEGER)"
+
+# Tabela de métricas -> coluna com a data da última compra/venda. Com ela,
+# dias_desde_ultima (e o segmento, nos clientes) é calculado na leitura contra
+# a data de referência (DatabaseManager.aplicar_referencia), então a recência
+# não envelhece entre uma importação e outra
+ULTIMA_DATA = {
+    'clientes_metricas_v2': 'ultima_compra',
+    'cliente_produtos_v2': 'ultima_compra',
+    'produtos_metricas_v2': 'ultima_venda',
+}
+
+# Segmentos de clientes pelo número de pedidos e pelos dias desde o último, na
+# ordem em que são testados: vale a primeira condição verdadeira e quem não cai
+# em nenhuma fica com SEGMENTO_PADRAO. Sem data, as comparações de dias são falsas
+SEGMENTOS = [
+    ('VIP', lambda qtd, dias: (qtd >= 10) & (dias <= 30)),
+    ('Fiel', lambda qtd, dias: (qtd >= 5) & (dias <= 60)),
+    ('Regular', lambda qtd, dias: (qtd >= 3) & (dias <= 90)),
+    ('Inativo', lambda qtd, dias: dias > 90),
+    ('Novo', lambda qtd, dias: (qtd == 1) & (dias <= 30)),
+    ('One-Shot', lambda qtd, dias: qtd == 1),
+    ('Em Risco', lambda qtd, dias: dias > 60),
+]
+SEGMENTO_PADRAO = 'Em Crescimento'
+
+# Status da frequência de compra pelos dias desde a última compra contra a
+# frequência média e o desvio dos intervalos; como nos SEGMENTOS, vale a
+# primeira condição verdadeira (sem desvio, com um só intervalo, a primeira é falsa)
+STATUS_FREQUENCIA = [
+    ('Cliente Novo', lambda freq, desvio, dias: np.isnan(freq)),
+    ('Atrasado - Precisa contato', lambda freq, desvio, dias: dias > freq + desvio),
+    ('Chegando a hora de comprar', lambda freq, desvio, dias: dias > freq),
+]
+STATUS_FREQUENCIA_PADRAO = 'Dentro do padrão'
+
+# Tendência da frequência: média dos últimos INTERVALOS_TENDENCIA intervalos
+# entre dias de compra dividida pela média de todos. Abaixo de
+# TENDENCIA_ALTA o cliente passou a comprar mais seguido, acima de
+# TENDENCIA_QUEDA mais espaçado; com poucos intervalos fica sem tendência
+INTERVALOS_TENDENCIA = 3
+TENDENCIA_ALTA = 0.8
+TENDENCIA_QUEDA = 1.25
+
+# Categorias de produto pelas palavras do nome (a primeira que casar vale)
+CATEGORIAS = {
+    'Especiarias': ['CANELA', 'CRAVO', 'PIMENTA', 'GENGIBRE', 'CURCUMA', 'PAPRICA', 'ALHO', 'CEBOLA', 'OREGANO'],
+    'Frutas Secas': ['UVA PASSA', 'DAMASCO', 'GOJI', 'CRANBERRY', 'AMEIXA', 'TAMARA'],
+    'Oleaginosas': ['AMENDOA', 'CASTANHA', 'NOZES', 'AMENDOIM', 'PISTACHE', 'MACADAMIA'],
+    'Farinhas': ['FARINHA'],
+    'Chás e Ervas': ['CHA', 'HIBISCO', 'CAMOMILA', 'ERVA DOCE', 'HORTELA', 'BOLDO'],
+    'Óleos e Manteigas': ['OLEO', 'MANTEIGA', 'GHEE'],
+    'Suplementos': ['WHEY', 'PROTEIN', 'COLAGENO', 'VITAMINA', 'OMEGA'],
+    'Grãos e Sementes': ['CHIA', 'LINHACA', 'QUINOA', 'AVEIA', 'GIRASSOL', 'ABOBORA'],
+    'Açúcares e Adoçantes': ['ACUCAR', 'MEL', 'XILITOL', 'ERITRITOL', 'STEVIA'],
+    'Cacau e Chocolate': ['CACAU', 'CHOCOLATE', 'NIBS'],
+}
+CATEGORIA_PADRAO = 'Outros'
+
+# Texto 'AAAA-MM-DD 00:00:00' de um número de dia, para as datas das métricas
+DATA_DO_DIA_SQL = "datetime({} * 86400, 'unixepoch')"
+
+# Colunas de data de bancos em que vendas.data era texto (migração)
+DIAS_DA_DATA_SQL = {
+    'data_dia': "CAST(julianday(date({data})) - 2440587.5 AS INTEGER)",
+    'ano_mes': "CAST(strftime('%Y%m', {data}) AS INTEGER)",
+}
+
+# Pragmas da conexão durante a carga em lote (restaurados ao final).
+# synchronous=OFF só vale enquanto as tabelas _nova são montadas: uma queda
+# nesse intervalo perde a importação, mas as tabelas em uso não são tocadas
+# até a troca, que já roda com o valor original.
+PRAGMAS_CARGA = {
+    'synchronous': 'OFF',
+    'cache_size': -262144,  # 256 MB
+    'temp.cache_size': -262144,
+}
+
+# Pragmas das conexões do pool (cache em KB negativos, mmap em bytes)
+PRAGMAS_ESCRITA = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'journal_size_limit': 67108864,
+}
+PRAGMAS_LEITURA = {
+    'cache_size': -32768,
+    'mmap_size': 268435456,
+}
+
+# Pragmas das conexões que montam uma tabela derivada num arquivo temporário:
+# o arquivo é descartável (sem journal nem sync) e `banco` é o banco anexado
+# somente leitura
+PRAGMAS_MONTAGEM = {
+    'main.journal_mode': 'OFF',
+    'main.synchronous': 'OFF',
+    'main.cache_size': -65536,
+    'temp.cache_size': -65536,
+    'banco.cache_size': -32768,
+    'banco.mmap_size': 268435456,
+}
+
+
+def datas_dos_dias(dias):
+    """Converte números de dia (vendas.data_dia) em datas do pandas, sem ler texto
+    
+    pd.to_numeric cobre a coluna que o read_sql devolve como object (vazia ou
+    só com NULL).
+    """
+    return pd.to_datetime(pd.to_numeric(dias), unit='D', origin=EPOCA)
+
+
+def classificar_segmentos(qtd_compras, dias_desde_ultima):
+    """Segmento de cada cliente (ver SEGMENTOS), calculado de uma vez com np.select"""
+    qtd = np.asarray(qtd_compras, dtype=float)
+    dias = np.asarray(dias_desde_ultima, dtype=float)
+    return np.select([condicao(qtd, dias) for _, condicao in SEGMENTOS],
+                     [nome for nome, _ in SEGMENTOS], default=SEGMENTO_PADRAO)
+
+
+def classificar_frequencia(frequencia, desvio, dias_desde_ultima):
+    """Status da frequência de cada cliente (ver STATUS_FREQUENCIA), com np.select"""
+    freq = np.asarray(frequencia, dtype=float)
+    desvio = np.asarray(desvio, dtype=float)
+    dias = np.asarray(dias_desde_ultima, dtype=float)
+    return np.select([condicao(freq, desvio, dias) for _, condicao in STATUS_FREQUENCIA],
+                     [nome for nome, _ in STATUS_FREQUENCIA], default=STATUS_FREQUENCIA_PADRAO)
+
+
+def categoria_sql(coluna):
+    """CASE do SQL com a categoria (ver CATEGORIAS) do nome de produto em `coluna`"""
+    casos = ' '.join(
+        "WHEN {} THEN '{}'".format(' OR '.join(f"{coluna} LIKE '%{palavra}%'" for palavra in palavras), categoria)
+        for categoria, palavras in CATEGORIAS.items()
+    )
+    return f"CASE {casos} ELSE '{CATEGORIA_PADRAO}' END"
+
+
+def garantir_raiz(conn):
+    """Registra sqrt na conexão se o SQLite veio sem as funções matemáticas
+    (anterior a 3.35 ou compilado sem SQLITE_ENABLE_MATH_FUNCTIONS)"""
+    try:
+        conn.execute('SELECT sqrt(1)')
+    except sqlite3.OperationalError:
+        conn.create_function('sqrt', 1, lambda x: None if x is None else math.sqrt(x), deterministic=True)
+
+
+def escapar_like(texto):
+    """Escapa os curingas de LIKE (usar com ESCAPE '\\')"""
+    return texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def dia_de_hoje():
+    """Número do dia de hoje, na mesma contagem de vendas.data_dia"""
+    return (pd.Timestamp.now().normalize() - EPOCA).days
+
+
+def banco_padrao():
+    """Banco usado pelo app: o de produção, se existir, senão o local"""
+    return 'database_production.db' if os.path.exists('database_production.db') else 'database.db'
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def obter_pool(db_path):
+    """Pool único por arquivo de banco dentro do processo"""
+    chave = os.path.abspath(db_path)
+    with _pools_lock:
+        if chave not in _pools:
+            _pools[chave] = PoolConexoes(db_path)
+        return _pools[chave]
+
+
+class PoolConexoes:
+    """Conexões do banco em modo WAL: um escritor e um leitor por thread
+    
+    No WAL, leituras não bloqueiam a escrita nem umas às outras, então cada
+    thread (cada sessão do Streamlit) lê pela sua própria conexão somente
+    leitura. Toda escrita passa pela única conexão `escritor`, usada sempre
+    com `lock_escrita`.
+    """
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock_escrita = threading.RLock()
+        self._local = threading.local()
+        
+        # O escritor abre primeiro: cria o arquivo e liga o WAL, o que uma
+        # conexão somente leitura não pode fazer
+        self.escritor = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        for nome, valor in PRAGMAS_ESCRITA.items():
+            self.escritor.execute(f'PRAGMA {nome} = {valor}')
+        garantir_raiz(self.escritor)
+        
+        self.uri_leitura = Path(db_path).resolve().as_uri() + '?mode=ro'
+    
+    def leitor(self):
+        """Conexão somente leitura da thread atual"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.uri_leitura, uri=True, timeout=30, check_same_thread=False)
+            for nome, valor in PRAGMAS_LEITURA.items():
+                conn.execute(f'PRAGMA {nome} = {valor}')
+            self._local.conn = conn
+        return conn
+    
+    def fechar_leitor(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+    
+    def checkpoint(self):
+        """Copia o WAL para o arquivo do banco sem esperar pelos leitores ativos"""
+        with self.lock_escrita:
+            self.escritor.execute('PRAGMA wal_checkpoint(PASSIVE)')
+    
+    def fechar(self):
+        """Fecha o escritor; a última conexão a sair incorpora o WAL ao banco"""
+        self.fechar_leitor()
+        with self.lock_escrita:
+            self.escritor.close()
+
+
+@atexit.register
+def _fechar_pools():
+    # Sem isso o banco copiado com o app (deploy, backup) pode ficar sem o que está no -wal
+    with _pools_lock:
+        for pool in _pools.values():
+            try:
+                pool.fechar()
+            except sqlite3.Error:
+                pass
+        _pools.clear()
+
+
+class ChavesDimensoes:
+    """Atribui às linhas importadas as chaves inteiras das dimensões
+    
+    As dimensões são pequenas e ficam em memória durante a importação:
+    cada bloco ganha as colunas cliente_id, produto_id, vendedor_id e
+    marca_id com um `map` por coluna, e só códigos/nomes ainda desconhecidos
+    são gravados na hora. A chave vem do código do ERP ou, na linha sem
+    código, do nome. Em `finalizar`, cada código fica com o nome da linha
+    mais recente (pelo dia e, no empate, pela ordem das linhas).
+    """
+    
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.por_codigo = {}
+        self.por_nome = {}
+        self.nomes = {}
+        self.codigos = {}
+        self.novos = {}
+        # coluna_id -> {id: (dia, nome)} da linha mais recente com nome
+        self.recentes = {}
+        
+        for coluna_id, dim in DIMENSOES.items():
+            codigo = dim['codigo'] or 'NULL'
+            linhas = cursor.execute(f"SELECT id, {codigo}, {dim['nome']} FROM {dim['tabela']}").fetchall()
+            self.por_codigo[coluna_id] = {cod: id_ for id_, cod, _ in linhas if cod is not None}
+            self.por_nome[coluna_id] = {nome: id_ for id_, cod, nome in linhas if cod is None}
+            self.nomes[coluna_id] = {id_: nome for id_, _, nome in linhas}
+            self.codigos[coluna_id] = {id_: cod for id_, cod, _ in linhas}
+            self.novos[coluna_id] = set()
+            self.recentes[coluna_id] = {}
+    
+    def atribuir(self, bloco):
+        """Acrescenta ao bloco as colunas de chave, gravando as chaves novas"""
+        vazio = pd.Series(None, index=bloco.index, dtype=object)
+        sem_dia = float('-inf')
+        dias = bloco['data_dia'].fillna(sem_dia) if 'data_dia' in bloco else pd.Series(sem_dia, index=bloco.index)
+        
+        for coluna_id, dim in DIMENSOES.items():
+            codigos = bloco[dim['codigo']] if dim['codigo'] in bloco else vazio
+            nomes = bloco[dim['nome']] if dim['nome'] in bloco else vazio
+            sem_codigo = codigos.isna()
+            
+            for cod in codigos.dropna().unique():
+                if cod not in self.por_codigo[coluna_id]:
+                    self.por_codigo[coluna_id][cod] = self._incluir(coluna_id, cod, None)
+            for nome in nomes[sem_codigo].dropna().unique():
+                if nome not in self.por_nome[coluna_id]:
+                    self.por_nome[coluna_id][nome] = self._incluir(coluna_id, None, nome)
+            
+            ids = codigos.map(self.por_codigo[coluna_id]).where(~sem_codigo, nomes.map(self.por_nome[coluna_id]))
+            bloco[coluna_id] = ids
+            
+            com_nome = ~sem_codigo & nomes.notna()
+            if dim['codigo'] is None or not com_nome.any():
+                continue
+            ultimos = pd.DataFrame({
+                'id': ids[com_nome], 'dia': dias[com_nome], 'nome': nomes[com_nome]
+            }).sort_values('dia', kind='stable').drop_duplicates('id', keep='last')
+            recentes = self.recentes[coluna_id]
+            for id_, dia, nome in ultimos.itertuples(index=False, name=None):
+                id_ = int(id_)
+                if id_ not in recentes or dia >= recentes[id_][0]:
+                    recentes[id_] = (dia, nome)
+        return bloco
+    
+    def _incluir(self, coluna_id, codigo, nome):
+        dim = DIMENSOES[coluna_id]
+        if dim['codigo'] is None:
+            self.cursor.execute(f"INSERT INTO {dim['tabela']} ({dim['nome']}) VALUES (?)", (nome,))
+        else:
+            self.cursor.execute(f"INSERT INTO {dim['tabela']} ({dim['codigo']}, {dim['nome']}) VALUES (?, ?)",
+                                (codigo, nome))
+        id_ = self.cursor.lastrowid
+        self.nomes[coluna_id][id_] = nome
+        self.codigos[coluna_id][id_] = codigo
+        self.novos[coluna_id].add(id_)
+        return id_
+    
+    def finalizar(self):
+        """Grava os nomes mais recentes e retorna, por coluna de chave, os
+        códigos já existentes cujo nome mudou"""
+        nomes_alterados = {}
+        for coluna_id, recentes in self.recentes.items():
+            dim = DIMENSOES[coluna_id]
+            alterados = set()
+            for id_, (_, nome) in recentes.items():
+                if nome == self.nomes[coluna_id][id_]:
+                    continue
+                self.cursor.execute(f"UPDATE {dim['tabela']} SET {dim['nome']} = ? WHERE id = ?", (nome, id_))
+                self.nomes[coluna_id][id_] = nome
+                if id_ not in self.novos[coluna_id]:
+                    alterados.add(self.codigos[coluna_id][id_])
+            nomes_alterados[coluna_id] = alterados
+        return nomes_alterados
+
+
+class DatabaseManager:
+    def __init__(self, db_path='database.db'):
+        self.db_path = db_path
+        self.pool = obter_pool(db_path)
+        # Data de referência da recência ('AAAA-MM-DD'); vazia = hoje
+        self.data_referencia = os.environ.get('DATA_REFERENCIA') or None
+        # Última situacao_metricas de cada thread, com a conexão e o data_version em que foi lida
+        self._situacao = threading.local()
+        self.init_database()
+    
+    def connect(self):
+        """Conexão de leitura desta thread (somente leitura; escritas usam self.pool.escritor)"""
+        return self.pool.leitor()
+    
+    def init_database(self):
+        """Inicializa o banco com as tabelas necessárias e aplica as migrações pendentes
+        
+        Ao final, self.versao_esquema e self.recursos descrevem o banco aberto.
+        """
+        with self.pool.lock_escrita:
+            conn = self.pool.escritor
+            cursor = conn.cursor()
+            
+            for tabela, ddl in TABELAS.items():
+                cursor.execute(ddl.format(tabela=tabela))
+            for ddl in INDICES_DIMENSOES:
+                cursor.execute(ddl)
+            
+            # Bancos antigos não têm a identidade da linha usada na importação
+            # incremental, as chaves das dimensões, a data como número do dia
+            # nem as tabelas derivadas (ver MIGRACOES)
+            versao = cursor.execute('PRAGMA user_version').fetchone()[0]
+            for numero in sorted(MIGRACOES):
+                if numero <= versao:
+                    continue
+                getattr(self, MIGRACOES[numero])(conn)
+                conn.commit()
+                cursor.execute(f'PRAGMA user_version = {numero}')
+            
+            # Índices para performance (os que saíram de INDICES são removidos)
+            for tabela, indices in INDICES.items():
+                self._remover_indices_obsoletos(cursor, tabela, indices)
+                self._criar_indices(cursor, tabela, indices)
+            
+            for ddl in VISOES.values():
+                cursor.execute(ddl)
+            
+            conn.commit()
+            
+            existentes = {nome for (nome,) in cursor.execute('SELECT name FROM sqlite_master')}
+            self.versao_esquema = cursor.execute('PRAGMA user_version').fetchone()[0]
+            self.recursos = frozenset(
+                recurso for recurso, tabelas in RECURSOS.items() if existentes.issuperset(tabelas)
+            )
+    
+    def tem_recurso(self, recurso):
+        """Indica se o banco aberto tem o recurso (ver RECURSOS)"""
+        return recurso in self.recursos
+    
+    def dia_referencia(self):
+        """Número do dia contra o qual a recência é medida
+        
+        É self.data_referencia (por padrão DATA_REFERENCIA do ambiente) ou,
+        sem ela, hoje. Uma data passada, como a da exportação do ERP,
+        reproduz os dias sem compra e os segmentos daquele dia; ela não pode
+        ser anterior às últimas vendas do banco, que não são descontadas
+        (os dias ficariam negativos).
+        """
+        if not self.data_referencia:
+            return dia_de_hoje()
+        return (pd.Timestamp(self.data_referencia).normalize() - EPOCA).days
+    
+    def aplicar_referencia(self, df, tabela):
+        """Preenche dias_desde_ultima de linhas lidas de `tabela` pela data de referência
+        
+        `df` precisa da coluna de data de ULTIMA_DATA[tabela]; em
+        clientes_metricas_v2, com qtd_compras, o segmento é calculado junto,
+        e com a frequência e o desvio, o status da frequência.
+        Tudo vetorizado sobre o DataFrame, que é devolvido alterado.
+        """
+        ultima = (pd.to_datetime(df[ULTIMA_DATA[tabela]]) - EPOCA).dt.days
+        dias = self.dia_referencia() - ultima
+        if tabela == 'clientes_metricas_v2' and 'qtd_compras' in df:
+            df['segmento'] = classificar_segmentos(df['qtd_compras'], dias)
+        if tabela == 'clientes_metricas_v2' and 'desvio_frequencia_dias' in df:
+            df['status'] = classificar_frequencia(df['frequencia_media_dias'], df['desvio_frequencia_dias'], dias)
+        df['dias_desde_ultima'] = dias.astype('Int64')
+        return df
+    
+    def _criar_indices(self, cursor, tabela, indices):
+        """Cria em `tabela` os índices que ainda não existem
+        
+        Nomes de índice são globais no banco, então enquanto a tabela em uso e
+        a sua versão _nova coexistem, o índice da nova recebe o sufixo _b (ou o
+        perde), alternando a cada troca.
+        """
+        existentes = dict(cursor.execute(
+            "SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'"
+        ).fetchall())
+        
+        for nome, colunas in indices.items():
+            alternativo = f'{nome}_b'
+            if existentes.get(nome) == tabela or existentes.get(alternativo) == tabela:
+                continue
+            livre = nome if nome not in existentes else alternativo
+            cursor.execute(f'CREATE INDEX {livre} ON {tabela}({colunas})')
+    
+    def _remover_indices_obsoletos(self, cursor, tabela, indices):
+        """Remove de `tabela` os índices criados por versões anteriores de INDICES"""
+        existentes = cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (tabela,)
+        ).fetchall()
+        
+        for (nome,) in existentes:
+            if nome.removesuffix('_b') not in indices:
+                print(f"Removendo índice obsoleto {nome}")
+                cursor.execute(f'DROP INDEX {nome}')
+    
+    def _criar_tabela_nova(self, cursor, tabela, com_indices=True):
+        """Cria {tabela}_nova, vazia e com os mesmos índices, para ser preenchida à parte
+        
+        Com com_indices=False os índices ficam para depois da carga.
+        """
+        nova = f'{tabela}_nova'
+        cursor.execute(f'DROP TABLE IF EXISTS {nova}')
+        cursor.execute(TABELAS[tabela].format(tabela=nova))
+        if com_indices:
+            self._criar_indices(cursor, nova, INDICES.get(tabela, {}))
+        return nova
+    
+    def _aplicar_pragmas(self, conn, pragmas):
+        """Aplica os pragmas e devolve os valores anteriores, para restaurar depois"""
+        cursor = conn.cursor()
+        anteriores = {}
+        for nome, valor in pragmas.items():
+            anteriores[nome] = cursor.execute(f'PRAGMA {nome}').fetchone()[0]
+            cursor.execute(f'PRAGMA {nome} = {valor}')
+        return anteriores
+    
+    def _trocar_tabelas(self, conn, tabelas, frescor=()):
+        """Coloca as tabelas _nova no lugar das atuais numa única transação curta
+        
+        Enquanto as _nova são construídas, quem lê continua vendo as tabelas
+        atuais; a troca só renomeia, então o bloqueio de escrita dura milissegundos.
+        As tabelas de métricas em `frescor` ficam marcadas, na mesma transação,
+        como montadas a partir do vendas resultante.
+        """
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            tem_estatisticas = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+            ).fetchone()
+            # O RENAME valida as visões, que não podem apontar para uma tabela
+            # recém-apagada: elas saem antes da troca e voltam depois
+            for visao in VISOES:
+                cursor.execute(f'DROP VIEW IF EXISTS {visao}')
+            for tabela in tabelas:
+                cursor.execute(f'DROP TABLE IF EXISTS {tabela}')
+                cursor.execute(f'ALTER TABLE {tabela}_nova RENAME TO {tabela}')
+                # O RENAME não leva junto as estatísticas do ANALYZE
+                if tem_estatisticas:
+                    cursor.execute('UPDATE sqlite_stat1 SET tbl = ? WHERE tbl = ?',
+                                   (tabela, f'{tabela}_nova'))
+            for ddl in VISOES.values():
+                cursor.execute(ddl)
+            if 'vendas' in tabelas:
+                # Conteúdo novo pode ter o mesmo número de linhas e o mesmo último id
+                self._registrar_alteracao_vendas(cursor)
+            self._gravar_frescor(cursor, frescor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    
+    def _marca_vendas(self, cursor):
+        """(linhas, último id, contador de alterações) de vendas
+        
+        Linhas e último id acusam linhas incluídas ou apagadas por fora do
+        app; o contador, as alterações das importações (_registrar_alteracao_vendas).
+        """
+        return tuple(cursor.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM vendas),
+                (SELECT COALESCE(MAX(id), 0) FROM vendas),
+                (SELECT COALESCE(MAX(alteracao), 0) FROM frescor_metricas WHERE tabela = 'vendas')
+        ''').fetchone())
+    
+    def _registrar_alteracao_vendas(self, cursor):
+        """Sobe o contador de alterações de vendas; chamado na transação que altera vendas"""
+        cursor.execute('''
+            INSERT INTO frescor_metricas (tabela, alteracao, atualizado_em)
+            VALUES ('vendas', 1, CURRENT_TIMESTAMP)
+            ON CONFLICT (tabela) DO UPDATE SET alteracao = alteracao + 1, atualizado_em = CURRENT_TIMESTAMP
         ''')
+    
+    def _gravar_frescor(self, cursor, tabelas):
+        """Marca as tabelas de métricas como montadas a partir do vendas atual"""
+        if not tabelas:
+            return
+        linhas, ultimo_id, alteracao = self._marca_vendas(cursor)
+        cursor.executemany('''
+            INSERT OR REPLACE INTO frescor_metricas (tabela, linhas, ultimo_id, alteracao, atualizado_em)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', [(tabela, linhas, ultimo_id, alteracao) for tabela in tabelas])
+    
+    def situacao_metricas(self):
+        """Indica se as métricas estão em dia com vendas, sem recalcular nada
+        
+        Retorna um dicionário com 'atualizadas' (bool), 'desatualizadas' (as
+        tabelas de TABELAS_METRICAS montadas a partir de outra marca de
+        vendas), 'linhas' de vendas e 'atualizado_em' (última montagem). A
+        consulta só é refeita quando o banco muda (PRAGMA data_version da
+        conexão desta thread); quem corrige as métricas é a importação ou um
+        recálculo enfileirado (tarefa 'metricas').
+        """
+        conn = self.connect()
+        versao = conn.execute('PRAGMA data_version').fetchone()[0]
+        guardada = getattr(self._situacao, 'guardada', None)
+        if guardada and guardada[0] is conn and guardada[1] == versao:
+            return guardada[2]
         
-        # Índices para performance
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_vendas_cod_parceiro ON vendas(cod_parceiro)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_vendas_cod_produto ON vendas(cod_produto)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_cliente_produtos_v2 ON cliente_produtos_v2(cod_parceiro, cod_produto)')
+        marca = self._marca_vendas(conn)
+        gravadas = {
+            tabela: (linhas, ultimo_id, alteracao, atualizado_em)
+            for tabela, linhas, ultimo_id, alteracao, atualizado_em in conn.execute(
+                'SELECT tabela, linhas, ultimo_id, alteracao, atualizado_em FROM frescor_metricas'
+            )
+        }
+        desatualizadas = [t for t in TABELAS_METRICAS if gravadas.get(t, (None,) * 3)[:3] != marca]
+        datas = [gravadas[t][3] for t in TABELAS_METRICAS if t in gravadas]
+        situacao = {
+            'atualizadas': not desatualizadas,
+            'desatualizadas': desatualizadas,
+            'linhas': marca[0],
+            'atualizado_em': max(datas) if datas else None,
+        }
+        self._situacao.guardada = (conn, versao, situacao)
+        return situacao
+    
+    def _garantir_seq_linha(self, conn):
+        """Cria e preenche vendas.seq_linha em bancos criados antes da coluna existir
+        
+        seq_linha é a posição da linha entre as linhas do mesmo pedido e produto,
+        na ordem do arquivo; junto com (n_venda, cod_produto) identifica a linha.
+        """
+        cursor = conn.cursor()
+        colunas = [row[1] for row in cursor.execute('PRAGMA table_info(vendas)')]
+        if 'seq_linha' in colunas:
+            return
         
+        print("Adicionando identidade das linhas de vendas (seq_linha)...")
+        cursor.execute('ALTER TABLE vendas ADD COLUMN seq_linha INTEGER')
+        cursor.execute('CREATE TEMP TABLE seq_vendas (id INTEGER PRIMARY KEY, seq INTEGER)')
+        cursor.execute('''
+            INSERT INTO seq_vendas (id, seq)
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY n_venda, cod_produto ORDER BY id) - 1
+            FROM vendas
+        ''')
+        cursor.execute('''
+            UPDATE vendas
+            SET seq_linha = (SELECT seq FROM seq_vendas WHERE seq_vendas.id = vendas.id)
+        ''')
+        cursor.execute('DROP TABLE temp.seq_vendas')
         conn.commit()
     
+    def _garantir_dimensoes(self, conn):
+        """Move os nomes de vendas para as tabelas dim_* em bancos anteriores a elas
+        
+        vendas é reconstruída uma vez (vendas_nova + troca) com as chaves
+        inteiras no lugar das colunas de nome, e o arquivo é compactado.
+        """
+        cursor = conn.cursor()
+        colunas = [row[1] for row in cursor.execute('PRAGMA table_info(vendas)')]
+        if 'cliente_id' in colunas:
+            return
+        
+        print("Movendo nomes de clientes, produtos, vendedores e marcas para as dimensões...")
+        chaves = ChavesDimensoes(cursor)
+        cursor.execute('CREATE TEMP TABLE chaves_vendas (id INTEGER PRIMARY KEY, {})'.format(
+            ', '.join(f'{coluna_id} INTEGER' for coluna_id in DIMENSOES)
+        ))
+        lidas = [c for dim in DIMENSOES.values() for c in (dim['codigo'], dim['nome']) if c]
+        dia = 'data_dia' if 'data_dia' in colunas else DIAS_DA_DATA_SQL['data_dia'].format(data='data')
+        leitura = pd.read_sql('SELECT id, {} AS data_dia, {} FROM vendas ORDER BY id'.format(
+            dia, ', '.join(f"NULLIF({c}, '') AS {c}" for c in lidas)
+        ), conn, chunksize=100000)
+        for bloco in leitura:
+            bloco = chaves.atribuir(bloco)
+            cursor.executemany(
+                'INSERT INTO chaves_vendas VALUES ({})'.format(', '.join(['?'] * (len(DIMENSOES) + 1))),
+                bloco[['id'] + list(DIMENSOES)].itertuples(index=False, name=None)
+            )
+        chaves.finalizar()
+        
+        nova = self._criar_tabela_nova(cursor, 'vendas', com_indices=False)
+        codigos = {dim['codigo'] for dim in DIMENSOES.values()}
+        # Banco com a data ainda em texto: os dias são calculados na mesma cópia
+        datas = DIAS_DA_DATA_SQL if 'data' in colunas else {}
+        copiadas = [row[1] for row in cursor.execute(f'PRAGMA table_info({nova})')
+                    if row[1] in colunas or row[1] in datas]
+        cursor.execute('''
+            INSERT INTO {nova} ({cols}, {ids})
+            SELECT {valores}, {chaves}
+            FROM vendas t
+            JOIN chaves_vendas k ON k.id = t.id
+            ORDER BY t.id
+        '''.format(
+            nova=nova,
+            cols=', '.join(copiadas),
+            ids=', '.join(DIMENSOES),
+            valores=', '.join(
+                f"NULLIF(t.{c}, '')" if c in codigos
+                else datas[c].format(data='t.data') if c in datas
+                else f't.{c}'
+                for c in copiadas
+            ),
+            chaves=', '.join(f'k.{coluna_id}' for coluna_id in DIMENSOES)
+        ))
+        cursor.execute('DROP TABLE temp.chaves_vendas')
+        self._criar_indices(cursor, nova, INDICES['vendas'])
+        conn.commit()
+        self._trocar_tabelas(conn, ['vendas'])
+        
+        # Devolve ao sistema as páginas que eram das colunas de nome
+        cursor.execute('VACUUM')
+        print("OK: Dimensões criadas")
+    
+    def _garantir_dias(self, conn):
+        """Troca a data em texto de vendas por data_dia e ano_mes em bancos antigos
+        
+        Como em _garantir_dimensoes, vendas é reconstruída uma vez e o arquivo
+        é compactado.
+        """
+        cursor = conn.cursor()
+        colunas = [row[1] for row in cursor.execute('PRAGMA table_info(vendas)')]
+        if 'data_dia' in colunas:
+            return
+        
+        print("Convertendo as datas de vendas para número do dia...")
+        nova = self._criar_tabela_nova(cursor, 'vendas', com_indices=False)
+        copiadas = [row[1] for row in cursor.execute(f'PRAGMA table_info({nova})') if row[1] in colunas]
+        cursor.execute('''
+            INSERT INTO {nova} ({cols}, {dias})
+            SELECT {cols}, {valores}
+            FROM vendas
+            ORDER BY id
+        '''.format(
+            nova=nova,
+            cols=', '.join(copiadas),
+            dias=', '.join(DIAS_DA_DATA_SQL),
+            valores=', '.join(expr.format(data='data') for expr in DIAS_DA_DATA_SQL.values())
+        ))
+        self._criar_indices(cursor, nova, INDICES['vendas'])
+        conn.commit()
+        self._trocar_tabelas(conn, ['vendas'])
+        
+        cursor.execute('VACUUM')
+        print("OK: Datas convertidas")
+    
+    def _garantir_derivadas(self, conn):
+        """Monta pedidos, os resumos mensais e as métricas em bancos que já têm
+        vendas mas ainda não têm essas tabelas preenchidas
+        
+        As métricas são sempre recalculadas junto: as antigas tinham o ticket
+        médio por linha de venda, e não por pedido.
+        """
+        cursor = conn.cursor()
+        # Tabela derivada -> linhas de vendas que geram registros nela
+        origens = {
+            'pedidos': 'n_venda IS NOT NULL',
+            'vendas_mes': 'ano_mes IS NOT NULL',
+            'clientes_metricas_v2': 'cod_parceiro IS NOT NULL',
+            'produtos_metricas_v2': 'cod_produto IS NOT NULL',
+        }
+        faltando = [
+            tabela for tabela, linhas in origens.items()
+            if not cursor.execute(f'SELECT 1 FROM {tabela} LIMIT 1').fetchone()
+            and cursor.execute(f'SELECT 1 FROM vendas WHERE {linhas} LIMIT 1').fetchone()
+        ]
+        if not faltando:
+            return
+        
+        print(f"Montando {', '.join(faltando)}...")
+        conn.commit()
+        self._reconstruir_metricas(conn)
+        print("OK: Tabelas derivadas montadas")
+    
+    def _garantir_busca(self, conn):
+        """Cria os índices de busca (BUSCAS) e os preenche com as dimensões
+        
+        Sem FTS5 com trigramas (SQLite anterior a 3.34 ou compilado sem FTS5)
+        o banco fica sem o recurso 'busca' e buscar_clientes/buscar_produtos
+        procuram com LIKE direto nas dimensões.
+        """
+        cursor = conn.cursor()
+        for indice, coluna_id in BUSCAS.items():
+            dim = DIMENSOES[coluna_id]
+            nomes = dict(indice=indice, tabela=dim['tabela'], codigo=dim['codigo'], nome=dim['nome'])
+            try:
+                cursor.execute(INDICE_BUSCA.format(**nomes))
+            except sqlite3.OperationalError as e:
+                print(f"AVISO: índice de busca indisponível neste SQLite ({e}); a busca usará LIKE")
+                return
+            for ddl in GATILHOS_BUSCA:
+                cursor.execute(ddl.format(**nomes))
+            cursor.execute(f"INSERT INTO {indice} ({indice}) VALUES ('rebuild')")
+        conn.commit()
+    
+    def _garantir_frescor(self, conn):
+        """Marca as métricas de bancos anteriores a frescor_metricas como em dia
+        
+        Até aqui as métricas eram refeitas a cada importação e pelas migrações
+        anteriores, então valem para o vendas atual; as tabelas já marcadas
+        (montadas por essas migrações) ficam como estão.
+        """
+        cursor = conn.cursor()
+        marcadas = {tabela for (tabela,) in cursor.execute('SELECT tabela FROM frescor_metricas')}
+        self._gravar_frescor(cursor, [t for t in TABELAS_METRICAS if t not in marcadas])
+        conn.commit()
+    
+    def _garantir_frequencia(self, conn):
+        """Remonta as métricas de bancos anteriores a desvio_frequencia_dias
+        
+        Até aqui frequência, tendência e categoria principal dos clientes e a
+        frequência de cliente_produtos_v2 ficavam vazias; a remontagem cria
+        as tabelas com a coluna nova e preenche tudo.
+        """
+        cursor = conn.cursor()
+        colunas = {coluna for _, coluna, *_ in cursor.execute('PRAGMA table_info(clientes_metricas_v2)')}
+        if 'desvio_frequencia_dias' in colunas:
+            return
+        
+        print("Calculando frequência, tendência e categoria principal dos clientes...")
+        conn.commit()
+        self._reconstruir_metricas(conn)
+        print("OK: Métricas de frequência montadas")
+    
+    def import_csv(self, csv_path, modo='completo', chunksize=50000, progress_callback=None,
+                   carga_em_lote=True, forcar=False):
+        """Importa um arquivo do ERP (CSV ou XLSX); ver import_arquivos"""
+        return self.import_arquivos([csv_path], modo=modo, chunksize=chunksize,
+                                    progress_callback=progress_callback,
+                                    carga_em_lote=carga_em_lote, forcar=forcar)
+    
+    def import_arquivos(self, caminhos, modo='completo', processos=None, chunksize=50000,
+                        progress_callback=None, carga_em_lote=True, forcar=False):
+        """Importa um ou mais arquivos do ERP (CSV ou XLSX) numa única transação
+        
+        Com um arquivo (ou processos=1), o CSV é lido em blocos de `chunksize`
+        linhas, sem carregar o arquivo inteiro na memória. Com vários, cada
+        arquivo é lido e convertido num processo separado (até `processos`,
+        padrão: número de CPUs) e os resultados entram na ordem da lista.
+        Cada bloco é inserido com executemany numa tabela temporária. Se
+        informado, `progress_callback(linhas_importadas, linhas_por_segundo)` é
+        chamado a cada bloco.
+        
+        modo='completo' substitui toda a tabela vendas pelos arquivos: o conteúdo
+        novo e as métricas calculadas a partir dele são montados em tabelas
+        _nova e trocados de uma vez, então quem lê nunca vê vendas vazia.
+        Com carga_em_lote=True (padrão), vendas_nova é preenchida sem índices,
+        com os PRAGMAS_CARGA na conexão; os índices são criados uma vez no
+        final e a tabela passa por ANALYZE antes da troca.
+        modo='incremental' identifica cada linha por (n_venda, cod_produto,
+        seq_linha), insere só as linhas novas e atualiza as que mudaram; linhas
+        que não estão nos arquivos são mantidas.
+        
+        Arquivos idênticos (mesmo SHA-256) a importações já aplicadas desde a
+        última completa não são reimportados: no modo incremental eles saem do
+        lote, no completo vale o lote inteiro. Se nada sobrar, vendas e métricas
+        ficam como estão e o resumo volta com ignorado=True. forcar=True importa
+        mesmo assim.
+        
+        Retorna um resumo com linhas, duração, linhas inseridas/atualizadas, os
+        códigos de clientes e produtos afetados, os arquivos lidos e, por coluna,
+        quantas células vieram vazias ou inválidas na conversão.
+        """
+        if modo not in ('completo', 'incremental'):
+            raise ValueError(f"Modo de importação inválido: {modo}")
+        if not caminhos:
+            raise ValueError("Nenhum arquivo para importar")
+        
+        inicio = time.perf_counter()
+        hashes = {caminho: calcular_hash_arquivo(caminho) for caminho in caminhos}
+        
+        arquivos_ignorados = []
+        if modo == 'incremental' and not forcar:
+            arquivos_ignorados = [c for c in caminhos if self.importacao_existente(hashes[c], modo)]
+            caminhos = [c for c in caminhos if c not in arquivos_ignorados]
+        
+        if caminhos:
+            hash_lote = combinar_hashes([hashes[c] for c in caminhos])
+            anterior = None if forcar else self.importacao_existente(hash_lote, modo)
+        else:
+            hash_lote = combinar_hashes(list(hashes.values()))
+            anterior = self.importacao_existente(hashes[arquivos_ignorados[-1]], modo)
+        
+        if anterior:
+            print(f"Arquivo idêntico ao importado em {anterior['importado_em']}; nada a fazer")
+            return {
+                'linhas': anterior['linhas'],
+                'segundos': time.perf_counter() - inicio,
+                'modo': modo,
+                'inseridas': 0,
+                'atualizadas': 0,
+                'clientes_afetados': set(),
+                'produtos_afetados': set(),
+                'ignorado': True,
+                'hash_arquivo': hash_lote,
+                'importacao_anterior': anterior
+            }
+        
+        if arquivos_ignorados:
+            print(f"{len(arquivos_ignorados)} arquivo(s) já importado(s) fora do lote")
+        print(f"Importando {len(caminhos)} arquivo(s) em blocos (modo {modo})...")
+        
+        if len(caminhos) > 1 and processos != 1:
+            blocos = self._blocos_em_paralelo(caminhos, processos, chunksize)
+        else:
+            blocos = ((caminho, conversor, bloco)
+                      for caminho in caminhos
+                      for conversor, bloco in blocos_arquivo(caminho, chunksize))
+        
+        # Um escritor por vez: a conexão de escrita é compartilhada pelo processo
+        with self.pool.lock_escrita:
+            conn = self.pool.escritor
+            cursor = conn.cursor()
+            
+            carga_em_lote = carga_em_lote and modo == 'completo'
+            if carga_em_lote:
+                pragmas_anteriores = self._aplicar_pragmas(conn, PRAGMAS_CARGA)
+            
+            try:
+                conversores, linhas_por_arquivo, nomes_alterados = self._carregar_arquivo_temporario(
+                    cursor, blocos, progress_callback, inicio
+                )
+                total_linhas = sum(linhas_por_arquivo.values())
+            
+                # Colunas presentes em algum dos arquivos, na ordem da tabela;
+                # nomes viram a chave da dimensão
+                presentes = {c for conversor in conversores.values() for c in conversor.colunas}
+                colunas = [c for c in COLUNAS_VENDAS if c in presentes and c not in COLUNAS_NOMES]
+                colunas += [coluna_id for coluna_id, dim in DIMENSOES.items()
+                            if dim['codigo'] in presentes or dim['nome'] in presentes]
+            
+                if modo == 'incremental':
+                    alteracoes = self._aplicar_delta_vendas(cursor, colunas)
+                    # Nome trocado no ERP muda as métricas mesmo sem mudar a linha
+                    alteracoes['clientes_afetados'] |= nomes_alterados.get('cliente_id', set())
+                    alteracoes['produtos_afetados'] |= nomes_alterados.get('produto_id', set())
+                    # O nome do produto também fica nas linhas de cliente_produtos_v2
+                    # (e na categoria principal) de todos os clientes que o compraram
+                    alteracoes['clientes_afetados'] |= self._clientes_dos_produtos(
+                        cursor, nomes_alterados.get('produto_id', set())
+                    )
+                    self._registrar_alteracao_vendas(cursor)
+                else:
+                    alteracoes = self._preparar_vendas_nova(cursor, colunas, carga_em_lote)
+            
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                if carga_em_lote:
+                    self._aplicar_pragmas(conn, pragmas_anteriores)
+                raise
+            finally:
+                cursor.execute('DROP TABLE IF EXISTS temp.vendas_importacao_bruta')
+                cursor.execute('DROP TABLE IF EXISTS temp.vendas_importacao')
+                cursor.execute('DROP TABLE IF EXISTS temp.delta_vendas')
+                cursor.execute('DROP TABLE IF EXISTS temp.pedidos_afetados')
+                cursor.execute('DROP TABLE IF EXISTS temp.meses_afetados')
+            
+            if carga_em_lote:
+                # A troca das tabelas volta a ser gravada com a segurança normal
+                self._aplicar_pragmas(conn, pragmas_anteriores)
+            
+            duracao = time.perf_counter() - inicio
+            print(f"OK: {total_linhas} registros lidos em {duracao:.1f}s "
+                  f"({alteracoes['inseridas']} inseridas, {alteracoes['atualizadas']} atualizadas)")
+            
+            # Atualizar métricas (no modo incremental, só o que foi afetado)
+            if modo == 'incremental':
+                self.update_metrics_parcial(alteracoes['clientes_afetados'], alteracoes['produtos_afetados'])
+            else:
+                print("Atualizando métricas com códigos...")
+                self._reconstruir_metricas(conn, origem='vendas_nova', trocar=['vendas'] + TABELAS_METRICAS)
+                print("OK: Vendas e métricas substituídas!")
+            
+            # Registrado só depois das métricas: se algo falhar antes, os mesmos
+            # arquivos podem ser enviados de novo (e as métricas continuam
+            # marcadas como desatualizadas)
+            if modo == 'incremental':
+                self._gravar_frescor(cursor, TABELAS_METRICAS)
+            cursor.execute('''
+                INSERT INTO importacoes (hash_arquivo, arquivo, modo, linhas, inseridas, atualizadas, segundos)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (hash_lote, ', '.join(Path(c).name for c in caminhos), modo, total_linhas,
+                  alteracoes['inseridas'], alteracoes['atualizadas'], time.perf_counter() - inicio))
+            conn.commit()
+            
+            # Devolve ao arquivo principal as páginas da carga; o -wal volta ao
+            # limite de journal_size_limit na próxima escrita
+            self.pool.checkpoint()
+            
+            resultado = {'linhas': total_linhas, 'segundos': duracao, 'modo': modo,
+                         'ignorado': False, 'hash_arquivo': hash_lote}
+            resultado.update(alteracoes)
+            resultado.update(self._resumo_conversao(conversores))
+            resultado['arquivos'] = [
+                {'arquivo': Path(c).name, 'linhas': linhas_por_arquivo.get(c, 0), 'hash_arquivo': hashes[c]}
+                for c in caminhos
+            ]
+            resultado['arquivos_ignorados'] = [Path(c).name for c in arquivos_ignorados]
+            return resultado
+    
+    def _clientes_dos_produtos(self, cursor, produtos):
+        """Códigos dos clientes com alguma linha em vendas dos produtos (códigos) informados"""
+        if not produtos:
+            return set()
+        cursor.execute('CREATE TEMP TABLE produtos_renomeados (cod TEXT PRIMARY KEY)')
+        try:
+            cursor.executemany('INSERT INTO produtos_renomeados VALUES (?)', [(p,) for p in produtos])
+            return {cod for (cod,) in cursor.execute('''
+                SELECT DISTINCT c.cod_parceiro
+                FROM vendas v
+                JOIN dim_cliente c ON c.id = v.cliente_id
+                WHERE v.produto_id IN (
+                    SELECT id FROM dim_produto WHERE cod_produto IN (SELECT cod FROM produtos_renomeados)
+                ) AND c.cod_parceiro IS NOT NULL
+            ''')}
+        finally:
+            cursor.execute('DROP TABLE IF EXISTS temp.produtos_renomeados')
+    
+    def importacao_existente(self, hash_arquivo, modo='incremental'):
+        """Importação anterior que torna o arquivo redundante, ou None
+        
+        Importações anteriores à última completa não contam, pois ela
+        substituiu tudo. No modo incremental basta o arquivo ter sido aplicado
+        depois disso; no modo completo, a última completa precisa ser do mesmo
+        arquivo e nada diferente pode ter entrado depois dela.
+        """
+        conn = self.connect()
+        cursor = conn.cursor()
+        ultima_completa = cursor.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM importacoes WHERE modo = 'completo'"
+        ).fetchone()[0]
+        
+        if modo == 'completo':
+            query = '''
+                SELECT id, arquivo, modo, linhas, importado_em FROM importacoes
+                WHERE id = ? AND hash_arquivo = ?
+                    AND NOT EXISTS (
+                        SELECT 1 FROM importacoes WHERE id > ? AND hash_arquivo != ?
+                    )
+            '''
+            params = (ultima_completa, hash_arquivo, ultima_completa, hash_arquivo)
+        else:
+            query = '''
+                SELECT id, arquivo, modo, linhas, importado_em FROM importacoes
+                WHERE id >= ? AND hash_arquivo = ?
+                ORDER BY id DESC LIMIT 1
+            '''
+            params = (ultima_completa, hash_arquivo)
+        
+        row = cursor.execute(query, params).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['id', 'arquivo', 'modo', 'linhas', 'importado_em'], row))
+    
+    def _blocos_em_paralelo(self, caminhos, processos, chunksize):
+        """Gera (caminho, conversor, bloco) com os arquivos convertidos em paralelo
+        
+        Cada processo grava os blocos do seu arquivo num arquivo temporário
+        (converter_arquivo), lido aqui um bloco por vez na ordem da lista. No
+        máximo `processos` arquivos ficam em conversão ou esperando a vez: o
+        próximo só é enviado quando o primeiro da fila começa a ser lido, então
+        nem a memória nem a pasta temporária chegam a guardar o lote inteiro.
+        
+        Processos iniciados com spawn: o app roda threads (fila de tarefas,
+        Streamlit) e fork a partir delas não é seguro.
+        """
+        processos = processos or os.cpu_count() or 1
+        contexto = multiprocessing.get_context('spawn')
+        pasta = tempfile.mkdtemp(prefix='importacao_', dir=Path(self.db_path).resolve().parent)
+        try:
+            with ProcessPoolExecutor(max_workers=processos, mp_context=contexto) as executor:
+                fila = deque()
+                for posicao, caminho in enumerate(caminhos):
+                    destino = os.path.join(pasta, f'{posicao}.pkl')
+                    fila.append((caminho, destino, executor.submit(converter_arquivo, caminho, destino, chunksize)))
+                    if len(fila) == processos:
+                        yield from self._ler_convertido(*fila.popleft())
+                while fila:
+                    yield from self._ler_convertido(*fila.popleft())
+        finally:
+            shutil.rmtree(pasta, ignore_errors=True)
+    
+    def _ler_convertido(self, caminho, destino, conversao):
+        """Gera (caminho, conversor, bloco) de um arquivo convertido por _blocos_em_paralelo"""
+        conversor = conversao.result()
+        if conversor is not None:
+            for bloco in ler_blocos_convertidos(destino):
+                yield caminho, conversor, bloco
+        os.remove(destino)
+    
+    def _carregar_arquivo_temporario(self, cursor, blocos, progress_callback, inicio):
+        """Grava os blocos convertidos na tabela temporária vendas_importacao
+        
+        `blocos` gera (caminho, conversor, bloco) na ordem dos arquivos. Ao
+        final, cada linha recebe seq_linha na ordem em que foi lida.
+        Retorna os conversores, as linhas lidas por arquivo e os códigos cujo
+        nome mudou nas dimensões.
+        """
+        cursor.execute('CREATE TEMP TABLE vendas_importacao_bruta ({})'.format(
+            ', '.join(COLUNAS_VENDAS + [f'{coluna_id} INTEGER' for coluna_id in DIMENSOES])
+        ))
+        chaves = ChavesDimensoes(cursor)
+        
+        conversores = {}
+        linhas_por_arquivo = {}
+        total_linhas = 0
+        
+        for caminho, conversor, bloco in blocos:
+            if caminho not in conversores:
+                if not conversor.colunas:
+                    raise ValueError(f"Nenhuma coluna de vendas reconhecida em {Path(caminho).name}")
+                conversores[caminho] = conversor
+                colunas = conversor.colunas + list(DIMENSOES)
+                insert_sql = 'INSERT INTO vendas_importacao_bruta ({}) VALUES ({})'.format(
+                    ', '.join(colunas), ', '.join(['?'] * len(colunas))
+                )
+            
+            bloco = chaves.atribuir(bloco)
+            cursor.executemany(insert_sql, bloco[colunas].itertuples(index=False, name=None))
+            linhas_por_arquivo[caminho] = linhas_por_arquivo.get(caminho, 0) + len(bloco)
+            total_linhas += len(bloco)
+            
+            if progress_callback:
+                decorrido = time.perf_counter() - inicio
+                progress_callback(total_linhas, total_linhas / decorrido if decorrido > 0 else 0)
+        
+        if total_linhas == 0:
+            raise ValueError("Arquivo sem linhas de vendas para importar")
+        
+        nomes_alterados = chaves.finalizar()
+        
+        cursor.execute('''
+            CREATE TEMP TABLE vendas_importacao AS
+            SELECT
+                rowid AS linha,
+                *,
+                ROW_NUMBER() OVER (PARTITION BY n_venda, cod_produto ORDER BY rowid) - 1 AS seq_linha
+            FROM vendas_importacao_bruta
+        ''')
+        cursor.execute('DROP TABLE temp.vendas_importacao_bruta')
+        
+        return conversores, linhas_por_arquivo, nomes_alterados
+    
+    def _resumo_conversao(self, conversores):
+        """Soma os resumos de conversão de todos os arquivos do lote"""
+        resumo = {'colunas': {}, 'colunas_ignoradas': [], 'colunas_ausentes': []}
+        for conversor in conversores.values():
+            parcial = conversor.resumo()
+            for coluna, contagem in parcial['colunas'].items():
+                total = resumo['colunas'].setdefault(coluna, {'vazios': 0, 'invalidos': 0})
+                total['vazios'] += contagem['vazios']
+                total['invalidos'] += contagem['invalidos']
+            for chave in ('colunas_ignoradas', 'colunas_ausentes'):
+                resumo[chave] += [c for c in parcial[chave] if c not in resumo[chave]]
+        return resumo
+    
+    def _preparar_vendas_nova(self, cursor, colunas, carga_em_lote=False):
+        """Grava as linhas importadas em vendas_nova, que depois substitui vendas
+        
+        Na carga em lote cada índice é montado uma vez, sobre a tabela cheia,
+        em vez de ser atualizado linha a linha durante o INSERT.
+        """
+        nova = self._criar_tabela_nova(cursor, 'vendas', com_indices=not carga_em_lote)
+        cursor.execute('''
+            INSERT INTO {nova} ({cols}, seq_linha)
+            SELECT {cols}, seq_linha FROM vendas_importacao ORDER BY linha
+        '''.format(nova=nova, cols=', '.join(colunas)))
+        inseridas = cursor.rowcount
+        
+        if carga_em_lote:
+            self._criar_indices(cursor, nova, INDICES['vendas'])
+            cursor.execute(f'ANALYZE {nova}')
+        
+        return {
+            'inseridas': inseridas,
+            'atualizadas': 0,
+            'clientes_afetados': None,
+            'produtos_afetados': None
+        }
+    
+    def _aplicar_delta_vendas(self, cursor, colunas):
+        """Insere as linhas novas e atualiza as alteradas a partir de vendas_importacao
+        
+        Só as colunas presentes no arquivo são comparadas e atualizadas.
+        Retorna as contagens e os códigos de clientes/produtos afetados.
+        """
+        cursor.execute('CREATE INDEX temp.idx_vendas_importacao_linha ON vendas_importacao(linha)')
+        
+        # Linhas novas (id_venda nulo) ou com alguma coluna diferente
+        diferente = ' OR '.join(f'v.{col} IS NOT t.{col}' for col in colunas)
+        cursor.execute(f'''
+            CREATE TEMP TABLE delta_vendas AS
+            SELECT
+                t.linha,
+                v.id AS id_venda,
+                v.cod_parceiro AS cod_parceiro_anterior,
+                v.cod_produto AS cod_produto_anterior,
+                v.ano_mes AS ano_mes_anterior
+            FROM vendas_importacao t
+            LEFT JOIN vendas v
+                ON v.n_venda IS t.n_venda
+                AND v.cod_produto IS t.cod_produto
+                AND v.seq_linha = t.seq_linha
+            WHERE v.id IS NULL OR {diferente}
+        ''')
+        cursor.execute('CREATE INDEX temp.idx_delta_vendas_id ON delta_vendas(id_venda)')
+        
+        # Códigos afetados: valores novos e, nas linhas alteradas, os anteriores
+        afetados = cursor.execute('''
+            SELECT t.cod_parceiro, t.cod_produto
+            FROM delta_vendas d
+            JOIN vendas_importacao t ON t.linha = d.linha
+            UNION
+            SELECT cod_parceiro_anterior, cod_produto_anterior
+            FROM delta_vendas
+            WHERE id_venda IS NOT NULL
+        ''').fetchall()
+        clientes_afetados = {cod for cod, _ in afetados if cod}
+        produtos_afetados = {cod for _, cod in afetados if cod}
+        
+        # Atualizar linhas alteradas
+        cols = ', '.join(colunas)
+        cursor.execute(f'''
+            UPDATE vendas
+            SET ({cols}) = (
+                SELECT {', '.join('t.' + col for col in colunas)}
+                FROM delta_vendas d
+                JOIN vendas_importacao t ON t.linha = d.linha
+                WHERE d.id_venda = vendas.id
+            )
+            WHERE id IN (SELECT id_venda FROM delta_vendas WHERE id_venda IS NOT NULL)
+        ''')
+        atualizadas = cursor.rowcount
+        
+        # Inserir linhas novas
+        cursor.execute(f'''
+            INSERT INTO vendas ({cols}, seq_linha)
+            SELECT {', '.join('t.' + col for col in colunas)}, t.seq_linha
+            FROM delta_vendas d
+            JOIN vendas_importacao t ON t.linha = d.linha
+            WHERE d.id_venda IS NULL
+            ORDER BY t.linha
+        ''')
+        inseridas = cursor.rowcount
+        
+        # Pedidos com alguma linha nova ou alterada são montados de novo (a linha
+        # casa pelo n_venda, então o número do pedido não muda na atualização)
+        cursor.execute('''
+            CREATE TEMP TABLE pedidos_afetados AS
+            SELECT DISTINCT t.n_venda
+            FROM delta_vendas d
+            JOIN vendas_importacao t ON t.linha = d.linha
+            WHERE t.n_venda IS NOT NULL
+        ''')
+        filtro_pedidos = 'AND n_venda IN (SELECT n_venda FROM pedidos_afetados)'
+        cursor.execute(f'DELETE FROM pedidos WHERE 1 = 1 {filtro_pedidos}')
+        self._montar_pedidos(cursor, filtro=filtro_pedidos)
+        
+        # Meses com alguma linha nova ou alterada (o mês atual da linha e, nas
+        # alteradas, o anterior) são resumidos de novo
+        meses_novos = '''
+            UNION
+            SELECT t.ano_mes
+            FROM delta_vendas d
+            JOIN vendas_importacao t ON t.linha = d.linha
+        ''' if 'ano_mes' in colunas else ''
+        cursor.execute(f'''
+            CREATE TEMP TABLE meses_afetados AS
+            SELECT ano_mes_anterior AS ano_mes
+            FROM delta_vendas
+            WHERE id_venda IS NOT NULL
+            {meses_novos}
+        ''')
+        filtro_meses = 'AND ano_mes IN (SELECT ano_mes FROM meses_afetados)'
+        for tabela in RESUMOS_MENSAIS:
+            cursor.execute(f'DELETE FROM {tabela} WHERE 1 = 1 {filtro_meses}')
+        self._montar_resumos_mensais(cursor, filtro=filtro_meses)
+        
+        return {
+            'inseridas': inseridas,
+            'atualizadas': atualizadas,
+            'clientes_afetados': clientes_afetados,
+            'produtos_afetados': produtos_afetados
+        }
+    
     def update_metrics(self):
         """Atualiza todas as tabelas de métricas usando códigos"""
         print("Atualizando métricas com códigos...")
-        conn = self.connect()
+        with self.pool.lock_escrita:
+            self._reconstruir_metricas(self.pool.escritor)
+        print("OK: Métricas atualizadas com códigos!")
+    
+    def _reconstruir_metricas(self, conn, origem='vendas', trocar=TABELAS_METRICAS, tarefas=None):
+        """Recalcula as métricas em tabelas _nova e troca as tabelas de `trocar`
         
-        # Atualizar métricas de clientes
-        self._update_cliente_metrics_v2(conn)
+        As tabelas em uso não são tocadas durante o cálculo; se algo falhar,
+        as _nova são descartadas e as métricas anteriores continuam valendo.
+        Com mais de uma tarefa (padrão: TAREFAS_METRICAS), as tabelas de cada
+        etapa de ETAPAS_METRICAS são montadas ao mesmo tempo; para isso
+        `origem` já precisa estar gravada (commit).
+        """
+        tarefas = tarefas or TAREFAS_METRICAS
+        cursor = conn.cursor()
+        try:
+            for tabela in TABELAS_METRICAS:
+                self._criar_tabela_nova(cursor, tabela)
+            conn.commit()
+            
+            for etapa in ETAPAS_METRICAS:
+                if tarefas > 1:
+                    self._montar_em_paralelo(conn, etapa, origem, tarefas)
+                else:
+                    for tabela in etapa:
+                        self._montar_derivada(conn, tabela, origem)
+                # As próximas etapas leem as _nova desta
+                conn.commit()
+            
+            self._trocar_tabelas(conn, trocar, frescor=TABELAS_METRICAS)
+        except Exception:
+            conn.rollback()
+            for tabela in trocar:
+                cursor.execute(f'DROP TABLE IF EXISTS {tabela}_nova')
+            conn.commit()
+            raise
+    
+    def _montar_derivada(self, conn, tabela, origem='vendas'):
+        """Preenche {tabela}_nova, uma das TABELAS_METRICAS, a partir de `origem`
         
-        # Atualizar produtos por cliente
-        self._update_cliente_produtos_v2(conn)
+        As tabelas de etapas anteriores são lidas das suas versões _nova.
+        """
+        cursor = conn.cursor()
+        if tabela == 'pedidos':
+            # Pedidos com os totais das linhas
+            self._montar_pedidos(cursor, origem=origem, destino='pedidos_nova')
+        elif tabela in RESUMOS_MENSAIS:
+            # Resumos mensais (total, por cliente e por produto)
+            self._montar_resumos_mensais(cursor, origem=origem, sufixo='_nova', tabelas=[tabela])
+        elif tabela == 'cliente_produtos_v2':
+            self._update_cliente_produtos_v2(conn, origem=origem, destino='cliente_produtos_v2_nova')
+        elif tabela == 'clientes_metricas_v2':
+            self._update_cliente_metrics_v2(conn, pedidos='pedidos_nova',
+                                            cliente_produtos='cliente_produtos_v2_nova',
+                                            produtos='produtos_metricas_v2_nova',
+                                            destino='clientes_metricas_v2_nova')
+        elif tabela == 'produtos_metricas_v2':
+            self._update_produto_metrics_v2(conn, origem=origem, destino='produtos_metricas_v2_nova')
+        else:
+            raise ValueError(f'Tabela derivada desconhecida: {tabela}')
+    
+    def _montar_em_paralelo(self, conn, tabelas, origem, tarefas):
+        """Monta `tabelas` ao mesmo tempo, cada uma num arquivo temporário, e
+        copia cada uma para a sua _nova assim que fica pronta
         
-        # Atualizar métricas de produtos
-        self._update_produto_metrics_v2(conn)
+        Cada thread monta a sua tabela por uma conexão própria
+        (_montar_em_arquivo); o sqlite3 solta o GIL enquanto a consulta roda,
+        então as agregações usam núcleos diferentes. Todas leem o mesmo estado
+        do banco: quem chama segura lock_escrita até a troca, e o escritor só
+        grava nas _nova.
+        """
+        pasta = tempfile.mkdtemp(prefix='metricas_', dir=Path(self.db_path).resolve().parent)
+        cursor = conn.cursor()
+        try:
+            with ThreadPoolExecutor(max_workers=min(tarefas, len(tabelas))) as executor:
+                montagens = {
+                    executor.submit(self._montar_em_arquivo, tabela, origem, pasta): tabela
+                    for tabela in tabelas
+                }
+                for montagem in as_completed(montagens):
+                    tabela = montagens[montagem]
+                    arquivo = montagem.result()
+                    # ATTACH não roda dentro de uma transação
+                    conn.commit()
+                    cursor.execute('ATTACH DATABASE ? AS montada', (arquivo,))
+                    try:
+                        cursor.execute(f'INSERT INTO main.{tabela}_nova SELECT * FROM montada.{tabela}_nova')
+                        conn.commit()
+                    finally:
+                        conn.rollback()
+                        cursor.execute('DETACH DATABASE montada')
+        finally:
+            shutil.rmtree(pasta, ignore_errors=True)
+    
+    def _montar_em_arquivo(self, tabela, origem, pasta):
+        """Monta {tabela}_nova num arquivo novo em `pasta`, com o banco anexado
+        somente leitura como `banco`; retorna o caminho do arquivo
         
-        conn.commit()
-        print("OK: Métricas atualizadas com códigos!")
+        Nas consultas sem esquema, o SQLite procura primeiro no arquivo novo:
+        o destino fica nele e o resto (origem, dimensões, _nova de etapas
+        anteriores) vem do banco.
+        """
+        arquivo = os.path.join(pasta, f'{tabela}.db')
+        conn = sqlite3.connect(Path(arquivo).as_uri(), uri=True)
+        try:
+            conn.execute('ATTACH DATABASE ? AS banco', (self.pool.uri_leitura,))
+            for nome, valor in PRAGMAS_MONTAGEM.items():
+                conn.execute(f'PRAGMA {nome} = {valor}')
+            garantir_raiz(conn)
+            conn.execute(TABELAS[tabela].format(tabela=f'{tabela}_nova'))
+            self._montar_derivada(conn, tabela, origem)
+            conn.commit()
+        finally:
+            conn.close()
+        return arquivo
     
-    def _update_cliente_metrics_v2(self, conn):
-        """Atualiza métricas agregadas de clientes usando código"""
+    def update_metrics_parcial(self, clientes_afetados, produtos_afetados):
+        """Recalcula as métricas só dos clientes e produtos informados
+        
+        clientes_afetados atualiza clientes_metricas_v2 e as
+        linhas de cliente_produtos_v2 desses clientes; produtos_afetados atualiza
+        produtos_metricas_v2 (com taxa_recompra). O resultado dessas linhas é o
+        mesmo de um update_metrics completo.
+        """
+        clientes_afetados = {cod for cod in clientes_afetados if cod}
+        produtos_afetados = {cod for cod in produtos_afetados if cod}
+        print(f"Atualizando métricas de {len(clientes_afetados)} clientes "
+              f"e {len(produtos_afetados)} produtos...")
+        with self.pool.lock_escrita:
+            conn = self.pool.escritor
+            cursor = conn.cursor()
+            
+            try:
+                # Chaves em tabelas temporárias para não depender do limite de parâmetros
+                cursor.execute('CREATE TEMP TABLE chaves_clientes (cod TEXT PRIMARY KEY)')
+                cursor.execute('CREATE TEMP TABLE chaves_produtos (cod TEXT PRIMARY KEY)')
+                cursor.executemany('INSERT INTO chaves_clientes VALUES (?)', [(c,) for c in clientes_afetados])
+                cursor.executemany('INSERT INTO chaves_produtos VALUES (?)', [(p,) for p in produtos_afetados])
+            
+                # Produtos antes: a categoria principal dos clientes lê a dos produtos
+                if produtos_afetados:
+                    self._update_produto_metrics_v2(conn, parcial=True)
+                if clientes_afetados:
+                    self._update_cliente_produtos_v2(conn, parcial=True)
+                    self._update_cliente_metrics_v2(conn, parcial=True)
+            
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.execute('DROP TABLE IF EXISTS temp.chaves_clientes')
+                cursor.execute('DROP TABLE IF EXISTS temp.chaves_produtos')
+            
+        print("OK: Métricas parciais atualizadas!")
+    
+    def _montar_pedidos(self, cursor, origem='vendas', destino='pedidos', filtro=''):
+        """Agrupa as linhas de `origem` em pedidos (n_venda, cliente) e grava em `destino`
+        
+        `filtro` restringe as linhas (ex.: só alguns n_venda) com um AND extra.
+        """
+        cursor.execute(f'''
+            INSERT INTO {destino} (
+                n_venda, cliente_id, data_dia, ano_mes, vendedor_id,
+                qtd_linhas, valor_bruto, desconto, total
+            )
+            SELECT
+                n_venda,
+                cliente_id,
+                MIN(data_dia),
+                MIN(ano_mes),
+                MIN(vendedor_id),
+                COUNT(*),
+                SUM(valor_bruto),
+                SUM(desconto),
+                SUM(total)
+            FROM {origem}
+            WHERE n_venda IS NOT NULL {filtro}
+            GROUP BY n_venda, cliente_id
+        ''')
+    
+    def _montar_resumos_mensais(self, cursor, origem='vendas', sufixo='', filtro='', tabelas=None):
+        """Agrupa as linhas de `origem` por mês em cada tabela de RESUMOS_MENSAIS
+        
+        `sufixo` escolhe o destino (ex.: '_nova' grava em vendas_mes_nova);
+        `filtro` restringe as linhas (ex.: só alguns meses) com um AND extra;
+        `tabelas` limita a montagem a alguns dos resumos.
+        Agrupar pelo mês primeiro deixa o SQLite ler vendas pelo índice do mês
+        em vez de percorrer um índice por cliente/produto e buscar cada linha.
+        """
+        for tabela, resumo in RESUMOS_MENSAIS.items():
+            if tabelas is not None and tabela not in tabelas:
+                continue
+            fonte = origem if resumo['origem'] == 'vendas' else resumo['origem'] + sufixo
+            agrupamento = ', '.join(filter(None, ['ano_mes', resumo['chave']]))
+            colunas = resumo['colunas']
+            cursor.execute(f'''
+                INSERT INTO {tabela}{sufixo} ({agrupamento}, {', '.join(colunas)})
+                SELECT {agrupamento}, {', '.join(colunas.values())}
+                FROM {fonte}
+                WHERE ano_mes IS NOT NULL {filtro}
+                GROUP BY {agrupamento}
+            ''')
+    
+    def _update_cliente_metrics_v2(self, conn, parcial=False, pedidos='pedidos',
+                                   cliente_produtos='cliente_produtos_v2',
+                                   produtos='produtos_metricas_v2',
+                                   destino='clientes_metricas_v2'):
+        """Atualiza métricas agregadas de clientes usando código
+        
+        Compras, valores e datas vêm de `pedidos` (ticket médio = valor médio
+        do pedido), os produtos únicos vêm das linhas do cliente em
+        `cliente_produtos` e a categoria principal é a de maior valor nessas
+        linhas, pela categoria de cada produto em `produtos`; as três
+        precisam estar atualizadas antes. Frequência, desvio e tendência saem
+        dos intervalos entre os dias de compra, com LAG sobre os dias
+        distintos de `pedidos` de todos os clientes numa consulta só.
+        Com parcial=True, só os clientes de temp.chaves_clientes.
+        
+        O custo da montagem completa está na categoria principal, que junta
+        e agrupa todas as linhas de `cliente_produtos`; por isso ela é lida
+        na ordem da tabela (NOT INDEXED), sem buscar cada linha pelo índice
+        de cliente. Os produtos únicos custam pouco: a subconsulta por
+        cliente só conta entradas desse índice.
+        """
         cursor = conn.cursor()
+        filtro = 'AND cod_parceiro IN (SELECT cod FROM chaves_clientes)' if parcial else ''
         
         # Limpar tabela
-        cursor.execute('DELETE FROM clientes_metricas_v2')
+        cursor.execute(f'DELETE FROM {destino} WHERE 1 = 1 {filtro}')
         
-        # Query para calcular métricas - AGORA AGRUPANDO POR CÓDIGO
+        # Query para calcular métricas - agrupa pela chave inteira e busca
+        # código e nome em dim_cliente
         query = '''
-        INSERT INTO clientes_metricas_v2 (
+        INSERT INTO {destino} (
             cod_parceiro, parceiro, total_compras, qtd_compras, ticket_medio,
-            primeira_compra, ultima_compra, dias_desde_ultima,
-            total_produtos_unicos
+            primeira_compra, ultima_compra, frequencia_media_dias, desvio_frequencia_dias,
+            total_produtos_unicos, categoria_principal, tendencia
         )
         SELECT 
-            cod_parceiro,
-            MAX(parceiro) as parceiro,  -- Pega o nome mais recente
-            SUM(total) as total_compras,
-            COUNT(DISTINCT n_venda) as qtd_compras,
-            AVG(total) as ticket_medio,
-            MIN(data) as primeira_compra,
-            MAX(data) as ultima_compra,
-            CAST(julianday('now') - julianday(MAX(data)) as INTEGER) as dias_desde_ultima,
-            COUNT(DISTINCT cod_produto) as total_produtos_unicos
-        FROM vendas
-        WHERE cod_parceiro IS NOT NULL AND cod_parceiro != ''
-        GROUP BY cod_parceiro
-        '''
-        
-        cursor.execute(query)
-        
-        # Atualizar segmentos
-        self._update_segmentos_v2(conn)
-    
-    def _update_segmentos_v2(self, conn):
-        """Classifica clientes em segmentos"""
-        df = pd.read_sql('''
-            SELECT cod_parceiro, parceiro, total_compras, qtd_compras, dias_desde_ultima
-            FROM clientes_metricas_v2
-        ''', conn)
-        
-        def classificar_cliente(row):
-            if row['qtd_compras'] >= 10 and row['dias_desde_ultima'] <= 30:
-                return 'VIP'
-            elif row['qtd_compras'] >= 5 and row['dias_desde_ultima'] <= 60:
-                return 'Fiel'
-            elif row['qtd_compras'] >= 3 and row['dias_desde_ultima'] <= 90:
-                return 'Regular'
-            elif row['dias_desde_ultima'] > 90:
-                return 'Inativo'
-            elif row['qtd_compras'] == 1 and row['dias_desde_ultima'] <= 30:
-                return 'Novo'
-            elif row['qtd_compras'] == 1:
-                return 'One-Shot'
-            elif row['dias_desde_ultima'] > 60:
-                return 'Em Risco'
-            else:
-                return 'Em Crescimento'
+            c.cod_parceiro,
+            c.parceiro,
+            v.total_compras,
+            v.qtd_compras,
+            v.ticket_medio,
+            {primeira} as primeira_compra,
+            {ultima} as ultima_compra,
+            f.frequencia_media_dias,
+            f.desvio_frequencia_dias,
+            (SELECT COUNT(*) FROM {cliente_produtos} cp
+             WHERE cp.cod_parceiro = c.cod_parceiro) as total_produtos_unicos,
+            k.categoria as categoria_principal,
+            CASE
+                WHEN f.intervalos <= {intervalos_tendencia} THEN NULL
+                WHEN f.frequencia_recente <= f.frequencia_media_dias * {alta} THEN 'Em alta'
+                WHEN f.frequencia_recente >= f.frequencia_media_dias * {queda} THEN 'Em queda'
+                ELSE 'Estável'
+            END as tendencia
+        FROM (
+            SELECT
+                cliente_id,
+                SUM(total) as total_compras,
+                COUNT(*) as qtd_compras,
+                AVG(total) as ticket_medio,
+                MIN(data_dia) as primeira_compra,
+                MAX(data_dia) as ultima_compra
+            FROM {pedidos}
+            WHERE cliente_id IN (SELECT id FROM dim_cliente WHERE cod_parceiro IS NOT NULL {filtro})
+            GROUP BY cliente_id
+        ) v
+        JOIN dim_cliente c ON c.id = v.cliente_id
+        LEFT JOIN (
+            SELECT
+                cliente_id,
+                COUNT(intervalo) as intervalos,
+                AVG(intervalo) as frequencia_media_dias,
+                sqrt(MAX(0, (SUM(intervalo * intervalo) - 1.0 * SUM(intervalo) * SUM(intervalo) / COUNT(intervalo))
+                            / (COUNT(intervalo) - 1))) as desvio_frequencia_dias,
+                AVG(CASE WHEN seguintes < {intervalos_tendencia} THEN intervalo END) as frequencia_recente
+            FROM (
+                SELECT
+                    cliente_id,
+                    data_dia - LAG(data_dia) OVER dias as intervalo,
+                    COUNT(*) OVER (PARTITION BY cliente_id) - ROW_NUMBER() OVER dias as seguintes
+                FROM (
+                    SELECT DISTINCT cliente_id, data_dia
+                    FROM {pedidos}
+                    WHERE data_dia IS NOT NULL
+                      AND cliente_id IN (SELECT id FROM dim_cliente WHERE cod_parceiro IS NOT NULL {filtro})
+                )
+                WINDOW dias AS (PARTITION BY cliente_id ORDER BY data_dia)
+            )
+            GROUP BY cliente_id
+        ) f ON f.cliente_id = v.cliente_id
+        LEFT JOIN (
+            SELECT cod_parceiro, categoria
+            FROM (
+                SELECT
+                    cp.cod_parceiro,
+                    p.categoria,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY cp.cod_parceiro ORDER BY SUM(cp.valor_total) DESC, p.categoria
+                    ) as ordem
+                FROM {cliente_produtos} cp {leitura}
+                JOIN categorias_produtos p ON p.cod_produto = cp.cod_produto
+                WHERE 1 = 1 {filtro}
+                GROUP BY cp.cod_parceiro, p.categoria
+            )
+            WHERE ordem = 1
+        ) k ON k.cod_parceiro = c.cod_parceiro
+        '''.format(destino=destino, pedidos=pedidos, cliente_produtos=cliente_produtos,
+                   leitura='' if parcial else 'NOT INDEXED', filtro=filtro,
+                   primeira=DATA_DO_DIA_SQL.format('v.primeira_compra'),
+                   ultima=DATA_DO_DIA_SQL.format('v.ultima_compra'),
+                   intervalos_tendencia=INTERVALOS_TENDENCIA,
+                   alta=TENDENCIA_ALTA, queda=TENDENCIA_QUEDA)
         
-        df['segmento'] = df.apply(classificar_cliente, axis=1)
-        
-        # Atualizar banco
-        cursor = conn.cursor()
-        for _, row in df.iterrows():
-            cursor.execute('''
-                UPDATE clientes_metricas_v2 
-                SET segmento = ? 
-                WHERE cod_parceiro = ?
-            ''', (row['segmento'], row['cod_parceiro']))
+        # Categoria de cada produto numa tabela WITHOUT ROWID: uma busca por
+        # linha de cliente_produtos, em vez de índice + tabela em `produtos`
+        cursor.execute('''
+            CREATE TEMP TABLE categorias_produtos (cod_produto TEXT PRIMARY KEY, categoria TEXT) WITHOUT ROWID
+        ''')
+        try:
+            cursor.execute(f'INSERT INTO categorias_produtos SELECT cod_produto, categoria FROM {produtos}')
+            cursor.execute(query)
+        finally:
+            cursor.execute('DROP TABLE IF EXISTS temp.categorias_produtos')
     
-    def _update_cliente_produtos_v2(self, conn):
-        """Atualiza produtos comprados por cada cliente usando códigos"""
+    def _update_cliente_produtos_v2(self, conn, parcial=False, origem='vendas',
+                                    destino='cliente_produtos_v2'):
+        """Atualiza produtos comprados por cada cliente usando códigos
+        
+        frequencia_compra_dias é o intervalo médio entre os dias em que o
+        cliente comprou o produto: a média das diferenças entre dias seguidos
+        é (último - primeiro) / (dias distintos - 1).
+        Com parcial=True, só as linhas dos clientes de temp.chaves_clientes.
+        """
         cursor = conn.cursor()
+        filtro = 'AND cod_parceiro IN (SELECT cod FROM chaves_clientes)' if parcial else ''
         
         # Limpar tabela
-        cursor.execute('DELETE FROM cliente_produtos_v2')
+        cursor.execute(f'DELETE FROM {destino} WHERE 1 = 1 {filtro}')
         
-        # Query para agregar produtos por cliente - COM CÓDIGOS
+        # Query para agregar produtos por cliente - pelas chaves inteiras
         query = '''
-        INSERT INTO cliente_produtos_v2 (
+        INSERT INTO {destino} (
             cod_parceiro, parceiro, cod_produto, produto, 
             quantidade_total, valor_total,
-            qtd_compras, primeira_compra, ultima_compra, dias_desde_ultima
+            qtd_compras, primeira_compra, ultima_compra, frequencia_compra_dias
         )
         SELECT 
-            cod_parceiro,
-            MAX(parceiro) as parceiro,
-            cod_produto,
-            MAX(produto) as produto,
-            SUM(quantidade) as quantidade_total,
-            SUM(total) as valor_total,
-            COUNT(*) as qtd_compras,
-            MIN(data) as primeira_compra,
-            MAX(data) as ultima_compra,
-            CAST(julianday('now') - julianday(MAX(data)) as INTEGER) as dias_desde_ultima
-        FROM vendas
-        WHERE cod_parceiro IS NOT NULL AND cod_parceiro != ''
-            AND cod_produto IS NOT NULL AND cod_produto != ''
-        GROUP BY cod_parceiro, cod_produto
-        '''
+            c.cod_parceiro,
+            c.parceiro,
+            p.cod_produto,
+            p.produto,
+            v.quantidade_total,
+            v.valor_total,
+            v.qtd_compras,
+            {primeira} as primeira_compra,
+            {ultima} as ultima_compra,
+            1.0 * (v.ultima_compra - v.primeira_compra) / NULLIF(v.dias_compra - 1, 0) as frequencia_compra_dias
+        FROM (
+            SELECT
+                cliente_id,
+                produto_id,
+                SUM(quantidade) as quantidade_total,
+                SUM(total) as valor_total,
+                COUNT(*) as qtd_compras,
+                MIN(data_dia) as primeira_compra,
+                MAX(data_dia) as ultima_compra,
+                COUNT(DISTINCT data_dia) as dias_compra
+            FROM {origem}
+            WHERE cliente_id IN (SELECT id FROM dim_cliente WHERE cod_parceiro IS NOT NULL {filtro})
+            GROUP BY cliente_id, produto_id
+        ) v
+        JOIN dim_cliente c ON c.id = v.cliente_id
+        JOIN dim_produto p ON p.id = v.produto_id AND p.cod_produto IS NOT NULL
+        '''.format(destino=destino, origem=origem, filtro=filtro,
+                   primeira=DATA_DO_DIA_SQL.format('v.primeira_compra'),
+                   ultima=DATA_DO_DIA_SQL.format('v.ultima_compra'))
         
         cursor.execute(query)
     
-    def _update_produto_metrics_v2(self, conn):
-        """Atualiza métricas de produtos usando códigos"""
+    def _update_produto_metrics_v2(self, conn, parcial=False, origem='vendas',
+                                   destino='produtos_metricas_v2'):
+        """Atualiza métricas de produtos usando códigos
+        
+        A taxa de recompra (% dos clientes do produto que o compraram mais de
+        uma vez) sai na mesma consulta, de um agrupamento por produto e cliente,
+        e a categoria, das palavras do nome (CATEGORIAS).
+        Com parcial=True, só os produtos de temp.chaves_produtos.
+        """
         cursor = conn.cursor()
+        filtro = 'AND cod_produto IN (SELECT cod FROM chaves_produtos)' if parcial else ''
         
         # Limpar tabela
-        cursor.execute('DELETE FROM produtos_metricas_v2')
+        cursor.execute(f'DELETE FROM {destino} WHERE 1 = 1 {filtro}')
         
-        # Query para calcular métricas - COM CÓDIGOS
+        # Query para calcular métricas - pela chave inteira, com código e
+        # nome de dim_produto
         query = '''
-        INSERT INTO produtos_metricas_v2 (
+        INSERT INTO {destino} (
             cod_produto, produto, quantidade_vendida, valor_total, qtd_vendas,
-            clientes_unicos, ticket_medio, margem_media,
-            primeira_venda, ultima_venda, dias_desde_ultima
+            clientes_unicos, ticket_medio, taxa_recompra, margem_media,
+            primeira_venda, ultima_venda, categoria
         )
         SELECT 
-            cod_produto,
-            MAX(produto) as produto,
-            SUM(quantidade) as quantidade_vendida,
-            SUM(total) as valor_total,
-            COUNT(*) as qtd_vendas,
-            COUNT(DISTINCT cod_parceiro) as clientes_unicos,
-            AVG(total) as ticket_medio,
-            AVG(CASE 
-                WHEN preco_base > 0 THEN ((preco_final - preco_base) / preco_base * 100)
-                ELSE 0 
-            END) as margem_media,
-            MIN(data) as primeira_venda,
-            MAX(data) as ultima_venda,
-            CAST(julianday('now') - julianday(MAX(data)) as INTEGER) as dias_desde_ultima
-        FROM vendas
-        WHERE cod_produto IS NOT NULL AND cod_produto != ''
-        GROUP BY cod_produto
-        '''
+            p.cod_produto,
+            p.produto,
+            v.quantidade_vendida,
+            v.valor_total,
+            v.qtd_vendas,
+            v.clientes_unicos,
+            v.ticket_medio,
+            r.taxa_recompra,
+            v.margem_media,
+            {primeira} as primeira_venda,
+            {ultima} as ultima_venda,
+            {categoria} as categoria
+        FROM (
+            SELECT
+                produto_id,
+                SUM(quantidade) as quantidade_vendida,
+                SUM(total) as valor_total,
+                COUNT(*) as qtd_vendas,
+                COUNT(DISTINCT cod_parceiro) as clientes_unicos,
+                AVG(total) as ticket_medio,
+                AVG(CASE 
+                    WHEN preco_base > 0 THEN ((preco_final - preco_base) / preco_base * 100)
+                    ELSE 0 
+                END) as margem_media,
+                MIN(data_dia) as primeira_venda,
+                MAX(data_dia) as ultima_venda
+            FROM {origem}
+            WHERE produto_id IN (SELECT id FROM dim_produto WHERE cod_produto IS NOT NULL {filtro})
+            GROUP BY produto_id
+        ) v
+        JOIN dim_produto p ON p.id = v.produto_id
+        JOIN (
+            SELECT produto_id, 100.0 * SUM(compras > 1) / COUNT(*) as taxa_recompra
+            FROM (
+                SELECT produto_id, cliente_id, COUNT(*) as compras
+                FROM {origem}
+                WHERE produto_id IN (SELECT id FROM dim_produto WHERE cod_produto IS NOT NULL {filtro})
+                GROUP BY produto_id, cliente_id
+            )
+            GROUP BY produto_id
+        ) r ON r.produto_id = v.produto_id
+        '''.format(destino=destino, origem=origem, filtro=filtro,
+                   primeira=DATA_DO_DIA_SQL.format('v.primeira_venda'),
+                   ultima=DATA_DO_DIA_SQL.format('v.ultima_venda'),
+                   categoria=categoria_sql('p.produto'))
         
         cursor.execute(query)
-        
-        # Calcular taxa de recompra
-        df_recompra = pd.read_sql('''
-            SELECT cod_produto, cod_parceiro, COUNT(*) as compras
-            FROM vendas
-            GROUP BY cod_produto, cod_parceiro
-        ''', conn)
-        
-        taxa_recompra = df_recompra.groupby('cod_produto')['compras'].apply(
-            lambda x: (x > 1).mean() * 100
-        ).reset_index()
-        taxa_recompra.columns = ['cod_produto', 'taxa_recompra']
-        
-        # Atualizar taxas de recompra
-        for _, row in taxa_recompra.iterrows():
-            cursor.execute('''
-                UPDATE produtos_metricas_v2 
-                SET taxa_recompra = ? 
-                WHERE cod_produto = ?
-            ''', (row['taxa_recompra'], row['cod_produto']))
     
     def get_cliente_data_v2(self, cod_parceiro=None):
         """Retorna dados de clientes com código"""
         conn = self.connect()
         
-        # Primeiro, garantir que as tabelas v2 estejam atualizadas
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM clientes_metricas_v2")
-        if cursor.fetchone()[0] == 0:
-            self.update_metrics()
-        
+        # As métricas são montadas pelas MIGRACOES e a cada importação, nunca
+        # numa leitura (ver situacao_metricas); a recência e o segmento saem
+        # da data de referência
         if cod_parceiro:
             query = '''
                 SELECT * FROM clientes_metricas_v2
                 WHERE cod_parceiro = ?
             '''
-            return pd.read_sql(query, conn, params=[cod_parceiro])
+            clientes = pd.read_sql(query, conn, params=[cod_parceiro])
         else:
-            return pd.read_sql('SELECT * FROM clientes_metricas_v2 ORDER BY total_compras DESC', conn)
+            clientes = pd.read_sql('SELECT * FROM clientes_metricas_v2 ORDER BY total_compras DESC', conn)
+        return self.aplicar_referencia(clientes, 'clientes_metricas_v2')
     
     def get_produtos_cliente_v2(self, cod_parceiro):
         """Retorna produtos comprados por um cliente com códigos"""
@@ -297,30 +2149,70 @@ class DatabaseManager:
             WHERE cod_parceiro = ?
             ORDER BY valor_total DESC
         '''
-        return pd.read_sql(query, conn, params=[cod_parceiro])
+        produtos = pd.read_sql(query, conn, params=[cod_parceiro])
+        return self.aplicar_referencia(produtos, 'cliente_produtos_v2')
     
     def get_produto_data_v2(self):
         """Retorna dados de produtos com códigos"""
         conn = self.connect()
+        produtos = pd.read_sql('SELECT * FROM produtos_metricas_v2 ORDER BY valor_total DESC', conn)
+        return self.aplicar_referencia(produtos, 'produtos_metricas_v2')
+    
+    def buscar_clientes(self, termo, limite=20):
+        """Clientes com código cujo código ou nome contém todas as palavras de `termo`
         
-        # Garantir que as tabelas estejam atualizadas
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM produtos_metricas_v2")
-        if cursor.fetchone()[0] == 0:
-            self.update_metrics()
-            
-        return pd.read_sql('SELECT * FROM produtos_metricas_v2 ORDER BY valor_total DESC', conn)
+        Retorna até `limite` linhas (cod_parceiro, parceiro): código igual ao
+        termo primeiro, depois código e nome que começam por ele.
+        """
+        return self._buscar('busca_cliente', termo, limite)
+    
+    def buscar_produtos(self, termo, limite=20):
+        """Produtos com código cujo código ou nome contém todas as palavras de
+        `termo` (cod_produto, produto); ver buscar_clientes"""
+        return self._buscar('busca_produto', termo, limite)
+    
+    def _buscar(self, indice, termo, limite):
+        dim = DIMENSOES[BUSCAS[indice]]
+        codigo, nome = dim['codigo'], dim['nome']
+        palavras = (termo or '').split()
+        longas = [p for p in palavras if len(p) >= LETRAS_TRIGRAMA] if self.tem_recurso('busca') else []
+        
+        origem = f"{dim['tabela']} d"
+        condicoes, params = [f'd.{codigo} IS NOT NULL'], []
+        if longas:
+            # Cada palavra entre aspas (frase do FTS5), todas obrigatórias
+            origem = f"{indice} b JOIN {dim['tabela']} d ON d.id = b.rowid"
+            condicoes.append(f'{indice} MATCH ?')
+            params.append(' '.join('"{}"'.format(p.replace('"', '""')) for p in longas))
+        for palavra in palavras:
+            if palavra in longas:
+                continue
+            condicoes.append(f"(d.{codigo} || ' ' || COALESCE(d.{nome}, '')) LIKE ? ESCAPE '\\'")
+            params.append(f'%{escapar_like(palavra)}%')
+        
+        termo = (termo or '').strip()
+        prefixo = f'{escapar_like(termo)}%'
+        query = f'''
+            SELECT d.{codigo}, d.{nome}
+            FROM {origem}
+            WHERE {' AND '.join(condicoes)}
+            ORDER BY d.{codigo} = ? DESC, d.{codigo} LIKE ? ESCAPE '\\' DESC,
+                     d.{nome} LIKE ? ESCAPE '\\' DESC, d.{nome}, d.{codigo}
+            LIMIT ?
+        '''
+        params += [termo, prefixo, prefixo, limite]
+        return pd.read_sql(query, self.connect(), params=params)
     
     def get_vendas_raw(self):
-        """Retorna dados brutos de vendas"""
+        """Retorna dados brutos de vendas, com a data já convertida do número do dia"""
         conn = self.connect()
-        return pd.read_sql('SELECT * FROM vendas', conn)
+        vendas = pd.read_sql('SELECT * FROM vendas_detalhe', conn)
+        vendas.insert(vendas.columns.get_loc('data_dia'), 'data', datas_dos_dias(vendas['data_dia']))
+        return vendas
     
     def close(self):
-        """Fecha conexão com banco"""
-        if self.conn:
-            self.conn.close()
-            self.conn = None
+        """Fecha a conexão de leitura desta thread (o escritor fica com o pool)"""
+        self.pool.fechar_leitor()
 
 # Compatibilidade com código antigo
 DatabaseManager.get_cliente_data = DatabaseManager.get_cliente_data_v2
@@ -0,0 +1,307 @@
+"""
+Esquema das colunas do CSV do ERP e conversão vetorizada para a tabela vendas
+
+Também lê os arquivos (CSV ou planilha XLSX) já convertidos; as funções de
+leitura ficam no nível do módulo para rodar nos processos do import paralelo.
+"""
+import hashlib
+import pickle
+import re
+import unicodedata
+from datetime import date, datetime
+from pathlib import Path
+import pandas as pd
+
+# Esquema declarativo: para cada coluna de vendas, os cabeçalhos aceitos no
+# arquivo do ERP (já normalizados), trechos usados como último recurso quando
+# nenhum cabeçalho bate exatamente, e o tipo de conversão aplicado
+ESQUEMA_VENDAS = [
+    {'coluna': 'n_venda', 'tipo': 'texto',
+     'aliases': ['n venda', 'no venda', 'numero venda', 'n da venda'],
+     'contem': [('venda', 'n')]},
+    {'coluna': 'data_dia', 'tipo': 'data',
+     'aliases': ['data', 'data venda', 'data da venda'],
+     'contem': []},
+    {'coluna': 'produto', 'tipo': 'texto',
+     'aliases': ['produto classificacao', 'produto classificao', 'produto'],
+     'contem': [('produto', 'classifica')]},
+    {'coluna': 'cod_produto', 'tipo': 'texto',
+     'aliases': ['classificacao', 'classificao', 'cod produto', 'codigo produto'],
+     'contem': [('class',)]},
+    {'coluna': 'quantidade', 'tipo': 'numero',
+     'aliases': ['quantidade', 'qtd', 'qtde'],
+     'contem': []},
+    {'coluna': 'preco_unitario', 'tipo': 'numero',
+     'aliases': ['preco unitario', 'preo unitario'],
+     'contem': [('unitario',)]},
+    {'coluna': 'valor_bruto', 'tipo': 'numero',
+     'aliases': ['valor bruto'],
+     'contem': [('valor bruto',)]},
+    {'coluna': 'unidade_medida', 'tipo': 'texto',
+     'aliases': ['unidade medida', 'unidade de medida'],
+     'contem': []},
+    {'coluna': 'qtd_un_medida', 'tipo': 'numero',
+     'aliases': ['qtd un medida', 'qtd un'],
+     'contem': [('qtd un',)]},
+    {'coluna': 'valor', 'tipo': 'numero',
+     'aliases': ['valor'],
+     'contem': []},
+    {'coluna': 'desconto', 'tipo': 'numero',
+     'aliases': ['desconto'],
+     'contem': []},
+    {'coluna': 'acrescimo', 'tipo': 'numero',
+     'aliases': ['acrescimo', 'acrscimo'],
+     'contem': [('acr', 'scimo')]},
+    {'coluna': 'total', 'tipo': 'numero',
+     'aliases': ['total'],
+     'contem': []},
+    {'coluna': 'cod_vendedor', 'tipo': 'texto',
+     'aliases': ['vendedor', 'cod vendedor'],
+     'contem': []},
+    {'coluna': 'nome_vendedor', 'tipo': 'texto',
+     'aliases': ['nome vendedor'],
+     'contem': []},
+    {'coluna': 'ref_fabrica', 'tipo': 'texto',
+     'aliases': ['ref fabrica', 'ref fbrica'],
+     'contem': [('ref', 'brica')]},
+    {'coluna': 'cod_parceiro', 'tipo': 'texto',
+     'aliases': ['cod', 'cd', 'cod parceiro', 'codigo parceiro'],
+     'contem': []},
+    {'coluna': 'parceiro', 'tipo': 'texto',
+     'aliases': ['parceiro'],
+     'contem': []},
+    {'coluna': 'preco_final', 'tipo': 'numero',
+     'aliases': ['preco final', 'preo final'],
+     'contem': [('final',)]},
+    {'coluna': 'preco_base', 'tipo': 'numero',
+     'aliases': ['preco base', 'preo base'],
+     'contem': [('base',)]},
+    {'coluna': 'obs', 'tipo': 'texto',
+     'aliases': ['obs', 'observacao'],
+     'contem': []},
+    {'coluna': 'marca', 'tipo': 'texto',
+     'aliases': ['marca'],
+     'contem': []},
+]
+
+# Colunas calculadas na conversão a partir de outra coluna já convertida
+COLUNAS_DERIVADAS = {
+    'ano_mes': 'data_dia',
+}
+
+COLUNAS_VENDAS = [item['coluna'] for item in ESQUEMA_VENDAS] + list(COLUNAS_DERIVADAS)
+
+# Datas são gravadas como número do dia, contado a partir desta data
+EPOCA = pd.Timestamp('1970-01-01')
+
+EXTENSOES_PLANILHA = ('.xlsx', '.xlsm')
+
+
+def normalizar_cabecalho(nome):
+    """Remove acentos, pontuação e caracteres corrompidos do cabeçalho"""
+    nome = str(nome).replace('�', '')
+    nome = unicodedata.normalize('NFKD', nome)
+    nome = ''.join(c for c in nome if not unicodedata.combining(c))
+    nome = re.sub(r'[^a-z0-9]+', ' ', nome.lower())
+    return nome.strip()
+
+
+def calcular_hash_arquivo(caminho, tamanho_bloco=1024 * 1024):
+    """SHA-256 do arquivo, lido em blocos para não carregá-lo inteiro na memória"""
+    sha = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(tamanho_bloco), b''):
+            sha.update(bloco)
+    return sha.hexdigest()
+
+
+def combinar_hashes(hashes):
+    """Identidade de um lote de arquivos; um arquivo sozinho mantém o seu hash"""
+    if len(hashes) == 1:
+        return hashes[0]
+    return hashlib.sha256('\n'.join(sorted(hashes)).encode()).hexdigest()
+
+
+def blocos_arquivo(caminho, chunksize=50000):
+    """Gera (conversor, bloco convertido) para um arquivo do ERP
+
+    CSV é lido em blocos de `chunksize` linhas; planilhas vêm num bloco só.
+    """
+    if Path(caminho).suffix.lower() in EXTENSOES_PLANILHA:
+        leitor = [ler_planilha(caminho)]
+    else:
+        # Tudo como texto: a conversão é feita por coluna em cada bloco
+        leitor = pd.read_csv(caminho, encoding='latin-1', sep=';', dtype=str,
+                             keep_default_na=False, chunksize=chunksize)
+
+    conversor = None
+    for bloco in leitor:
+        if conversor is None:
+            # Esquema resolvido uma vez a partir do cabeçalho
+            conversor = ConversorVendas(bloco.columns)
+        yield conversor, conversor.converter(bloco)
+
+
+def converter_arquivo(caminho, destino, chunksize=50000):
+    """Lê e converte um arquivo, gravando os blocos convertidos em `destino`
+
+    Usada pelos processos do import paralelo: os blocos vão para o disco, um
+    depois do outro, em vez de voltarem ao processo principal como um
+    DataFrame só. Retorna o conversor, ou None se não houver linhas.
+    """
+    conversor = None
+    with open(destino, 'wb') as arquivo:
+        for conversor, bloco in blocos_arquivo(caminho, chunksize):
+            pickle.dump(bloco, arquivo, protocol=pickle.HIGHEST_PROTOCOL)
+    return conversor
+
+
+def ler_blocos_convertidos(origem):
+    """Gera, um de cada vez, os blocos gravados por converter_arquivo"""
+    with open(origem, 'rb') as arquivo:
+        while True:
+            try:
+                yield pickle.load(arquivo)
+            except EOFError:
+                return
+
+
+def ler_planilha(caminho):
+    """Lê a planilha XLSX como texto no mesmo formato do CSV do ERP
+
+    Células numéricas e de data chegam tipadas do openpyxl e são escritas como
+    no CSV (vírgula decimal, dd/mm/aaaa) para passar pela mesma conversão.
+    """
+    planilha = pd.read_excel(caminho, engine='openpyxl', dtype=object)
+    return planilha.apply(lambda serie: serie.map(_texto_celula))
+
+
+def _texto_celula(valor):
+    if valor is None or (isinstance(valor, float) and pd.isna(valor)):
+        return ''
+    if isinstance(valor, (datetime, date)):
+        return valor.strftime('%d/%m/%Y')
+    if isinstance(valor, bool):
+        return str(valor)
+    if isinstance(valor, (int, float)):
+        if float(valor).is_integer():
+            return str(int(valor))
+        return repr(float(valor)).replace('.', ',')
+    return str(valor)
+
+
+class ConversorVendas:
+    """Esquema compilado para os cabeçalhos de um arquivo do ERP
+
+    O mapeamento cabeçalho -> coluna é resolvido uma única vez no construtor;
+    `converter` aplica os tipos a blocos inteiros com operações vetorizadas e
+    acumula em `contagens` quantas células vieram vazias ou inválidas.
+    """
+
+    def __init__(self, cabecalhos, esquema=ESQUEMA_VENDAS):
+        self.mapeamento = {}
+        self.tipos = {item['coluna']: item['tipo'] for item in esquema}
+
+        normalizados = {cab: normalizar_cabecalho(cab) for cab in cabecalhos}
+
+        # Primeiro os nomes exatos, depois os trechos (mesma ordem do esquema)
+        for item in esquema:
+            for cab, norm in normalizados.items():
+                if cab not in self.mapeamento and norm in item['aliases']:
+                    self.mapeamento[cab] = item['coluna']
+                    break
+
+        for item in esquema:
+            if item['coluna'] in self.mapeamento.values():
+                continue
+            for cab, norm in normalizados.items():
+                if cab in self.mapeamento:
+                    continue
+                if any(all(trecho in norm for trecho in regra) for regra in item['contem']):
+                    self.mapeamento[cab] = item['coluna']
+                    break
+
+        lidas = list(self.mapeamento.values())
+        derivadas = [coluna for coluna, origem in COLUNAS_DERIVADAS.items() if origem in lidas]
+        ordem = {coluna: i for i, coluna in enumerate(COLUNAS_VENDAS)}
+        self.colunas = sorted(lidas + derivadas, key=lambda c: ordem.get(c, len(ordem)))
+        self.ignoradas = [cab for cab in cabecalhos if cab not in self.mapeamento]
+        self.ausentes = [c for c in COLUNAS_VENDAS if c not in self.colunas]
+        self.contagens = {coluna: {'vazios': 0, 'invalidos': 0} for coluna in lidas}
+
+    def converter(self, bloco):
+        """Converte um bloco lido como texto para os tipos da tabela vendas"""
+        bloco = bloco[list(self.mapeamento)].rename(columns=self.mapeamento)
+        resultado = {}
+
+        for coluna in self.contagens:
+            tipo = self.tipos[coluna]
+            conversao = CONVERSOES.get(tipo, _converter_texto)
+            convertida, vazios, invalidos = _converter_por_valores_unicos(bloco[coluna], conversao)
+
+            self.contagens[coluna]['vazios'] += int(vazios)
+            self.contagens[coluna]['invalidos'] += int(invalidos)
+            resultado[coluna] = convertida
+
+        if 'ano_mes' in self.colunas:
+            resultado['ano_mes'] = _ano_mes(resultado['data_dia'])
+
+        # Números já vêm sem NaN, texto com None e dias com NaN, que viram NULL no banco
+        return pd.DataFrame(resultado, index=bloco.index)
+
+    def resumo(self):
+        """Contagens de conversão e colunas não reconhecidas do arquivo"""
+        return {
+            'colunas': self.contagens,
+            'colunas_ignoradas': self.ignoradas,
+            'colunas_ausentes': self.ausentes
+        }
+
+
+def _converter_por_valores_unicos(serie, conversao):
+    """Converte só os valores distintos da coluna e espalha o resultado
+
+    Datas, códigos e valores se repetem muito no arquivo do ERP, então a
+    conversão vetorizada roda sobre poucos milhares de valores por bloco.
+    """
+    codigos, unicos = pd.factorize(serie.fillna(''))
+    convertida, vazio, invalido = conversao(pd.Series(unicos, dtype=object))
+    valores = pd.Series(convertida.to_numpy()[codigos], index=serie.index)
+    return valores, vazio.to_numpy()[codigos].sum(), invalido.to_numpy()[codigos].sum()
+
+
+def _converter_numero(serie):
+    """Valores no formato brasileiro ('R$ 1.234,56'); vazios e inválidos viram 0"""
+    texto = serie.str.replace(r'R\$|\s|\.', '', regex=True).str.replace(',', '.', regex=False)
+    vazio = texto.isna() | (texto == '')
+    numeros = pd.to_numeric(texto.where(~vazio), errors='coerce')
+    invalido = numeros.isna() & ~vazio
+    return numeros.fillna(0.0), vazio, invalido
+
+
+def _converter_data(serie):
+    """Datas dd/mm/aaaa viram o número do dia desde EPOCA (NaN se vazia ou inválida)"""
+    texto = serie.str.strip()
+    vazio = texto.isna() | (texto == '')
+    datas = pd.to_datetime(texto.where(~vazio), format='%d/%m/%Y', errors='coerce')
+    invalido = datas.isna() & ~vazio
+    return (datas - EPOCA).dt.days, vazio, invalido
+
+
+def _ano_mes(dias):
+    """Chave AAAAMM do mês de cada número de dia"""
+    datas = EPOCA + pd.to_timedelta(dias, unit='D')
+    return datas.dt.year * 100 + datas.dt.month
+
+
+def _converter_texto(serie):
+    """Texto mantido como veio do ERP; célula vazia vira NULL"""
+    vazio = serie.isna() | (serie == '')
+    return serie.where(~vazio, None), vazio, pd.Series(False, index=serie.index)
+
+
+CONVERSOES = {
+    'numero': _converter_numero,
+    'data': _converter_data,
+    'texto': _converter_texto,
+}
@@ -0,0 +1,219 @@
+"""
+Monitor da pasta de uploads: importa automaticamente os arquivos do ERP
+
+Arquivos CSV/XLSX deixados em data/uploads (só o nível de cima da pasta) são
+importados quando param de crescer, em lotes de até `max_arquivos`, e depois
+movidos para data/uploads/processados/AAAA-MM-DD (ou data/uploads/erros, com
+o motivo num .erro.txt ao lado).
+
+Roda como processo próprio:
+
+    python monitor_uploads.py [--uma-vez]
+
+ou é iniciado pelo startup.py em segundo plano quando MONITOR_UPLOADS=1.
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+from db_manager_v2 import DatabaseManager, banco_padrao
+from importacao import EXTENSOES_PLANILHA
+
+PASTA_UPLOADS = Path('data/uploads')
+
+EXTENSOES_ACEITAS = ('.csv',) + EXTENSOES_PLANILHA
+
+# Arquivo precisa ficar este tempo sem mudar de tamanho/data para ser lido
+ESTABILIDADE_SEGUNDOS = 30
+
+
+class MonitorUploads:
+    """Varre a pasta de uploads e importa os arquivos completos
+
+    Um arquivo é considerado completo quando tamanho e data de modificação
+    não mudaram entre duas varreduras e a última escrita foi há pelo menos
+    `estabilidade` segundos. Cada lote passa por import_arquivos, que lê os
+    arquivos em até `processos` processos; os lotes rodam um de cada vez.
+    """
+
+    def __init__(self, db_path, pasta=PASTA_UPLOADS, modo='incremental', intervalo=10,
+                 estabilidade=ESTABILIDADE_SEGUNDOS, max_arquivos=12, processos=2):
+        self.db_path = db_path
+        self.pasta = Path(pasta)
+        self.modo = modo
+        self.intervalo = intervalo
+        self.estabilidade = estabilidade
+        self.max_arquivos = max_arquivos
+        self.processos = processos
+
+        self.pasta_processando = self.pasta / 'processando'
+        self.pasta_processados = self.pasta / 'processados'
+        self.pasta_erros = self.pasta / 'erros'
+
+        # Última (tamanho, data) vista de cada arquivo
+        self._vistos = {}
+
+    def arquivos_prontos(self):
+        """Arquivos do nível de cima da pasta que já terminaram de ser gravados"""
+        self.pasta.mkdir(parents=True, exist_ok=True)
+        agora = time.time()
+        prontos = []
+        atuais = {}
+
+        for caminho in sorted(self.pasta.iterdir()):
+            if not caminho.is_file() or caminho.suffix.lower() not in EXTENSOES_ACEITAS:
+                continue
+            # Temporários do Excel (~$) e arquivos ocultos
+            if caminho.name.startswith(('.', '~$')):
+                continue
+
+            try:
+                estado = caminho.stat()
+            except FileNotFoundError:
+                continue
+            if estado.st_size == 0:
+                continue
+            assinatura = (estado.st_size, estado.st_mtime)
+            atuais[caminho] = assinatura
+
+            if self._vistos.get(caminho) == assinatura and agora - estado.st_mtime >= self.estabilidade:
+                prontos.append(caminho)
+
+        self._vistos = atuais
+        return prontos
+
+    def processar(self, prontos):
+        """Importa os arquivos prontos em lotes e arquiva cada um"""
+        for i in range(0, len(prontos), self.max_arquivos):
+            self._importar_lote(prontos[i:i + self.max_arquivos])
+
+    def _importar_lote(self, lote):
+        # Tirados da pasta antes da importação para não serem vistos de novo
+        self.pasta_processando.mkdir(parents=True, exist_ok=True)
+        em_processo = []
+        for caminho in lote:
+            destino = self.pasta_processando / caminho.name
+            shutil.move(str(caminho), str(destino))
+            self._vistos.pop(caminho, None)
+            em_processo.append(destino)
+
+        self._importar(em_processo)
+
+    def _importar(self, arquivos):
+        print(f"[monitor] Importando {len(arquivos)} arquivo(s): "
+              f"{', '.join(c.name for c in arquivos)}")
+
+        db = DatabaseManager(self.db_path)
+        try:
+            resultado = db.import_arquivos([str(c) for c in arquivos], modo=self.modo,
+                                           processos=self.processos)
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                self._arquivar_erro(arquivos, traceback.format_exc())
+                return
+            # Banco ocupado por outra importação: devolve à pasta para a próxima varredura
+            print(f"[monitor] Banco ocupado ({e}); nova tentativa na próxima varredura")
+            for caminho in arquivos:
+                shutil.move(str(caminho), str(self.pasta / caminho.name))
+            return
+        except Exception:
+            if len(arquivos) == 1:
+                self._arquivar_erro(arquivos, traceback.format_exc())
+                return
+            # Um arquivo ruim não segura os outros: nova tentativa, um por vez
+            print("[monitor] Erro no lote; importando arquivo por arquivo")
+            for caminho in arquivos:
+                self._importar([caminho])
+            return
+        finally:
+            db.close()
+
+        if resultado.get('ignorado'):
+            print("[monitor] Arquivos idênticos a importações anteriores; nada alterado")
+        else:
+            print(f"[monitor] OK: {resultado['linhas']} linhas, {resultado['inseridas']} inseridas, "
+                  f"{resultado['atualizadas']} atualizadas")
+
+        arquivo_dia = self.pasta_processados / datetime.now().strftime('%Y-%m-%d')
+        arquivo_dia.mkdir(parents=True, exist_ok=True)
+        for caminho in arquivos:
+            shutil.move(str(caminho), str(_destino_livre(arquivo_dia / caminho.name)))
+
+    def _arquivar_erro(self, arquivos, detalhe):
+        print(f"[monitor] ERRO ao importar: {detalhe}")
+        self.pasta_erros.mkdir(parents=True, exist_ok=True)
+        for caminho in arquivos:
+            destino = _destino_livre(self.pasta_erros / caminho.name)
+            shutil.move(str(caminho), str(destino))
+            destino.with_name(destino.name + '.erro.txt').write_text(detalhe, encoding='utf-8')
+
+    def recuperar_interrompidos(self):
+        """Devolve à pasta os arquivos de um lote interrompido (processo encerrado no meio)"""
+        if not self.pasta_processando.exists():
+            return
+        for caminho in self.pasta_processando.iterdir():
+            if caminho.is_file():
+                print(f"[monitor] Retomando {caminho.name}")
+                shutil.move(str(caminho), str(self.pasta / caminho.name))
+
+    def executar(self, uma_vez=False):
+        """Laço principal; com uma_vez=True sai quando não houver mais arquivos na pasta"""
+        print(f"[monitor] Observando {self.pasta} (modo {self.modo}, a cada {self.intervalo}s)")
+        self.recuperar_interrompidos()
+
+        while True:
+            try:
+                prontos = self.arquivos_prontos()
+                if prontos:
+                    self.processar(prontos)
+            except Exception:
+                traceback.print_exc()
+
+            if uma_vez and not self._vistos:
+                return
+            time.sleep(self.intervalo)
+
+
+def _destino_livre(destino):
+    """Evita sobrescrever um arquivo de mesmo nome já arquivado"""
+    if not destino.exists():
+        return destino
+    return destino.with_name(f"{destino.stem}_{datetime.now():%H%M%S%f}{destino.suffix}")
+
+
+def iniciar_em_segundo_plano():
+    """Inicia o monitor num processo separado, independente de quem o chamou"""
+    processo = subprocess.Popen(
+        [sys.executable, str(Path(__file__).resolve())],
+        cwd=os.getcwd(),
+        start_new_session=True
+    )
+    print(f"Monitor de uploads iniciado (pid {processo.pid})")
+    return processo
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Importa automaticamente os arquivos de data/uploads')
+    parser.add_argument('--db', default=None, help='Banco SQLite (padrão: o mesmo do app)')
+    parser.add_argument('--pasta', default=str(PASTA_UPLOADS))
+    parser.add_argument('--modo', default=os.environ.get('MONITOR_UPLOADS_MODO', 'incremental'),
+                        choices=['incremental', 'completo'])
+    parser.add_argument('--intervalo', type=float, default=10)
+    parser.add_argument('--estabilidade', type=float, default=ESTABILIDADE_SEGUNDOS)
+    parser.add_argument('--processos', type=int,
+                        default=int(os.environ.get('MONITOR_UPLOADS_PROCESSOS', 2)))
+    parser.add_argument('--uma-vez', action='store_true',
+                        help='Importa o que estiver pronto e sai')
+    args = parser.parse_args()
+
+    monitor = MonitorUploads(args.db or banco_padrao(), pasta=args.pasta, modo=args.modo,
+                             intervalo=args.intervalo, estabilidade=args.estabilidade,
+                             processos=args.processos)
+    monitor.executar(uma_vez=args.uma_vez)
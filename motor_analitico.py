@@ -0,0 +1,170 @@
+"""
+Motor das consultas analíticas pesadas (agregações sobre vendas inteira)
+
+Por padrão elas rodam no próprio SQLite. Com MOTOR_ANALITICO=duckdb, as
+tabelas de TABELAS_ANALITICAS são copiadas para um arquivo DuckDB ao lado do
+banco (database.db -> database.duckdb) e as consultas rodam nele, em colunas
+e vetorizadas. A cópia é refeita por quem escreve, não por quem lê: a fila de
+tarefas chama sincronizar() no fim de cada importação ou recálculo e, parada,
+confere a marca do SQLite (toda importação grava em importacoes), o que
+alcança também as importações do monitor de uploads. As consultas usam a
+última cópia pronta, que continua valendo entre reinícios do app.
+
+O DuckDB é opcional (pip install duckdb): sem ele, o motor volta para o
+SQLite com um aviso. As consultas roteadas usam SQL comum aos dois motores
+(datas como número do dia, com a data de referência já no texto da consulta)
+e devolvem os mesmos DataFrames nos dois.
+"""
+import os
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+# Tabelas copiadas para o DuckDB -> colunas copiadas (None = todas). De vendas
+# vão só chaves e valores: ler as colunas de texto é o que mais pesa na cópia
+TABELAS_ANALITICAS = {
+    'vendas': ('id', 'n_venda', 'data_dia', 'ano_mes', 'produto_id', 'cliente_id',
+               'vendedor_id', 'marca_id', 'quantidade', 'valor_bruto', 'desconto',
+               'total', 'preco_final', 'preco_base'),
+    'dim_cliente': None,
+    'dim_produto': None,
+}
+
+# Linhas lidas do SQLite por bloco na cópia
+LINHAS_POR_BLOCO = 500000
+
+# Tipo declarado no SQLite -> tipo da coluna no DuckDB (datas ficam em texto, como no SQLite)
+TIPOS_DUCKDB = {
+    'INTEGER': 'BIGINT',
+    'REAL': 'DOUBLE',
+    'TEXT': 'VARCHAR',
+}
+
+
+class MotorSQLite:
+    """Consultas analíticas no próprio SQLite, pelo leitor da thread"""
+
+    nome = 'sqlite'
+
+    def __init__(self, db):
+        self.db = db
+
+    def consultar(self, sql, params=None):
+        """Executa a consulta e devolve um DataFrame"""
+        return pd.read_sql(sql, self.db.connect(), params=params)
+
+    def sincronizar(self):
+        """Nada a copiar: as consultas leem o próprio SQLite"""
+
+
+class MotorDuckDB:
+    """Consultas analíticas num arquivo DuckDB com a cópia das TABELAS_ANALITICAS
+
+    Cada thread consulta pelo seu próprio cursor; a cópia é feita dentro de
+    uma transação, então quem consulta durante a recarga continua vendo os
+    dados anteriores. Enquanto nenhuma cópia foi feita, as consultas rodam
+    no SQLite.
+    """
+
+    nome = 'duckdb'
+
+    def __init__(self, db, caminho=None):
+        import duckdb
+
+        self.db = db
+        self.caminho = caminho or str(Path(db.db_path).with_suffix('.duckdb'))
+        self.conexao = duckdb.connect(self.caminho)
+        self.conexao.execute('CREATE TABLE IF NOT EXISTS sincronizacao (marca VARCHAR)')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._marca = None
+        # Cópia de uma execução anterior do app já serve às consultas
+        self._copia_pronta = self.conexao.execute('SELECT marca FROM sincronizacao').fetchone() is not None
+
+    def _cursor(self):
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self._local.cursor = self.conexao.cursor()
+        return cursor
+
+    def _marca_sqlite(self):
+        """Identifica o conteúdo atual do SQLite: versão do esquema, última importação e última linha"""
+        importacao, linha = self.db.connect().execute(
+            'SELECT (SELECT MAX(id) FROM importacoes), (SELECT MAX(id) FROM vendas)'
+        ).fetchone()
+        return f'{self.db.versao_esquema}:{importacao}:{linha}'
+
+    def sincronizar(self):
+        """Refaz a cópia das TABELAS_ANALITICAS se o SQLite mudou desde a última"""
+        marca = self._marca_sqlite()
+        if marca == self._marca:
+            return
+
+        with self._lock:
+            cursor = self._cursor()
+            gravada = cursor.execute('SELECT marca FROM sincronizacao').fetchone()
+            if gravada is None or gravada[0] != marca:
+                print(f"Copiando {', '.join(TABELAS_ANALITICAS)} para o DuckDB ({self.caminho})...")
+                cursor.execute('BEGIN TRANSACTION')
+                try:
+                    for tabela in TABELAS_ANALITICAS:
+                        self._copiar_tabela(cursor, tabela)
+                    cursor.execute('DELETE FROM sincronizacao')
+                    cursor.execute('INSERT INTO sincronizacao VALUES (?)', [marca])
+                    cursor.execute('COMMIT')
+                except Exception:
+                    cursor.execute('ROLLBACK')
+                    raise
+                print("OK: Cópia no DuckDB atualizada")
+            self._marca = marca
+            self._copia_pronta = True
+
+    def _copiar_tabela(self, cursor, tabela):
+        """Recria `tabela` no DuckDB com os tipos do SQLite e copia as linhas em blocos"""
+        conn = self.db.connect()
+        copiadas = TABELAS_ANALITICAS[tabela]
+        tipos = {
+            nome: TIPOS_DUCKDB.get(tipo.upper(), 'VARCHAR')
+            for _, nome, tipo, *_ in conn.execute(f'PRAGMA table_info({tabela})')
+            if copiadas is None or nome in copiadas
+        }
+        cursor.execute(f'DROP TABLE IF EXISTS {tabela}')
+        cursor.execute(f'CREATE TABLE {tabela} ({", ".join(f"{nome} {tipo}" for nome, tipo in tipos.items())})')
+
+        consulta = f'SELECT {", ".join(tipos)} FROM {tabela}'
+        for bloco in pd.read_sql(consulta, conn, chunksize=LINHAS_POR_BLOCO):
+            cursor.register('bloco', bloco)
+            cursor.execute(f'INSERT INTO {tabela} SELECT * FROM bloco')
+            cursor.unregister('bloco')
+
+    def consultar(self, sql, params=None):
+        """Executa a consulta na última cópia sincronizada e devolve um DataFrame"""
+        if not self._copia_pronta:
+            return pd.read_sql(sql, self.db.connect(), params=params)
+        return self._cursor().execute(sql, params or []).df()
+
+
+_motores = {}
+_motores_lock = threading.Lock()
+
+
+def obter_motor(db, nome=None):
+    """Motor analítico único por banco e tipo dentro do processo
+
+    `nome` ('sqlite' ou 'duckdb') vem por padrão de MOTOR_ANALITICO; sem o
+    pacote duckdb instalado, fica o SQLite.
+    """
+    nome = (nome or os.environ.get('MOTOR_ANALITICO', 'sqlite')).lower()
+    chave = (os.path.abspath(db.db_path), nome)
+    with _motores_lock:
+        if chave not in _motores:
+            if nome == 'duckdb':
+                try:
+                    _motores[chave] = MotorDuckDB(db)
+                except ImportError:
+                    print("AVISO: MOTOR_ANALITICO=duckdb, mas o pacote duckdb não está instalado; usando o SQLite")
+                    _motores[chave] = MotorSQLite(db)
+            else:
+                _motores[chave] = MotorSQLite(db)
+        return _motores[chave]
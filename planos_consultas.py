@@ -0,0 +1,171 @@
+"""
+Conferência dos planos de execução das análises pontuais (EXPLAIN QUERY PLAN)
+
+As análises de um cliente ou de um produto filtram vendas, pedidos e os
+resumos mensais pela chave da dimensão e precisam dos índices compostos de
+INDICES. Cada análise registrada em CONSULTAS é executada para um cliente e
+um produto de amostra com o rastreamento de SQL da conexão ligado; toda
+consulta capturada que lê uma das TABELAS_CONFERIDAS passa pelo EXPLAIN QUERY
+PLAN e não pode ter SCAN dela (varredura completa, mesmo que por índice).
+
+A amostra é o cliente e o produto do meio da lista por número de vendas: para
+os maiores, varrer o índice inteiro pode ser de fato o plano mais barato.
+
+    python planos_consultas.py [--db database.db]
+
+Sai com código 1 se alguma consulta regredir para varredura completa.
+"""
+import argparse
+import re
+import sys
+
+from analise_clientes import AnalisadorClientes
+from analise_produtos_v2 import AnalisadorProdutos
+from db_manager_v2 import DatabaseManager, banco_padrao
+
+# Análises pontuais: nome -> função(analisador de clientes, de produtos, amostra)
+CONSULTAS = {
+    'cliente_completo': lambda clientes, produtos, amostra:
+        clientes.get_analise_completa_cliente(amostra['cod_parceiro']),
+    'cliente_por_nome': lambda clientes, produtos, amostra: (
+        clientes.analisar_categorias_cliente(amostra['parceiro']),
+        clientes.analisar_frequencia_compra(amostra['parceiro']),
+        clientes.gerar_recomendacoes(amostra['parceiro']),
+    ),
+    'produto_completo': lambda clientes, produtos, amostra:
+        produtos.get_analise_completa_produto(amostra['cod_produto']),
+    'produto_por_nome': lambda clientes, produtos, amostra: (
+        produtos.get_produtos_complementares(amostra['produto']),
+        produtos.analisar_sazonalidade(amostra['produto']),
+    ),
+}
+
+AMOSTRA_CLIENTE = '''
+    SELECT c.cod_parceiro, c.parceiro
+    FROM vendas v
+    JOIN dim_cliente c ON c.id = v.cliente_id
+    WHERE c.cod_parceiro IS NOT NULL
+    GROUP BY v.cliente_id
+    ORDER BY COUNT(*) DESC
+    LIMIT 1 OFFSET (SELECT COUNT(DISTINCT cliente_id) FROM vendas) / 2
+'''
+
+AMOSTRA_PRODUTO = '''
+    SELECT p.cod_produto, p.produto
+    FROM vendas v
+    JOIN dim_produto p ON p.id = v.produto_id
+    WHERE p.cod_produto IS NOT NULL
+    GROUP BY v.produto_id
+    ORDER BY COUNT(*) DESC
+    LIMIT 1 OFFSET (SELECT COUNT(DISTINCT produto_id) FROM vendas) / 2
+'''
+
+# Tabelas grandes, que as análises pontuais nunca podem ler inteiras
+TABELAS_CONFERIDAS = ('vendas', 'pedidos', 'cliente_mes', 'produto_mes')
+
+# "FROM vendas v" / "JOIN vendas AS v": o plano mostra o apelido, não o nome da tabela
+_LEITURA_TABELA = re.compile(
+    r'\b(?:FROM|JOIN)\s+({})\b(?:\s+(?:AS\s+)?(\w+))?'.format('|'.join(TABELAS_CONFERIDAS)),
+    re.IGNORECASE
+)
+_PALAVRAS_SQL = {'WHERE', 'GROUP', 'ORDER', 'LEFT', 'INNER', 'CROSS', 'JOIN', 'ON',
+                 'LIMIT', 'HAVING', 'UNION', 'EXCEPT', 'INTERSECT'}
+
+
+def apelidos_conferidos(sql):
+    """Nomes pelos quais as TABELAS_CONFERIDAS aparecem no plano da consulta"""
+    apelidos = set()
+    for encontrado in _LEITURA_TABELA.finditer(sql):
+        tabela, apelido = encontrado.groups()
+        if apelido and apelido.upper() not in _PALAVRAS_SQL:
+            apelidos.add(apelido)
+        else:
+            apelidos.add(tabela)
+    return apelidos
+
+
+def varreduras(conn, sql):
+    """Plano da consulta e as linhas dele que varrem uma tabela conferida inteira"""
+    apelidos = apelidos_conferidos(sql)
+    plano = [linha[3] for linha in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+    return plano, [
+        detalhe for detalhe in plano
+        if detalhe.startswith('SCAN ') and detalhe.split()[1] in apelidos
+    ]
+
+
+def capturar_consultas(conn, funcao):
+    """Executa `funcao` registrando o SQL (já com os parâmetros) que passar pela conexão"""
+    capturadas = []
+    conn.set_trace_callback(capturadas.append)
+    try:
+        funcao()
+    finally:
+        conn.set_trace_callback(None)
+    return capturadas
+
+
+def verificar_planos(db, consultas=CONSULTAS):
+    """Roda as análises registradas e confere o plano de cada consulta às tabelas grandes
+
+    Retorna uma lista com uma entrada por consulta conferida:
+    {'analise', 'sql', 'plano', 'varreduras'}; `varreduras` vazio quer dizer
+    plano aprovado. Uma análise sem nenhuma consulta conferida entra com
+    sql=None e uma varredura descrevendo o problema.
+    """
+    conn = db.connect()
+    amostra = {}
+    for consulta in (AMOSTRA_CLIENTE, AMOSTRA_PRODUTO):
+        cursor = conn.execute(consulta)
+        linha = cursor.fetchone()
+        if linha is None:
+            raise ValueError('Banco sem vendas para escolher a amostra')
+        amostra.update(zip([coluna[0] for coluna in cursor.description], linha))
+
+    clientes = AnalisadorClientes(db)
+    produtos = AnalisadorProdutos(db)
+
+    resultado = []
+    for nome, funcao in consultas.items():
+        capturadas = capturar_consultas(conn, lambda: funcao(clientes, produtos, amostra))
+        conferidas = 0
+        for sql in dict.fromkeys(capturadas):
+            if not sql.lstrip().upper().startswith(('SELECT', 'WITH')) or not apelidos_conferidos(sql):
+                continue
+            plano, encontradas = varreduras(conn, sql)
+            resultado.append({'analise': nome, 'sql': sql, 'plano': plano, 'varreduras': encontradas})
+            conferidas += 1
+        if conferidas == 0:
+            resultado.append({'analise': nome, 'sql': None, 'plano': [],
+                              'varreduras': ['nenhuma consulta conferida foi executada']})
+
+    return resultado
+
+
+def _resumo_sql(sql, limite=100):
+    return ' '.join(sql.split())[:limite]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Confere os planos das consultas das análises')
+    parser.add_argument('--db', default=None, help='Banco SQLite (padrão: o mesmo do app)')
+    parser.add_argument('--verboso', action='store_true', help='Mostra o plano de todas as consultas')
+    args = parser.parse_args()
+
+    db = DatabaseManager(args.db or banco_padrao())
+    try:
+        resultado = verificar_planos(db)
+    finally:
+        db.close()
+
+    falhas = [item for item in resultado if item['varreduras']]
+    for item in resultado:
+        if not (args.verboso or item['varreduras']):
+            continue
+        status = 'VARREDURA' if item['varreduras'] else 'OK'
+        print(f"[{status}] {item['analise']}: {_resumo_sql(item['sql'] or '-')}")
+        for detalhe in item['plano'] or item['varreduras']:
+            print(f"    {detalhe}")
+
+    print(f"{len(resultado)} consulta(s) conferida(s), {len(falhas)} com varredura completa")
+    sys.exit(1 if falhas else 0)
@@ -2,15 +2,133 @@
 Script de inicialização automática para garantir que o banco esteja configurado
 Garante que os dados locais sejam copiados para Railway
 """
+import json
 import os
 import sys
-import shutil
+import sqlite3
+from datetime import datetime
 from pathlib import Path
 from db_manager_v2 import DatabaseManager
+from importacao import calcular_hash_arquivo
+
+# Páginas copiadas por passo da API de backup: entre um passo e outro o banco
+# de origem fica livre para quem estiver escrevendo nele
+PAGINAS_POR_PASSO = 4096
+
+# Cópias de segurança do banco de produção tiradas na inicialização
+PASTA_BACKUPS = Path(os.environ.get('PASTA_BACKUPS', 'backups'))
+BACKUPS_MANTIDOS = int(os.environ.get('BACKUPS_MANTIDOS', 3))
+
+def copiar_banco(origem, destino):
+    """Copia um banco SQLite pela API de backup online, em passos de PAGINAS_POR_PASSO
+
+    Ao contrário de copiar o arquivo, a cópia inclui o que ainda está no -wal
+    e é consistente mesmo com a origem em uso. Ela é gravada num arquivo
+    temporário que só no final substitui o destino (junto some o -wal/-shm
+    que sobrou do destino antigo).
+    """
+    temporario = f'{destino}.tmp'
+    if os.path.exists(temporario):
+        os.remove(temporario)
+
+    fonte = sqlite3.connect(origem)
+    alvo = sqlite3.connect(temporario)
+    try:
+        fonte.backup(alvo, pages=PAGINAS_POR_PASSO)
+    finally:
+        alvo.close()
+        fonte.close()
+
+    for sufixo in ('-wal', '-shm'):
+        if os.path.exists(destino + sufixo):
+            os.remove(destino + sufixo)
+    os.replace(temporario, destino)
+
+def _assinatura(caminho):
+    """Tamanho e data de modificação: se não mudaram, o conteúdo também não"""
+    info = os.stat(caminho)
+    return [info.st_size, info.st_mtime_ns]
+
+def _cabecalho(caminho):
+    """Campos do cabeçalho do SQLite que mudam com as escritas (bytes 24 a 100)
+
+    Contador de alterações, número de páginas, páginas livres, versão do
+    esquema e `user_version`. Em modo WAL o contador nem sempre sobe a cada
+    transação, então cabeçalhos diferentes provam que o banco mudou, mas
+    cabeçalhos iguais não provam que ele está igual.
+    """
+    with open(caminho, 'rb') as arquivo:
+        return arquivo.read(100)[24:].hex()
+
+def _wal_pendente(caminho):
+    """Se o -wal tem transações ainda não incorporadas ao arquivo principal"""
+    wal = f'{caminho}-wal'
+    return os.path.exists(wal) and os.path.getsize(wal) > 0
+
+def fazer_backup(caminho):
+    """Guarda uma cópia de `caminho` em PASTA_BACKUPS, mantendo as BACKUPS_MANTIDOS mais novas
+
+    O registro da última cópia (`<banco>.backup.json`) guarda a assinatura e o
+    cabeçalho do banco logo depois do checkpoint que incorpora o -wal ao
+    arquivo principal. Na próxima inicialização, um -wal com transações, outro
+    tamanho ou outro cabeçalho bastam para saber que o banco mudou; a mesma
+    assinatura, que não mudou. O SHA-256 do arquivo só é calculado quando só a
+    data de modificação mudou (ex.: arquivo copiado ou tocado por fora).
+    """
+    # O último backup deixou o -wal vazio: o que houver nele veio depois
+    mudou = _wal_pendente(caminho)
+
+    conn = sqlite3.connect(caminho)
+    try:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+
+    arquivo_registro = Path(f'{caminho}.backup.json')
+    registro = json.loads(arquivo_registro.read_text()) if arquivo_registro.exists() else {}
+    ultimo = registro.get('backup')
+    assinatura = _assinatura(caminho)
+    cabecalho = _cabecalho(caminho)
+    sha256 = None
+
+    if ultimo and os.path.exists(ultimo) and not mudou:
+        if registro.get('assinatura') == assinatura:
+            print(f"Backup em dia: {ultimo}")
+            return ultimo
+        if (registro.get('assinatura', [None])[0] == assinatura[0]
+                and registro.get('cabecalho') == cabecalho):
+            sha256 = calcular_hash_arquivo(caminho)
+            if registro.get('sha256') == sha256:
+                registro['assinatura'] = assinatura
+                arquivo_registro.write_text(json.dumps(registro))
+                print(f"Backup em dia: {ultimo}")
+                return ultimo
+
+    PASTA_BACKUPS.mkdir(parents=True, exist_ok=True)
+    nome = Path(caminho).stem
+    backup = PASTA_BACKUPS / f"{nome}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db"
+    copiar_banco(caminho, str(backup))
+    arquivo_registro.write_text(json.dumps(
+        {'backup': str(backup), 'assinatura': assinatura, 'cabecalho': cabecalho, 'sha256': sha256}
+    ))
+    print(f"Backup criado: {backup}")
+
+    # Rotação: o nome tem a data, então a ordem alfabética é a cronológica
+    for antigo in sorted(PASTA_BACKUPS.glob(f'{nome}-*.db'))[:-BACKUPS_MANTIDOS]:
+        antigo.unlink()
+        print(f"Backup antigo removido: {antigo}")
+
+    return str(backup)
 
 def copy_local_database():
-    """Copia banco de dados local se disponível e necessário"""
+    """Prepara database_production.db a partir do banco local com dados
+
+    Um banco de produção com dados é mantido como está e só ganha um backup
+    (pulado se nada mudou desde o último); sem ele, o database.db local é
+    copiado pela API de backup.
+    """
     source_files = ['database_production.db', 'database.db']
+    target_file = 'database_production.db'  # Sempre usar production como padrão
 
     for source_file in source_files:
         if os.path.exists(source_file):
@@ -19,16 +137,12 @@ def copy_local_database():
             if file_size > 1000:  # Arquivo com pelo menos 1KB de dados
                 print(f"Encontrado banco local com dados: {source_file} ({file_size} bytes)")
 
-                # Fazer backup do arquivo existente se houver
-                target_file = 'database_production.db'  # Sempre usar production como padrão
-                if os.path.exists(target_file) and target_file != source_file:
-                    backup_file = f"{target_file}.backup"
-                    shutil.copy2(target_file, backup_file)
-                    print(f"Backup criado: {backup_file}")
-
-                # Copiar o arquivo com dados
-                if target_file != source_file:
-                    shutil.copy2(source_file, target_file)
+                if target_file == source_file:
+                    # Backup antes de o banco ser aberto (e migrado)
+                    fazer_backup(target_file)
+                else:
+                    # Copiar o banco com dados
+                    copiar_banco(source_file, target_file)
                     print(f"Banco copiado: {source_file} -> {target_file}")
 
                 return target_file
@@ -79,32 +193,15 @@ def setup_database():
         
         db.close()
     
-    # Verificar integridade do banco
+    # Verificar integridade do banco (a abertura cria as tabelas que faltam,
+    # aplica as migrações pendentes e monta as métricas)
     try:
         db = DatabaseManager(db_path)
         conn = db.connect()
         cursor = conn.cursor()
         
-        # Verificar tabelas essenciais
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = [row[0] for row in cursor.fetchall()]
-        
-        required_tables = ['vendas', 'clientes_metricas', 'produtos_metricas']
-        missing = [t for t in required_tables if t not in tables]
-        
-        if missing:
-            print(f"Tabelas faltando: {missing}")
-            print("Recriando estrutura do banco...")
-            db.init_database()
-            
-            # Tentar reimportar dados se necessário
-            cursor.execute("SELECT COUNT(*) FROM vendas")
-            if cursor.fetchone()[0] == 0:
-                for csv_file in csv_files:
-                    if os.path.exists(csv_file):
-                        print(f"Reimportando dados de {csv_file}...")
-                        db.import_csv(csv_file)
-                        break
+        print(f"Esquema do banco na versão {db.versao_esquema}; "
+              f"recursos: {', '.join(sorted(db.recursos))}")
         
         # Verificar se há dados
         cursor.execute("SELECT COUNT(*) FROM vendas")
@@ -113,19 +210,10 @@ def setup_database():
 
         if count > 0:
             # Verificar período dos dados
-            cursor.execute("SELECT MIN(data), MAX(data) FROM vendas")
+            cursor.execute("SELECT date(MIN(data_dia) * 86400, 'unixepoch'), "
+                           "date(MAX(data_dia) * 86400, 'unixepoch') FROM vendas")
             min_data, max_data = cursor.fetchone()
             print(f"Período dos dados: {min_data} até {max_data}")
-
-            # Verificar tabelas de métricas
-            cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ('clientes_metricas', 'produtos_metricas')")
-            metrics_tables = cursor.fetchone()[0]
-            print(f"Tabelas de métricas encontradas: {metrics_tables}")
-
-            if metrics_tables < 2:
-                print("Atualizando métricas...")
-                db.update_metrics()
-                print("Métricas atualizadas com sucesso!")
         else:
             print("AVISO: Banco de dados vazio. Os dados serão carregados do repositório.")
 
@@ -142,6 +230,12 @@ if __name__ == "__main__":
     db_path = setup_database()
     if db_path:
         print(f"\nBanco de dados pronto: {db_path}")
+
+        # Importação automática dos arquivos deixados em data/uploads
+        if os.environ.get('MONITOR_UPLOADS') == '1':
+            from monitor_uploads import iniciar_em_segundo_plano
+            iniciar_em_segundo_plano()
+
         print("Sistema pronto para uso!")
     else:
         print("\nERRO: Não foi possível configurar o banco de dados.")
@@ -0,0 +1,288 @@
+"""
+Fila de tarefas em segundo plano (importações e recálculo de métricas)
+
+As tarefas ficam gravadas na tabela `tarefas` e são executadas, uma de cada
+vez, por uma única thread com a sua própria conexão. A página só enfileira e
+consulta o status, então uma importação longa não depende da sessão do
+Streamlit que a pediu.
+
+A tabela fica num arquivo ao lado do banco (database_tarefas.db para
+database.db): a importação mantém o banco principal bloqueado para escrita
+enquanto roda, e status e progresso precisam ser gravados nesse meio tempo.
+"""
+import json
+import sqlite3
+import threading
+import time
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+from db_manager_v2 import DatabaseManager
+from motor_analitico import obter_motor
+
+TIPOS_TAREFA = ('importacao', 'metricas')
+
+# Status em que a tarefa ainda vai (ou está para) rodar
+STATUS_ATIVOS = ('pendente', 'executando')
+
+# Espera do trabalhador quando a fila está vazia (segundos)
+INTERVALO_FILA = 2.0
+
+TABELA_TAREFAS = '''
+    CREATE TABLE IF NOT EXISTS tarefas (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tipo TEXT NOT NULL,
+        parametros TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pendente',
+        progresso_linhas INTEGER DEFAULT 0,
+        linhas_por_segundo REAL DEFAULT 0,
+        resultado TEXT,
+        erro TEXT,
+        criada_em TIMESTAMP,
+        iniciada_em TIMESTAMP,
+        concluida_em TIMESTAMP
+    )
+'''
+
+_filas = {}
+_filas_lock = threading.Lock()
+
+
+def caminho_tarefas(db_path):
+    """Arquivo da tabela de tarefas de um banco"""
+    caminho = Path(db_path)
+    return str(caminho.with_name(f'{caminho.stem}_tarefas.db'))
+
+
+def obter_fila(db_path):
+    """Fila única por banco: reruns e caches limpos não criam outro trabalhador"""
+    with _filas_lock:
+        if db_path not in _filas:
+            _filas[db_path] = FilaTarefas(db_path)
+        return _filas[db_path]
+
+
+class FilaTarefas:
+    """Fila persistente com um único trabalhador
+
+    Como só uma thread executa tarefas, duas importações nunca rodam ao mesmo
+    tempo.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.tarefas_path = caminho_tarefas(db_path)
+        self._lock = threading.Lock()
+        self._sinal = threading.Event()
+
+        self._init_tabela()
+
+        # Conexão própria do trabalhador, criada já aqui para que ajustes de
+        # esquema do init_database rodem antes de qualquer tarefa
+        self._db = DatabaseManager(db_path)
+
+        self._trabalhador = threading.Thread(target=self._executar, name='fila-tarefas', daemon=True)
+        self._trabalhador.start()
+
+    def _conectar(self):
+        """Conexão curta para ler/gravar a tabela de tarefas"""
+        conn = sqlite3.connect(self.tarefas_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_tabela(self):
+        """Cria a tabela e marca as tarefas que o último processo deixou pela metade"""
+        conn = self._conectar()
+        try:
+            conn.execute(TABELA_TAREFAS)
+            interrompidas = conn.execute('''
+                UPDATE tarefas
+                SET status = 'interrompida',
+                    erro = 'Servidor reiniciado durante a execução',
+                    concluida_em = ?
+                WHERE status = 'executando'
+            ''', (datetime.now(),)).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+
+        if interrompidas:
+            print(f"AVISO: {interrompidas} tarefa(s) interrompida(s) por reinício")
+
+    def enfileirar(self, tipo, **parametros):
+        """Enfileira uma tarefa e retorna o seu id
+
+        Se já houver uma tarefa igual (mesmo tipo e parâmetros) pendente ou em
+        execução, retorna o id dela em vez de criar outra.
+        """
+        if tipo not in TIPOS_TAREFA:
+            raise ValueError(f"Tipo de tarefa inválido: {tipo}")
+
+        parametros_json = json.dumps(parametros, sort_keys=True)
+
+        with self._lock:
+            conn = self._conectar()
+            try:
+                existente = conn.execute('''
+                    SELECT id FROM tarefas
+                    WHERE tipo = ? AND parametros = ? AND status IN (?, ?)
+                    ORDER BY id LIMIT 1
+                ''', (tipo, parametros_json) + STATUS_ATIVOS).fetchone()
+                if existente:
+                    return existente['id']
+
+                cursor = conn.execute('''
+                    INSERT INTO tarefas (tipo, parametros, status, criada_em)
+                    VALUES (?, ?, 'pendente', ?)
+                ''', (tipo, parametros_json, datetime.now()))
+                conn.commit()
+                tarefa_id = cursor.lastrowid
+            finally:
+                conn.close()
+
+        print(f"Tarefa {tarefa_id} enfileirada: {tipo}")
+        self._sinal.set()
+        return tarefa_id
+
+    def obter(self, tarefa_id):
+        """Status, progresso e resultado da tarefa"""
+        conn = self._conectar()
+        try:
+            row = conn.execute('SELECT * FROM tarefas WHERE id = ?', (tarefa_id,)).fetchone()
+        finally:
+            conn.close()
+        return self._formatar(row) if row else None
+
+    def listar(self, limite=10):
+        """Tarefas mais recentes primeiro"""
+        conn = self._conectar()
+        try:
+            rows = conn.execute('SELECT * FROM tarefas ORDER BY id DESC LIMIT ?', (limite,)).fetchall()
+        finally:
+            conn.close()
+        return [self._formatar(row) for row in rows]
+
+    def tarefas_ativas(self):
+        """Tarefas pendentes ou em execução, na ordem em que vão rodar"""
+        conn = self._conectar()
+        try:
+            rows = conn.execute('''
+                SELECT * FROM tarefas WHERE status IN (?, ?) ORDER BY id
+            ''', STATUS_ATIVOS).fetchall()
+        finally:
+            conn.close()
+        return [self._formatar(row) for row in rows]
+
+    def _formatar(self, row):
+        tarefa = dict(row)
+        tarefa['parametros'] = json.loads(tarefa['parametros'])
+        tarefa['resultado'] = json.loads(tarefa['resultado']) if tarefa['resultado'] else None
+        return tarefa
+
+    def _atualizar(self, tarefa_id, **campos):
+        conn = self._conectar()
+        try:
+            conn.execute('UPDATE tarefas SET {} WHERE id = ?'.format(
+                ', '.join(f'{campo} = ?' for campo in campos)
+            ), list(campos.values()) + [tarefa_id])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _proxima(self):
+        """Marca a tarefa pendente mais antiga como em execução e a retorna"""
+        with self._lock:
+            conn = self._conectar()
+            try:
+                row = conn.execute('''
+                    SELECT * FROM tarefas WHERE status = 'pendente' ORDER BY id LIMIT 1
+                ''').fetchone()
+                if row is None:
+                    return None
+                conn.execute('''
+                    UPDATE tarefas SET status = 'executando', iniciada_em = ? WHERE id = ?
+                ''', (datetime.now(), row['id']))
+                conn.commit()
+            finally:
+                conn.close()
+        return self._formatar(row)
+
+    def _executar(self):
+        """Laço do trabalhador: uma tarefa por vez, com a sua própria conexão"""
+        while True:
+            try:
+                tarefa = self._proxima()
+            except sqlite3.OperationalError as e:
+                print(f"Erro ao ler a fila de tarefas: {e}")
+                tarefa = None
+
+            if tarefa is None:
+                # Parado: alcança as importações feitas por fora (monitor de uploads)
+                self._sincronizar_motor(self._db)
+                self._sinal.wait(INTERVALO_FILA)
+                self._sinal.clear()
+                continue
+
+            self._rodar(self._db, tarefa)
+
+    def _sincronizar_motor(self, db):
+        """Atualiza a cópia do motor analítico (ver motor_analitico), se o banco mudou
+
+        Uma falha aqui não derruba a tarefa: as consultas seguem na cópia anterior.
+        """
+        try:
+            obter_motor(db).sincronizar()
+        except Exception as e:
+            print(f"Erro ao sincronizar o motor analítico: {e}")
+
+    def _rodar(self, db, tarefa):
+        tarefa_id = tarefa['id']
+        parametros = tarefa['parametros']
+        print(f"Executando tarefa {tarefa_id}: {tarefa['tipo']}")
+
+        def registrar_progresso(linhas, linhas_por_segundo):
+            self._atualizar(tarefa_id, progresso_linhas=linhas, linhas_por_segundo=linhas_por_segundo)
+
+        try:
+            if tarefa['tipo'] == 'importacao':
+                resultado = db.import_arquivos(_caminhos(parametros), modo=parametros.get('modo', 'completo'),
+                                               progress_callback=registrar_progresso,
+                                               forcar=parametros.get('forcar', False))
+                resultado = _resumo_importacao(resultado)
+            else:
+                inicio = time.perf_counter()
+                db.update_metrics()
+                resultado = {'segundos': time.perf_counter() - inicio}
+
+            # Antes de concluir: quando a página mostra a tarefa pronta, as
+            # consultas do motor analítico já leem os dados novos
+            self._sincronizar_motor(db)
+
+            self._atualizar(tarefa_id, status='concluida', resultado=json.dumps(resultado),
+                            progresso_linhas=resultado.get('linhas', 0), concluida_em=datetime.now())
+            print(f"OK: Tarefa {tarefa_id} concluída")
+        except Exception as e:
+            traceback.print_exc()
+            self._atualizar(tarefa_id, status='erro', erro=str(e), concluida_em=datetime.now())
+        finally:
+            if parametros.get('remover_arquivo'):
+                for caminho in _caminhos(parametros):
+                    try:
+                        Path(caminho).unlink()
+                    except OSError:
+                        pass
+
+
+def _caminhos(parametros):
+    """Arquivos de uma tarefa de importação (`caminho` único ou lista em `caminhos`)"""
+    return parametros.get('caminhos') or [parametros['caminho']]
+
+
+def _resumo_importacao(resultado):
+    """Resultado do import_csv em formato JSON (conjuntos de códigos viram contagens)"""
+    resumo = dict(resultado)
+    for chave in ('clientes_afetados', 'produtos_afetados'):
+        if resumo.get(chave) is not None:
+            resumo[chave] = len(resumo[chave])
+    return resumo